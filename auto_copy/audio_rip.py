@@ -0,0 +1,203 @@
+"""
+audio_rip.py
+Rip audio CDs without abcde: cdparanoia reads one track after the other,
+and every track that has been read is encoded right away into all wanted
+formats, while the drive goes on with the next track. The disc can be
+ejected as soon as the last track has been read.
+"""
+
+import logging
+import os
+import re
+import time
+
+import drive
+import metrics
+import supervisor
+
+LOGGER = logging.getLogger('auto_copy')
+
+FORMATS = ('mp3', 'flac', 'opus')
+
+# a track in the output of cdparanoia -Q, e.g.
+#   1.    16503 [03:40.03]        0 [00:00.00]    no   no  2
+TOC_LINE = re.compile(r'^\s*(\d+)\.\s+(\d+) \[[\d:.]+\]\s+(\d+) ')
+
+
+class Track(object):
+    """
+    An audio track and what became of it
+    """
+
+    def __init__(self, number, sectors=None):
+        """
+        number: track number
+        sectors: length in sectors, if known
+        """
+        self.number = number
+        self.sectors = sectors
+        self.wav = None
+        self.read_seconds = None
+        self.outputs = []
+        self.failed = []
+
+    @property
+    def name(self):
+        return 'track_%02d' % self.number
+
+
+def parse_cdparanoia_toc(output):
+    """
+    Parse the table of contents cdparanoia -Q prints
+
+    returns a list of Track objects
+    """
+    tracks = []
+    for line in output.splitlines():
+        match = TOC_LINE.match(line)
+        if match:
+            tracks.append(Track(int(match.group(1)), int(match.group(2))))
+    return tracks
+
+
+def read_tracks(device, cdparanoia='/bin/cdparanoia', timeout=supervisor.TOOL_TIMEOUT):
+    """
+    Find the audio tracks on the disc, from the drive if it tells us,
+    from cdparanoia otherwise
+
+    timeout: seconds cdparanoia may take
+
+    returns a list of Track objects
+    """
+    try:
+        return [Track(number, sectors) for number, start, sectors, audio
+                in drive.read_toc(device) if audio]
+    except OSError as error:
+        LOGGER.debug('Could not read TOC of %s (%s), asking cdparanoia', device, error)
+    result = supervisor.run([cdparanoia, '-d', device, '-Q'], timeout=timeout, capture=True,
+                            quiet=True)
+    return parse_cdparanoia_toc(result.output.decode('utf-8', 'replace'))
+
+
+def encode_command(config, audio_format, wav, outfile):
+    """
+    The command encoding wav to outfile in audio_format
+
+    config: a configParser object, for tool paths and bitrates
+    """
+    if audio_format == 'mp3':
+        return [config.lame, '--quiet', '-b', str(config.mp3_bitrate), wav, outfile]
+    if audio_format == 'flac':
+        return [config.flac, '--silent', '--force', '-o', outfile, wav]
+    if audio_format == 'opus':
+        return [config.opusenc, '--quiet', '--bitrate', str(config.opus_bitrate), wav, outfile]
+    raise ValueError('Unknown audio format ' + audio_format)
+
+
+def encode_track(config, track, audio_format, out_dir):
+    """
+    Encode a track that was read already into one format
+
+    returns True on success
+    """
+    outfile = os.path.join(out_dir, track.name + '.' + audio_format)
+    command = encode_command(config, audio_format, track.wav, outfile)
+    LOGGER.debug('Encoding: %s', ' '.join(command))
+    start = time.time()
+    try:
+        # the encoders are quiet, the growing output shows they are alive
+        returncode = supervisor.run(command, timeout=config.job_timeout,
+                                    stall_timeout=config.stall_timeout, watch=outfile).returncode
+    except OSError as error:
+        LOGGER.warning('Could not execute %s: %s', command[0], error)
+        returncode = 127
+    metrics.REGISTRY.observe('stage_seconds', time.time() - start, stage='audio_encode',
+                             format=audio_format)
+    if returncode != 0:
+        LOGGER.warning('Encoding %s to %s failed with %s', track.name, audio_format, returncode)
+        return False
+    return True
+
+
+def read_track(config, device, track, wav_dir):
+    """
+    Read a track into a wav file with cdparanoia
+
+    returns True on success
+    """
+    track.wav = os.path.join(wav_dir, track.name + '.wav')
+    command = [config.cdparanoia, '-q', '-d', device, '-w', str(track.number), track.wav]
+    labels = {'device': os.path.basename(device)}
+    metrics.REGISTRY.set('rip_track', track.number, **labels)
+    start = time.time()
+    try:
+        # a scratch can keep cdparanoia busy for long, but the wav file grows
+        returncode = supervisor.run(command, timeout=config.job_timeout,
+                                    stall_timeout=config.stall_timeout,
+                                    watch=track.wav).returncode
+    except OSError as error:
+        LOGGER.warning('Could not execute %s: %s', command[0], error)
+        returncode = 127
+    track.read_seconds = time.time() - start
+    metrics.REGISTRY.observe('rip_track_seconds', track.read_seconds, **labels)
+    if returncode != 0 or not os.path.exists(track.wav):
+        LOGGER.warning('Reading %s failed with %s', track.name, returncode)
+        return False
+    if track.sectors:
+        # in multiples of playing time, as drives are advertised
+        speed = float(track.sectors) / drive.CD_FRAMES / max(track.read_seconds, 0.001)
+        metrics.REGISTRY.set('rip_speed', round(speed, 1), **labels)
+        LOGGER.info('Read %s in %ss (%sx)', track.name, round(track.read_seconds, 1),
+                    round(speed, 1))
+    return True
+
+
+def rip_disc(config, device, out_dir, formats, workers=None, on_read_done=None):
+    """
+    Rip all audio tracks of a CD
+
+    config: a configParser object, for tool paths and bitrates
+    device: the drive
+    out_dir: directory for the encoded tracks, wav files are kept in a
+        hidden directory below it until they are encoded
+    formats: list of formats, see FORMATS
+    workers: encoders running at once, defaults to one per cpu core
+    on_read_done: called once the last track was read, e.g. to eject. optional
+
+    returns the list of Track objects
+    """
+    # only needed here, importing it costs every other run of auto_copy
+    import concurrent.futures
+    tracks = read_tracks(device, config.cdparanoia, config.tool_timeout)
+    LOGGER.info('Ripping %s tracks from %s to %s', len(tracks), device, ', '.join(formats))
+    wav_dir = os.path.join(out_dir, '.wav')
+    if not os.path.isdir(wav_dir):
+        os.makedirs(wav_dir)
+    pending = {}
+    # the encoders are external processes, threads only wait for them
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        for track in tracks:
+            if not read_track(config, device, track, wav_dir):
+                track.failed = list(formats)
+                continue
+            pending[track.number] = [pool.submit(encode_track, config, track, audio_format, out_dir)
+                                     for audio_format in formats]
+        metrics.REGISTRY.remove('rip_track', device=os.path.basename(device))
+        if on_read_done is not None:
+            on_read_done()
+        for track in tracks:
+            for audio_format, future in zip(formats, pending.get(track.number, [])):
+                if future.result():
+                    track.outputs.append(audio_format)
+                else:
+                    track.failed.append(audio_format)
+            if track.wav and os.path.exists(track.wav):
+                os.unlink(track.wav)
+    try:
+        os.rmdir(wav_dir)
+    except OSError as error:
+        LOGGER.warning('Could not remove %s: %s', wav_dir, error)
+    failed = [track.name for track in tracks if track.failed]
+    if failed:
+        LOGGER.warning('Could not rip %s', ', '.join(failed))
+    return tracks
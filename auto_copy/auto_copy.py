@@ -17,16 +17,33 @@ used manually.
 # 30-AUG-2018 - Isaac Hailperin <isaac.hailperin@gmail.com> - Adding dvd title detection
 
 import atexit
+import audio_rip
+import copy
 import datetime
+import fnmatch
+import json
 import logging
 import os
 import shutil
 import signal
-import subprocess
 import sys
+import threading
 import time
 import config_parser
+import copier
+import disc
+import drive
 import dvd_title
+import encode_queue
+import ingest_index
+import metadata_cache
+import metrics
+import mover
+import rescue
+import scheduler
+import segment_encode
+import supervisor
+import title_scan
 
 # ENVIRONMENT will be passed to subprocess.Popen()
 ENVIRONMENT = {
@@ -42,6 +59,9 @@ MEGA = KILO * KILO
 
 MY_PID = str(os.getpid())
 
+# the configuration key of the encoder for each format of the native audio ripper
+AUDIO_ENCODERS = {'mp3': 'lame', 'flac': 'flac', 'opus': 'opusenc'}
+
 LOG_LEVELS = {
     'info': logging.INFO,
     'debug': logging.DEBUG,
@@ -49,17 +69,10 @@ LOG_LEVELS = {
     'error': logging.ERROR,
     'critical': logging.CRITICAL, }
 
-# default log level
-DEFAULT_LOG_LEVEL = 'debug'
-
-# should shell command output be printed to stdout?
-DEBUG = True
+# log level until the configuration was read, see setup_logging
+DEFAULT_LOG_LEVEL = 'info'
 
-# used for subprocess calls - print stdout and stderr if log level is debug
-if DEBUG:
-    DEV_ZERO = None
-else:
-    DEV_ZERO = open('/dev/zero', 'w')
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 LOGGER = logging.getLogger('auto_copy')
 LOGGER.setLevel(LOG_LEVELS[DEFAULT_LOG_LEVEL])
@@ -72,18 +85,30 @@ class CouldNotAcquireLockException(Exception):
     pass
 
 
+class IncompleteImageException(Exception):
+    pass
+
+
+class TrayopenNotFoundException(Exception):
+    pass
+
+
 class Lock(object):
     """
     Simple implementation of a lock. Should be cleaned up on almost any exit,
     with the notable exception of SIGKILL (cannot be cought by underlying C library).
     """
 
-    def __init__(self):
+    def __init__(self, lock_name=None):
         """
         Set a few attributes, and call needed methods
+
+        lock_name: name of the lock directory. Defaults to the name of the running
+            script. Use a per device name to allow several drives to work in parallel.
         """
         lock_dir = '/tmp'
-        lock_name = os.path.basename(sys.argv[0])
+        if lock_name is None:
+            lock_name = os.path.basename(sys.argv[0])
         self.lock = os.path.join(lock_dir, lock_name)
         self.my_pid = os.getpid()
         self.pid_lock = os.path.join(self.lock, str(self.my_pid))
@@ -98,7 +123,8 @@ class Lock(object):
             os.mkdir(self.pid_lock)
             LOGGER.debug('Aqcuired lock')
         except OSError:
-            LOGGER.info('Could not aquire lock, raising CouldNotAcquireLockException (PID ' + str(self.my_pid) + ')')
+            LOGGER.info('Could not aquire lock, raising CouldNotAcquireLockException (PID %s)',
+                        self.my_pid)
             raise CouldNotAcquireLockException()
 
     def release_lock(self, signal_num, stack_frame):
@@ -124,81 +150,184 @@ class Lock(object):
         handle lock management, to ensure there is only a singular instance running
         """
         atexit.register(self.release_lock, None, None)
-        for sig in (signal.SIGABRT, signal.SIGINT, signal.SIGTERM):
-            signal.signal(sig, self.release_lock)
+        # signal handlers can only be installed from the main thread; drive
+        # workers in the daemon rely on atexit and explicit releases instead
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGABRT, signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, self.release_lock)
         self.aquire_lock()
 
 
+def device_lock_name(cdrom_device):
+    """
+    Name of the lock guarding a single optical drive
+
+    cdrom_device: path to the device, e.g. /dev/sr0
+    """
+    return 'auto_copy_' + os.path.basename(cdrom_device)
+
+
+def drive_configs(config):
+    """
+    Get one config per optical drive. Each of them is a shallow copy of
+    config, with cdrom_device and cdrom_mnt set for that drive.
+
+    config: a configParser object
+
+    returns a list of configParser objects
+    """
+    drives = config.cdrom_devices or [config.cdrom_device]
+    configs = []
+    for drive in drives:
+        if not isinstance(drive, dict):
+            drive = {'device': drive}
+        if not drive.get('device'):
+            raise config_parser.MissingConfigValue('Every entry in cdrom_devices needs a device')
+        drive_config = copy.copy(config)
+        drive_config.cdrom_device = drive['device']
+        if drive.get('mnt'):
+            drive_config.cdrom_mnt = drive['mnt']
+        elif len(drives) > 1:
+            # every drive needs a mount point of its own
+            drive_config.cdrom_mnt = config.cdrom_mnt + '_' + os.path.basename(drive['device'])
+        configs.append(drive_config)
+    return configs
+
+
+def detect_disc(config):
+    """
+    Look at the inserted disc without mounting it
+
+    config: a configParser object
+
+    returns a disc.Disc object
+    """
+    LOGGER.debug('Detecting disc in %s', config.cdrom_device)
+    with metrics.timed('detect', device=os.path.basename(config.cdrom_device)):
+        my_disc = disc.detect(config.cdrom_device, cdparanoia=config.cdparanoia)
+        if my_disc.media_type is None:
+            LOGGER.debug('Could not read the disc directly, mounting it')
+            my_disc.media_type = determine_media_type(config)
+    LOGGER.info('Found %r', my_disc)
+    return my_disc
+
+
 def determine_media_type(config):
     """
-    Determine the media type of inserted media
+    Determine the media type of inserted media by mounting it.
+    Used if the disc cannot be read directly, see detect_disc.
 
     config: a configParser object
 
     returns one of ['VIDEO_DVD', 'DATA', 'AUDIO']
     """
-    LOGGER.debug('Determining media type. PID ' + MY_PID)
+    LOGGER.debug('Determining media type. PID %s', MY_PID)
     media_type = ''
-    time.sleep(5)
     # check for audio first
-    audio_check = config.cdparanoia + ' -Q'
-    result = subprocess.call(audio_check.split(), stdout=DEV_ZERO, stderr=DEV_ZERO)
-    if result == 0:
-        LOGGER.debug('Media type found was AUDIO PID ' + MY_PID)
+    audio_check = [config.cdparanoia, '-d', config.cdrom_device, '-Q']
+    if supervisor.run(audio_check, timeout=config.tool_timeout, quiet=True).returncode == 0:
+        LOGGER.debug('Media type found was AUDIO PID %s', MY_PID)
         return 'AUDIO'
-    mount(config.cdrom_device, config.cdrom_mnt)
-    time.sleep(5)
+    mount(config.cdrom_device, config.cdrom_mnt, config.tool_timeout)
     if os.path.exists(config.cdrom_mnt + '/VIDEO_TS') or os.path.exists(config.cdrom_mnt + '/video_ts'):
         media_type = 'VIDEO_DVD'
     else:
         media_type = 'DATA'
-    LOGGER.debug(config.cdrom_mnt + ' contains ' + '\n'.join(os.listdir(config.cdrom_mnt)))
-    LOGGER.debug('Media type found was ' + media_type + ' PID ' + MY_PID)
-    umount(config.cdrom_device)
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug('%s contains %s', config.cdrom_mnt, '\n'.join(os.listdir(config.cdrom_mnt)))
+    LOGGER.debug('Media type found was %s PID %s', media_type, MY_PID)
+    umount(config.cdrom_device, config.tool_timeout)
     return media_type
 
 
-def mount(cdrom_device, cdrom_mnt):
+def mount(cdrom_device, cdrom_mnt, timeout=supervisor.TOOL_TIMEOUT):
     """
-    Mount cdrom drive
+    Mount cdrom drive, or a staged image
+
+    timeout: seconds mount may take, see tool_timeout
     """
-    mount_command = 'mount ' + cdrom_device + ' ' + cdrom_mnt
-    LOGGER.debug('Executing: ' + mount_command)
-    result = subprocess.call(mount_command.split(), stdout=DEV_ZERO, stderr=DEV_ZERO)
+    if not os.path.isdir(cdrom_mnt):
+        os.makedirs(cdrom_mnt)
+    mount_command = ['mount', cdrom_device, cdrom_mnt]
+    if os.path.isfile(cdrom_device):
+        mount_command = ['mount', '-o', 'loop,ro', cdrom_device, cdrom_mnt]
+    LOGGER.debug('Executing: %s', ' '.join(mount_command))
+    result = supervisor.run(mount_command, timeout=timeout, quiet=True).returncode
     if result != 0:
         LOGGER.info('Could not mount optical drive - probably empty.')
         raise CouldNotMountException()
 
 
-def umount(cdrom_device):
+def umount(cdrom_device, timeout=supervisor.TOOL_TIMEOUT):
     """
     uMount cdrom drive
+
+    timeout: see mount
     """
-    umount_command = 'umount ' + cdrom_device
-    LOGGER.debug('Executing: ' + umount_command)
-    subprocess.call(umount_command.split(), stdout=DEV_ZERO, stderr=DEV_ZERO)
+    umount_command = ['umount', cdrom_device]
+    LOGGER.debug('Executing: %s', ' '.join(umount_command))
+    supervisor.run(umount_command, timeout=timeout, quiet=True)
 
 
-def rip_large_tracks(config):
+def handbrake_command(config, source, outfile, track_num):
     """
-    Call HandbrakeCLI to rip large tracks
+    Build the HandBrakeCLI argument list to encode a single title
 
     config: a configParser object
+    source: the device or image to read from
+    outfile: path of the resulting mp4
+    track_num: number of the title to encode
 
     """
-    LOGGER.info('Starting to rip large tracks')
-    handbrake_base_cmd = config.handbrakecli + ' -i ' + config.cdrom_device + ' -o ' \
-        + config.data_dir + '/OUTFILE -e x264 -q 20.0 -a 1,2,3,4,5,6 -s 1,2,3,4,5,6 ' \
-        + '-E ffaac -B 160 -6 dpl2 -R Auto -D 0.0 ' \
-        + '--audio-copy-mask aac,ac3,dtshd,dts,mp3 --audio-fallback ffac3 ' \
-        + '-f mp4 --loose-anamorphic --modulus 2 -m --x264-preset ' \
-        + config.rip_speed + ' --h264-profile main --h264-level 4.0 --optimize'
+    return [config.handbrakecli, '-i', source, '-o', outfile, '-t', str(track_num),
+            '-e', 'x264', '-q', '20.0', '-a', '1,2,3,4,5,6', '-s', '1,2,3,4,5,6',
+            '-E', 'ffaac', '-B', '160', '-6', 'dpl2', '-R', 'Auto', '-D', '0.0',
+            '--audio-copy-mask', 'aac,ac3,dtshd,dts,mp3', '--audio-fallback', 'ffac3',
+            '-f', 'mp4', '--loose-anamorphic', '--modulus', '2', '-m',
+            '--x264-preset', config.rip_speed,
+            '--h264-profile', 'main', '--h264-level', '4.0', '--optimize']
+
+
+def encode_jobs(config, source, volume=None, segmented=False, out_dir=None, metadata=None,
+                titles=None):
+    """
+    Determine the encode jobs for a video DVD, one per title
+
+    config: a configParser object
+    source: the device or staged image to read from
+    volume: a disc_fs.Volume of source, if it was read already
+    segmented: encode long titles in parallel chapter segments, see
+        segment_encode.py. Only for images, a drive cannot take parallel reads.
+    out_dir: where to write the videos, defaults to config.data_dir
+    metadata: a metadata_cache.MetadataLookup, opened from config if not given
+    titles: the title_scan.Title objects of source, if it was scanned already
+
+    returns a list of jobs as expected by encode_queue.EncodeQueue
+    """
+    if not titles:
+        titles = title_scan.scan(source, handbrakecli=config.handbrakecli,
+                                 timeout=config.scan_timeout, env=handbrake_env(config))
+    if titles:
+        candidates = titles
+        if config.skip_duplicate_titles:
+            candidates = title_scan.unique_titles(titles)
+        track_nums = [title.index for title in title_scan.feature_titles(
+            candidates, config.min_title_duration, config.max_tracks)]
+        LOGGER.info('Ripping titles %s of %s', track_nums, len(titles))
+    else:
+        LOGGER.warning('Title scan failed, trying titles 1 to %s', config.max_tracks)
+        track_nums = range(1, config.max_tracks + 1)
     LOGGER.debug('Trying to determine dvd title ...')
-    LOGGER.debug('cdrom_device: ' + config.cdrom_device + '; handbrakecli: ' + config.handbrakecli)
+    LOGGER.debug('source: %s; handbrakecli: %s', source, config.handbrakecli)
     dvd_title_with_year = dvd_title.title_with_year(
-            device=config.cdrom_device, handbrakecli=config.handbrakecli)
-    LOGGER.debug('dvd title determined as: "' + str(dvd_title_with_year) + '"')
-    for track_num in xrange(1, config.max_tracks + 1):
+            device=source, handbrakecli=config.handbrakecli, titles=titles, volume=volume,
+            metadata=metadata or open_metadata_lookup(config), timeout=config.scan_timeout,
+            env=handbrake_env(config))
+    LOGGER.debug('dvd title determined as: "%s"', dvd_title_with_year)
+    titles_by_index = dict((title.index, title) for title in titles)
+    segment_workers = config.segment_workers or segment_encode.default_workers()
+    jobs = []
+    for track_num in track_nums:
         if not dvd_title_with_year:
             # set a default that at least hints to when the file was ripped
             outfile_name = 'new_video_' + str(track_num) + '_' \
@@ -206,119 +335,786 @@ def rip_large_tracks(config):
                 + '.mp4'
         else:
             appendix = '.mp4'
-            if track_num > 1:
+            if jobs:
                 appendix = '_' + str(track_num) + '.mp4'
-            # add double quotes around name because the title will contain whitespace
-            outfile_name = '"' + dvd_title_with_year + appendix + '"'
-        handbrake_cmd = handbrake_base_cmd.replace('OUTFILE', outfile_name) \
-            + ' -t ' + str(track_num)
-        LOGGER.debug('Executing: ' + handbrake_cmd)
-        with open('/dev/zero', 'w') as dev_zero:
-            subprocess.call(handbrake_cmd, stdout=dev_zero, stderr=dev_zero, shell=True)
+            outfile_name = dvd_title_with_year + appendix
+        outfile = os.path.join(out_dir or config.data_dir, outfile_name)
+        command = handbrake_command(config, source, outfile, track_num)
+        title = titles_by_index.get(track_num)
+        if segmented and title is not None \
+                and len(segment_encode.plan_segments(title.chapters, segment_workers)) > 1:
+            command = segment_encode.command_line(command, title.chapters, segment_workers,
+                                                  config.ffmpeg, config.ffprobe, title.duration)
+        jobs.append({
+            'source': source,
+            'title': track_num,
+            'outfile': outfile,
+            'command': command,
+            'duration': title.duration if title is not None else None,
+        })
+    return jobs
+
+
+def open_metadata_lookup(config):
+    """
+    Set up the movie metadata lookup as configured
+
+    config: a configParser object
+
+    returns a metadata_cache.MetadataLookup
+    """
+    if config.metadata_backend == 'imdb':
+        backend = metadata_cache.ImdbBackend()
+    elif config.metadata_backend == 'local':
+        backend = metadata_cache.LocalBackend(movie_file=config.metadata_local_file)
+    else:
+        backend = metadata_cache.NoBackend()
+    cache = None
+    if config.metadata_cache_file:
+        cache = metadata_cache.MetadataCache(
+            config.metadata_cache_file,
+            ttl=config.metadata_ttl_days * 86400,
+            negative_ttl=config.metadata_negative_ttl_hours * 3600,
+            max_entries=config.metadata_max_entries)
+    return metadata_cache.MetadataLookup(backend, cache, timeout=config.metadata_timeout)
+
+
+def start_metrics(config):
+    """
+    Export progress and throughput metrics as configured, see metrics.py
+
+    config: a configParser object
+    """
+    metrics.start(port=config.metrics_port, textfile=config.metrics_textfile)
+
+
+def start_coordinator(config, encoder):
+    """
+    Let workers on other machines take encode jobs, if configured.
+    See distributed.py.
+
+    config: a configParser object
+    encoder: the encode_queue.EncodeQueue to hand out jobs from
+    """
+    if not config.distributed_port:
+        return None
+    import distributed
+    coordinator = distributed.Coordinator(encoder, token=config.distributed_token,
+                                          lease=config.distributed_lease)
+    coordinator.serve(config.distributed_port)
+    return coordinator
+
 
+def open_ingest_index(config):
+    """
+    Open the index of ingested discs and files
+
+    config: a configParser object
+
+    returns an ingest_index.IngestIndex, None if disabled
+    """
+    if not config.ingest_index_file:
+        return None
+    return ingest_index.IngestIndex(config.ingest_index_file)
+
+
+def open_encode_queue(config, workers=0, recover=False, mover=None, accept=None):
+    """
+    Open the persistent encode queue
+
+    config: a configParser object
+    workers: see encode_queue.EncodeQueue. 0 uses config.encode_workers
+    recover, accept: see encode_queue.EncodeQueue
+    mover: a mover.Mover finished videos are handed to. optional
 
-def rip_audio_cd(config):
+    returns an encode_queue.EncodeQueue
+    """
+    if workers == 0:
+        workers = config.encode_workers
+    on_done = None
+    if mover is not None:
+        on_done = lambda job: mover.submit(job['outfile'])
+    return encode_queue.EncodeQueue(config.encode_queue_file, workers=workers, recover=recover,
+                                    scheduler=open_scheduler(config), on_done=on_done,
+                                    timeout=config.job_timeout,
+                                    stall_timeout=config.stall_timeout,
+                                    limits=[] if config.handbrake_spool else job_limits(config),
+                                    accept=accept, env=handbrake_env(config))
+
+
+def open_mover(config):
+    """
+    Start moving outputs from output_staging_dir to data_dir, if configured
+
+    config: a configParser object
+
+    returns a mover.Mover, None if outputs are written to data_dir directly
+    """
+    if not config.output_staging_dir:
+        return None
+    return mover.Mover(config.output_staging_dir, config.data_dir, workers=config.mover_workers,
+                       bandwidth=config.mover_bandwidth_mb * MEGA,
+                       min_free=config.staging_min_free_mb * MEGA)
+
+
+def output_dir(config, mover=None):
+    """
+    Where outputs are written: the staging directory of mover if there
+    is one, data_dir otherwise
+    """
+    if mover is not None:
+        return mover.staging_dir
+    return config.data_dir
+
+
+def job_limits(config):
+    """
+    The prefix capping the resources of rips and encodes, see
+    supervisor.limit_prefix
+
+    config: a configParser object
+    """
+    return supervisor.limit_prefix(memory_mb=config.job_memory_mb,
+                                   cpu_seconds=config.job_cpu_seconds, cpus=config.job_cpus,
+                                   cgroup=config.job_cgroup)
+
+
+def spool_limits(config):
+    """
+    Priority and limits of scans and encodes run by the HandBrake worker
+    container. A prefix like job_limits would only reach hb_client, so
+    they are passed along to the worker instead, see hb_client.py. Caps
+    needing a cgroup, job_cpus and job_cgroup, cannot be applied there.
+
+    config: a configParser object
+
+    returns a dict for HANDBRAKE_LIMITS
+    """
+    return {'nice': config.encode_nice, 'idle_io': config.encode_idle_io,
+            'cpus': scheduler.encoder_cpus(config.encode_reserved_cpus),
+            'memory_mb': config.job_memory_mb, 'cpu_seconds': config.job_cpu_seconds}
+
+
+def handbrake_env(config):
+    """
+    Environment HandBrakeCLI is run with. With a HandBrake worker
+    container, hb_client.py is run instead and learns from it where the
+    spool directory is and what limits to pass on.
+
+    config: a configParser object
+
+    returns a dict, None to run it with our own environment
+    """
+    if not config.handbrake_spool:
+        return None
+    return dict(os.environ, HANDBRAKE_SPOOL=config.handbrake_spool,
+                HANDBRAKE_LIMITS=json.dumps(spool_limits(config)))
+
+
+def open_scheduler(config):
+    """
+    Set up the choice of preset and priority of encode jobs
+
+    config: a configParser object
+
+    returns a scheduler.Scheduler
+    """
+    if config.handbrake_spool:
+        # the priority is applied by the HandBrake worker, see spool_limits
+        return scheduler.Scheduler(slowest=config.rip_speed, fastest=config.fastest_rip_speed,
+                                   target_hours=config.backlog_target_hours, nice=0,
+                                   idle_io=False, reserved_cpus=0)
+    return scheduler.Scheduler(slowest=config.rip_speed, fastest=config.fastest_rip_speed,
+                               target_hours=config.backlog_target_hours,
+                               nice=config.encode_nice, idle_io=config.encode_idle_io,
+                               reserved_cpus=config.encode_reserved_cpus)
+
+
+def tool_keys(config):
+    """
+    The configuration keys of the external tools config will call
+    """
+    keys = ['handbrakecli', 'cdparanoia']
+    if config.audio_ripper == 'abcde':
+        keys.append('abcde')
+    else:
+        keys.extend(AUDIO_ENCODERS[audio_format] for audio_format in config.audio_formats)
+    if config.segment_encoding:
+        keys.extend(['ffmpeg', 'ffprobe'])
+    return keys
+
+
+def resolve_tools(config):
+    """
+    Replace the tool paths in config by absolute paths to executables,
+    searching PATH for bare names. Missing tools are reported once here,
+    instead of failing with the first disc needing them.
+
+    config: a configParser object, changed in place
+
+    returns the list of configuration keys of tools not found
+    """
+    missing = []
+    for key in tool_keys(config):
+        path = shutil.which(getattr(config, key))
+        if path is None:
+            LOGGER.warning('%s not found, discs needing it will fail', getattr(config, key))
+            missing.append(key)
+        else:
+            setattr(config, key, os.path.abspath(path))
+    return missing
+
+
+class Runtime(object):
+    """
+    What processing a disc needs besides the disc: encode queue, mover,
+    ingest index, metadata lookup and the tools checked. Setting this up
+    takes longer than looking at a disc, so the daemon and batch.py keep
+    a single Runtime ready, while a manual run sets one up per disc.
+    """
+
+    def __init__(self, config, encoder=None, mover=None):
+        """
+        config: a configParser object, see resolve_tools
+        encoder: an encode_queue.EncodeQueue, see auto_copy. optional
+        mover: a mover.Mover, see auto_copy. optional
+        """
+        start = time.time()
+        self.config = config
+        self.encoder = encoder
+        self.mover = mover
+        self.missing_tools = resolve_tools(config)
+        self.index = open_ingest_index(config)
+        self.metadata = open_metadata_lookup(config)
+        LOGGER.debug('Runtime ready in %.3fs', time.time() - start)
+
+    def warm_up(self):
+        """
+        Do now what the first disc would otherwise wait for, e.g. connect
+        to the metadata backend. For a resident process only.
+        """
+        start = time.time()
+        self.metadata.prepare()
+        LOGGER.info('Ready for discs, warming up took %.3fs', time.time() - start)
+
+
+def rip_large_tracks(config, source=None, encoder=None, volume=None, mover=None,
+                     segmented=False, metadata=None):
+    """
+    Call HandbrakeCLI to rip large tracks
+
+    config: a configParser object
+    source: the device or staged image to read from. Defaults to config.cdrom_device
+    encoder: an encode_queue.EncodeQueue. optional
+    volume: a disc_fs.Volume of source, if it was read already
+    mover: a mover.Mover. optional
+    segmented, metadata: see encode_jobs
+
+    returns True if all titles were encoded
+    """
+    if source is None:
+        source = config.cdrom_device
+    LOGGER.info('Starting to rip large tracks from %s', source)
+    if encoder is None:
+        encoder = open_encode_queue(config, workers=None, mover=mover)
+    # the drive cannot be shared, so encode one title after the other right here
+    ids = encoder.run_now(encode_jobs(config, source, volume, segmented=segmented,
+                                      out_dir=output_dir(config, mover), metadata=metadata))
+    return encoder.count(ids, encode_queue.FAILED) == 0
+
+
+def stage_disc(config, my_disc=None):
+    """
+    Copy the whole disc to an image in config.staging_dir, reading at full
+    drive speed. Damaged areas are retried for rescue_retry_time seconds at
+    most, and left zeroed if they cannot be read. The drive can be ejected
+    as soon as this returns.
+
+    The image is named after the fingerprint of the disc, so imaging that
+    was interrupted, or stopped at job_timeout, resumes when the disc is
+    inserted again. A disc that is still staged is not read again.
+
+    config: a configParser object
+    my_disc: the disc.Disc in the drive. optional, without a fingerprint
+        the image is named after the time instead
+
+    returns the path to the image
+    """
+    if not os.path.isdir(config.staging_dir):
+        os.makedirs(config.staging_dir)
+    if my_disc is not None and my_disc.fingerprint:
+        image_name = 'disc_' + my_disc.fingerprint[:16] + '.iso'
+    else:
+        image_name = 'disc_' + os.path.basename(config.cdrom_device) + '_' \
+            + str(datetime.datetime.now()).replace(' ', '_').replace(':', '-') + '.iso'
+    image = os.path.join(config.staging_dir, image_name)
+    if os.path.exists(image):
+        LOGGER.info('%s is staged already as %s', config.cdrom_device, image)
+        return image
+    LOGGER.info('Staging %s to %s', config.cdrom_device, image)
+    # the map lets imaging resume, by hand with 'rescue.py' or by inserting the disc again
+    map_file = image + '.map'
+    with metrics.timed('image', device=os.path.basename(config.cdrom_device)):
+        rescue_map = rescue.rescue(config.cdrom_device, image + '.part', map_file,
+                                   block_size=config.rescue_block_size * KILO,
+                                   retry_time=config.rescue_retry_time,
+                                   time_limit=config.job_timeout)
+    if rescue_map.find(rescue.NON_TRIED):
+        raise IncompleteImageException('Imaging of ' + config.cdrom_device + ' did not finish,'
+                                       ' insert the disc again to resume it')
+    os.rename(image + '.part', image)
+    os.unlink(map_file)
+    return image
+
+
+def encode_staged_image(config, image, encoder=None, mover=None, metadata=None,
+                        on_finished=None, titles=None):
+    """
+    Queue the encode jobs for a staged image. The image is removed after
+    the last of them finished, unless told to keep it.
+
+    config: a configParser object
+    image: path to an image created by stage_disc
+    encoder: an encode_queue.EncodeQueue. If not given, a queue is opened
+        and this waits until all jobs are done.
+        Jobs still queued or running for image are not queued a second time,
+        on_finished waits for those instead.
+    mover: a mover.Mover. optional
+    metadata, titles: see encode_jobs
+    on_finished: called with True if all jobs succeeded, False otherwise,
+        once the last of them finished. optional
+    """
+    wait = encoder is None
+    if encoder is None:
+        # our workers only take the jobs of this image, others are left to
+        # the daemon, we would not wait for them to finish
+        encoder = open_encode_queue(config, mover=mover,
+                                    accept=lambda job: job['source'] == image)
+    ids = encoder.unfinished(image)
+    if ids:
+        # the image was staged before and its encodes are not done yet
+        LOGGER.info('%s jobs of %s are still waiting or running, not queueing them again',
+                    len(ids), image)
+    else:
+        cleanup = None if config.keep_staged_images else image
+        ids = encoder.submit(encode_jobs(config, image, segmented=config.segment_encoding,
+                                         out_dir=output_dir(config, mover), metadata=metadata,
+                                         titles=titles),
+                             cleanup=cleanup)
+    if wait:
+        encoder.join(ids)
+        if on_finished is not None:
+            on_finished(encoder.count(ids, encode_queue.FAILED) == 0)
+    elif on_finished is not None:
+        encoder.when_finished(ids, on_finished)
+
+
+def copy_staged_image(config, image, label=None, index=None, mover=None):
+    """
+    Copy the large files of a staged data disc, then remove the image
+    unless told to keep it
+
+    config: a configParser object
+    image: path to an image created by stage_disc
+    label, index, mover: see copy_large_files
+
+    returns True if all files were copied
+    """
+    try:
+        return copy_large_files(config, label=label, index=index, source=image, mover=mover)
+    finally:
+        if not config.keep_staged_images:
+            os.unlink(image)
+
+
+def rip_audio_cd(config, mover=None):
     """
     rip an audio cd
 
     config: a configParser object
+    mover: a mover.Mover, for the native ripper. abcde writes where its
+        own configuration says. optional
 
+    returns True if all tracks were ripped
     """
     LOGGER.info('Starting to rip audio CD')
-    rip_command = config.abcde + ' -N -o mp3:"-b ' + config.mp3_bitrate + '"'
-    LOGGER.debug('Ripping audio with command: "' + rip_command + '"')
-    with open('/dev/zero', 'w') as dev_zero:
-        result = subprocess.call(rip_command, stdout=dev_zero, stderr=dev_zero, shell=True)
-        if result != 0:
-            LOGGER.warn('Something went wrong ripping the audio CD.')
+    if config.audio_ripper == 'native':
+        return rip_audio_native(config, mover)
+    rip_command = job_limits(config) + [config.abcde, '-N', '-d', config.cdrom_device,
+                                        '-o', 'mp3:-b ' + config.mp3_bitrate]
+    LOGGER.debug('Ripping audio with command: "%s"', ' '.join(rip_command))
+    device = os.path.basename(config.cdrom_device)
+    progress = metrics.AbcdeProgress(device=device)
+    try:
+        with metrics.timed('rip_audio', device=device):
+            result = supervisor.run(rip_command, timeout=config.job_timeout,
+                                    stall_timeout=config.stall_timeout, on_line=progress,
+                                    name='abcde').returncode
+    finally:
+        progress.finish()
+    if result != 0:
+        LOGGER.warning('Something went wrong ripping the audio CD.')
+    return result == 0
 
 
-def copy_large_files(config):
+def rip_audio_native(config, mover=None):
+    """
+    Rip an audio cd with cdparanoia, encoding while reading, see audio_rip.py.
+    The disc is ejected as soon as the last track was read.
+
+    config: a configParser object
+    mover: a mover.Mover the tracks are handed to. optional
+
+    returns True if all tracks were ripped
+    """
+    out_dir = os.path.join(output_dir(config, mover), 'audio_cd_'
+                           + str(datetime.datetime.now()).replace(' ', '_').replace(':', '-'))
+    device = os.path.basename(config.cdrom_device)
+    with metrics.timed('rip_audio', device=device):
+        tracks = audio_rip.rip_disc(config, config.cdrom_device, out_dir, config.audio_formats,
+                                    workers=config.audio_workers or None,
+                                    on_read_done=lambda: eject(config.cdrom_device, config.tool_timeout))
+    LOGGER.info('Ripped %s of %s tracks to %s',
+                len([track for track in tracks if not track.failed]), len(tracks), out_dir)
+    if mover is not None:
+        for track in tracks:
+            for audio_format in track.outputs:
+                mover.submit(os.path.join(out_dir, track.name + '.' + audio_format))
+    return not [track for track in tracks if track.failed]
+
+
+def copy_large_files(config, label=None, index=None, source=None, mover=None):
     """
     Copy large files from cdrom
 
     config: a configParser object
+    label: volume name of the disc, names the checksum manifest. optional
+    index: an ingest_index.IngestIndex. Files ingested before are hardlinked
+        or skipped instead of copied. optional
+    source: the device or staged image to copy from. Defaults to config.cdrom_device
+    mover: a mover.Mover. Files are copied to its staging directory and
+        handed over one by one. optional
+
+    returns True if all files were copied
+    """
+    if source is None:
+        source = config.cdrom_device
+    out_dir = output_dir(config, mover)
+    LOGGER.info('Starting to copy large files from %s', source)
+    mount(source, config.cdrom_mnt, config.tool_timeout)
+    results = []
+    failed = 0
+    start = time.time()
+    device = os.path.basename(config.cdrom_device)
+    try:
+        # files are copied as soon as they are found
+        for file_path, size_in_bytes in iter_large_files(
+                config.cdrom_mnt, config.min_file_size * MEGA,
+                include=config.copy_include, exclude=config.copy_exclude):
+            partial = full = None
+            if index is not None:
+                existing, partial, full = index.find_copy(file_path, size_in_bytes)
+                if existing is not None:
+                    result = link_existing(config, file_path, existing, size_in_bytes, full)
+                    if result is not None:
+                        index.add_file(result.dest, size_in_bytes, partial, full)
+                        results.append(result)
+                    continue
+            if mover is not None:
+                mover.wait_for_space(size_in_bytes)
+            LOGGER.debug('Copying %s (%sB) to %s', file_path, size_in_bytes, out_dir)
+            result = copier.copy_file(file_path, out_dir)
+            if config.verify_copies and not copier.verify(result):
+                LOGGER.error('Verification of %s failed, removing it', result.dest)
+                copier.discard(result)
+                failed += 1
+                continue
+            if mover is not None:
+                # from here on the copy is known by the name it gets in data_dir
+                result.dest = mover.submit(result.dest)
+            if index is not None:
+                index.add_file(result.dest, size_in_bytes, partial, result.checksum or full)
+            metrics.REGISTRY.inc('copy_bytes_total', result.size - result.resumed_at, device=device)
+            metrics.REGISTRY.set('copy_bytes_per_second', int(result.mb_per_s * MEGA), device=device)
+            results.append(result)
+    finally:
+        umount(config.cdrom_mnt, config.tool_timeout)
+        metrics.REGISTRY.observe('stage_seconds', time.time() - start, stage='copy', device=device)
+        if results:
+            manifest = manifest_path(config, label, out_dir)
+            # the paths in the manifest are relative to where it ends up
+            copier.write_manifest(results, manifest, config.data_dir)
+            if mover is not None:
+                mover.submit(manifest)
+    total_size = sum([result.size - result.resumed_at for result in results])
+    LOGGER.info('Copied %s files, %sMB at %sMB/s', len(results), total_size // MEGA,
+                copier.mb_per_s(total_size, time.time() - start))
+    return failed == 0
+
+
+def link_existing(config, file_path, existing, size_in_bytes, checksum):
+    """
+    Make a file that was ingested before show up in data_dir again, as a
+    hardlink to the existing copy
+
+    config: a configParser object
+    file_path: the file on the disc
+    existing: path of the earlier copy
+    size_in_bytes: size of the file
+    checksum: sha256 of the file
 
+    returns a copier.CopyResult for the link, None if nothing was linked
     """
-    LOGGER.info('Starting to copy large files')
-    mount(config.cdrom_device, config.cdrom_mnt)
-    file_list = get_recursive_file_list(config.cdrom_mnt)
-    LOGGER.debug('File list: ' + '\n'.join(file_list))
-    for file_path in file_list:
-        size_in_bytes = os.path.getsize(file_path)
-        LOGGER.debug('Considering for copy: ' + str(size_in_bytes) + 'B ' + file_path)
-        if size_in_bytes / MEGA > config.min_file_size:
-            LOGGER.debug('Copying ' + file_path + ' to ' + config.data_dir)
-            shutil.copy(file_path, config.data_dir)
-    umount(config.cdrom_device)
+    dest = os.path.join(config.data_dir, os.path.basename(file_path))
+    if os.path.exists(dest):
+        LOGGER.info('Skipping %s, already ingested as %s', file_path, existing)
+        return None
+    try:
+        os.link(existing, dest)
+    except OSError as error:
+        LOGGER.info('Skipping %s, already ingested as %s (could not link: %s)', file_path,
+                    existing, error)
+        return None
+    LOGGER.info('Linked %s to identical %s', dest, existing)
+    # nothing was read from the disc, so it does not count for throughput
+    return copier.CopyResult(file_path, dest, size_in_bytes, checksum, 0, size_in_bytes)
 
 
-def get_recursive_file_list(root_dir):
+def manifest_path(config, label=None, out_dir=None):
+    """
+    Path of the checksum manifest for the files copied from a disc
+
+    config: a configParser object
+    label: volume name of the disc. optional
+    out_dir: directory of the copies, defaults to config.data_dir
     """
-    Get a recursive listing of files in
+    name = (label or 'disc').replace('/', '_') + '_' \
+        + str(datetime.datetime.now()).replace(' ', '_').replace(':', '-')
+    return os.path.join(out_dir or config.data_dir, name + copier.MANIFEST_SUFFIX)
+
+
+def iter_large_files(root_dir, min_size, include=None, exclude=None):
+    """
+    Walk root_dir and yield the files worth copying, as they are found.
+    Uses the stat information os.scandir already has, so every file is
+    looked at only once.
+
     root_dir: string, the root dir to start the file listing
+    min_size: only files larger than this many bytes are yielded
+    include: list of shell patterns, if given a file must match one of them
+    exclude: list of shell patterns, matching files and directories are skipped
 
+    Patterns are matched against the path relative to root_dir and the name.
+    yields tuples of (path, size in bytes)
+    """
+    LOGGER.debug('Walking %s', root_dir)
+    dirs = [root_dir]
+    while dirs:
+        current = dirs.pop()
+        sub_dirs = []
+        try:
+            entries = os.scandir(current)
+        except OSError as error:
+            LOGGER.warning('Could not list %s: %s', current, error)
+            continue
+        with entries:
+            for entry in entries:
+                rel_path = os.path.relpath(entry.path, root_dir)
+                if exclude and matches(rel_path, exclude):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    size = entry.stat(follow_symlinks=False).st_size
+                    if size <= min_size:
+                        continue
+                    if include and not matches(rel_path, include):
+                        continue
+                    yield entry.path, size
+        # keep the order of the listing
+        dirs.extend(reversed(sub_dirs))
+
+
+def matches(rel_path, patterns):
     """
-    LOGGER.debug("Getting recursive file list for " + root_dir)
-    file_list = []
-    for root, sub_folders, files in os.walk(root_dir):
-        for my_file in files:
-            file_list.append(os.path.join(root, my_file))
-    return file_list
+    Check rel_path and its file name against a list of shell patterns
+    """
+    name = os.path.basename(rel_path)
+    for pattern in patterns:
+        if fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(name, pattern):
+            return True
+    return False
 
 
 def setup_logging(config):
     """
-    Do some setup for logging
+    Log at log_level to the console and to log_file, which is rotated at
+    log_max_mb. Records are written by a background thread, they reach it
+    through a queue. So a slow disk or terminal never holds up copying or
+    encoding.
 
     config: a configParser object
 
+    returns the logging.handlers.QueueListener, it is stopped at exit
     """
-    # create file handler
-    fh = logging.FileHandler(config.log_file)
-    fh.setLevel(LOG_LEVELS[DEFAULT_LOG_LEVEL])
-    # create console handler
-    ch = logging.StreamHandler()
-    ch.setLevel(LOG_LEVELS[DEFAULT_LOG_LEVEL])
-    # create formatter and add it to the handlers
-    ch_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    fh_formatter = ch_formatter
-    ch.setFormatter(ch_formatter)
-    fh.setFormatter(fh_formatter)
-    # add the handlers to LOGGER
-    LOGGER.addHandler(ch)
-    LOGGER.addHandler(fh)
-
-
-def read_config(config_file):
+    # imported here, they take longer to import than the rest of logging
+    import logging.handlers
+    import queue
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if config.log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            config.log_file, maxBytes=config.log_max_mb * MEGA,
+            backupCount=config.log_backup_count))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    # write out what is still queued when exiting
+    atexit.register(listener.stop)
+    LOGGER.addHandler(logging.handlers.QueueHandler(log_queue))
+    LOGGER.setLevel(LOG_LEVELS[config.log_level])
+    return listener
+
+
+def read_config(config_file, drive_required=True):
     """
     Read the configuration from
 
     config_file: path to a yaml file containing the configuration
+    drive_required: False for tools working without a drive, see batch.py
 
     """
-    return config_parser.configParser(config_file,
+    config = config_parser.configParser(config_file,
         defaults={
             'rip_speed': 'slow',
+            'cdrom_device': None,
+            'cdrom_devices': [],
             'cdrom_mnt': '/mnt/cdrom',
             'min_file_size': 10,
+            'verify_copies': False,
+            'copy_include': [],
+            'copy_exclude': [],
             'max_tracks': 10,
+            'min_title_duration': 120,
+            'skip_duplicate_titles': True,
             'no_exec_file': '/var/tmp/no_auto_copy',
-            'config.log_file': '/tmp/auto_copy.log',
+            'log_file': '/tmp/auto_copy.log',
+            'log_level': DEFAULT_LOG_LEVEL,
+            'log_max_mb': 10,
+            'log_backup_count': 5,
             'trayopen': '/usr/local/bin/trayopen',
+            'drive_ready_timeout': 30,
             'handbrakecli': '/bin/HandBrakeCLI',
+            'handbrake_spool': '',
+            'hb_client': '/usr/local/bin/hb_client.py',
             'cdparanoia': '/bin/cdparanoia',
             'abcde': '/bin/abcde',
             'mp3_bitrate': '320',
+            'audio_ripper': 'abcde',
+            'audio_formats': ['mp3'],
+            'audio_workers': 0,
+            'opus_bitrate': '160',
+            'lame': '/usr/bin/lame',
+            'flac': '/usr/bin/flac',
+            'opusenc': '/usr/bin/opusenc',
+            'event_dir': '/tmp/auto_copy_events',
+            'video_mode': 'direct',
+            'staging_dir': '/var/tmp/auto_copy',
+            'keep_staged_images': False,
+            'data_mode': 'direct',
+            'rescue_block_size': 1024,
+            'rescue_retry_time': 300,
+            'encode_queue_file': '/var/lib/auto_copy/encode_queue.sqlite',
+            'encode_workers': 0,
+            'backlog_target_hours': 0,
+            'fastest_rip_speed': 'veryfast',
+            'encode_nice': 10,
+            'encode_idle_io': True,
+            'encode_reserved_cpus': 1,
+            'output_staging_dir': '',
+            'mover_workers': 2,
+            'mover_bandwidth_mb': 0,
+            'staging_min_free_mb': 2048,
+            'distributed_port': 0,
+            'distributed_token': '',
+            'distributed_lease': 60,
+            'segment_encoding': False,
+            'segment_workers': 0,
+            'ffmpeg': '/usr/bin/ffmpeg',
+            'ffprobe': '/usr/bin/ffprobe',
+            'metadata_backend': 'imdb',
+            'metadata_local_file': '/etc/auto_copy_movies.yml',
+            'metadata_cache_file': '/var/lib/auto_copy/metadata.sqlite',
+            'metadata_ttl_days': 90,
+            'metadata_negative_ttl_hours': 24,
+            'metadata_max_entries': 10000,
+            'metadata_timeout': 5,
+            'metrics_port': 0,
+            'metrics_textfile': '',
+            'ingest_index_file': '/var/lib/auto_copy/ingest_index.sqlite',
+            'skip_known_discs': True,
+            'batch_jobs': 2,
+            'batch_state_file': '/var/lib/auto_copy/batch_state.json',
+            'tool_timeout': supervisor.TOOL_TIMEOUT,
+            'scan_timeout': supervisor.SCAN_TIMEOUT,
+            'job_timeout': 0,
+            'stall_timeout': supervisor.STALL_TIMEOUT,
+            'job_memory_mb': 0,
+            'job_cpu_seconds': 0,
+            'job_cpus': 0,
+            'job_cgroup': False,
         },
         allowed_values={
             'rip_speed': ['veryfast', 'fast', 'slow', 'veryslow', 'placebo'],
         },
         required_keys=[
-            'cdrom_device',
             'data_dir',
         ],
     )
+    if config.log_level not in LOG_LEVELS:
+        raise config_parser.IllegalConfigValue('Illegal configuration value for "log_level": '
+                                               + str(config.log_level))
+    if config.metadata_backend not in ('imdb', 'local', 'none'):
+        raise config_parser.IllegalConfigValue('Illegal configuration value for '
+                                               '"metadata_backend": ' + str(config.metadata_backend))
+    if config.audio_ripper not in ('abcde', 'native'):
+        raise config_parser.IllegalConfigValue('Illegal configuration value for "audio_ripper": '
+                                               + str(config.audio_ripper))
+    for audio_format in config.audio_formats:
+        if audio_format not in audio_rip.FORMATS:
+            raise config_parser.IllegalConfigValue('Illegal configuration value for '
+                                                   '"audio_formats": ' + str(audio_format))
+    for mode_key in ('video_mode', 'data_mode'):
+        if getattr(config, mode_key) not in ('direct', 'staged'):
+            raise config_parser.IllegalConfigValue('Illegal configuration value for "' + mode_key
+                                                   + '": ' + str(getattr(config, mode_key)))
+    if config.fastest_rip_speed not in scheduler.PRESETS or scheduler.PRESETS.index(
+            config.fastest_rip_speed) > scheduler.PRESETS.index(config.rip_speed):
+        raise config_parser.IllegalConfigValue('Illegal configuration value for '
+                                               '"fastest_rip_speed": '
+                                               + str(config.fastest_rip_speed)
+                                               + ', must be a preset not slower than rip_speed')
+    if config.rescue_block_size * KILO % rescue.SECTOR_SIZE:
+        raise config_parser.IllegalConfigValue('Illegal configuration value for "rescue_block_size": '
+                                               + str(config.rescue_block_size)
+                                               + ', must be a multiple of 2')
+    if config.distributed_port and not config.distributed_token:
+        # anyone reaching the port could otherwise take jobs, and with them
+        # read the staged images
+        raise config_parser.IllegalConfigValue('Illegal configuration value for '
+                                               '"distributed_token": must be set if '
+                                               'distributed_port is')
+    if config.handbrake_spool:
+        # scans and encodes are run by the HandBrake worker container, see
+        # docker/README.md. The client passes the output on as it comes.
+        # see handbrake_env
+        config.handbrakecli = config.hb_client
+    if drive_required and not config.cdrom_device and not config.cdrom_devices:
+        raise config_parser.MissingConfigValue('The following key is missing in ' +
+                                               config_file + ': cdrom_device or cdrom_devices')
+    return config
 
 
 def sanity_checks_pass(config, my_lock):
@@ -331,21 +1127,48 @@ def sanity_checks_pass(config, my_lock):
     """
     # do not exit if no_exec_file exists
     if os.path.exists(config.no_exec_file):
-        LOGGER.info('Exiting, found no exec file ' + config.no_exec_file)
+        LOGGER.info('Exiting, found no exec file %s', config.no_exec_file)
         LOGGER.debug('Explicitly releasing lock since no exec file found')
         my_lock.release_lock(None, None)
         return False
+    # wait for the drive to settle, as long as needed but no longer
+    try:
+        status = drive.wait_until_ready(config.cdrom_device, config.drive_ready_timeout)
+    except OSError as error:
+        LOGGER.debug('Could not query drive status (%s), using trayopen', error)
+        return tray_closed(config, my_lock)
+    if status != drive.CDS_DISC_OK:
+        LOGGER.debug('Exiting as drive reports %s', drive.STATUS_NAMES.get(status, str(status)))
+        LOGGER.debug('Explicitly releasing lock as there is no disc to work on')
+        my_lock.release_lock(None, None)
+        return False
+    return True
+
+
+def tray_closed(config, my_lock):
+    """
+    Check the tray with the trayopen binary, for drives not answering
+    the status ioctl
+
+    config: a configParser object
+    my_lock: a Lock object
+
+    raises TrayopenNotFoundException if trayopen is missing, the lock is
+    released then
+    """
     LOGGER.debug('Sleeping 10 secs to allow drive to settle')
     time.sleep(10)
     LOGGER.debug('Slept 10 secs')
     # check if we have custom binary trayopen
     if not os.path.exists(config.trayopen):
-        LOGGER.debug('ERROR: Could not find ' + config.trayopen)
+        LOGGER.error('Could not find %s to check the tray of %s', config.trayopen,
+                     config.cdrom_device)
         LOGGER.debug('Explicitly releasing lock as trayopen was not found')
         my_lock.release_lock(None, None)
-        sys.exit(1)
+        raise TrayopenNotFoundException(config.trayopen)
     # check if the tray is open or closed
-    tray_open = subprocess.call([config.trayopen, config.cdrom_device])
+    tray_open = supervisor.run([config.trayopen, config.cdrom_device],
+                               timeout=config.tool_timeout, quiet=True).returncode
     if tray_open == 0:
         LOGGER.debug('Exiting as tray is currently open')
         LOGGER.debug('Explicitly releasing lock as tray is currently open')
@@ -354,16 +1177,94 @@ def sanity_checks_pass(config, my_lock):
     return True
 
 
-def auto_copy(config):
+def is_known(index, my_disc):
+    """
+    Tell if my_disc was ingested before
+
+    index: an ingest_index.IngestIndex or None
+    my_disc: a disc.Disc
+    """
+    if index is None or not my_disc.fingerprint:
+        return False
+    return index.has_disc(my_disc.fingerprint)
+
+
+def process_disc(config, my_disc, runtime, in_drive=True):
+    """
+    Run the pipeline for the media type of a disc, in a drive or an image.
+    Discs in a drive are staged first if configured. Images are read in
+    place and left alone, there is nothing to eject.
+
+    config: a configParser object
+    my_disc: a disc.Disc, see detect_disc
+    runtime: a Runtime. Discs in its ingest index are skipped, new ones
+        recorded once everything on them was ingested. For a staged video
+        DVD that is when its last encode job finished.
+    in_drive: False if my_disc was detected in an image, see batch.py
+
+    returns True if the disc was processed, False if it was skipped
+    """
+    media_type = my_disc.media_type
+    source = my_disc.device
+    index = runtime.index
+    encoder = runtime.encoder
+    mover = runtime.mover
+    if config.skip_known_discs and is_known(index, my_disc):
+        LOGGER.info('Disc %s was ingested before, skipping it', my_disc.label)
+        return False
+
+    def record(succeeded):
+        # a disc that failed in part must be read again when inserted again
+        if not succeeded:
+            LOGGER.warning('Disc %s was not ingested completely', my_disc.label)
+        elif index is not None and my_disc.fingerprint:
+            index.add_disc(my_disc.fingerprint, my_disc.label, media_type)
+
+    if media_type == 'VIDEO_DVD' and in_drive and config.video_mode == 'staged':
+        # scanning opens the disc through libdvdcss, which authenticates the
+        # drive. Without that, it refuses to read the CSS protected sectors.
+        titles = title_scan.scan(config.cdrom_device, handbrakecli=config.handbrakecli,
+                                 timeout=config.scan_timeout, env=handbrake_env(config))
+        image = stage_disc(config, my_disc)
+        LOGGER.info('Disc staged, ejecting %s', config.cdrom_device)
+        eject(config.cdrom_device, config.tool_timeout)
+        encode_staged_image(config, image, encoder, mover, runtime.metadata, on_finished=record,
+                            titles=titles)
+    elif media_type == 'VIDEO_DVD':
+        record(rip_large_tracks(config, source=source, encoder=encoder, volume=my_disc.volume,
+                                mover=mover, segmented=config.segment_encoding and not in_drive,
+                                metadata=runtime.metadata))
+    elif media_type == 'DATA' and in_drive and config.data_mode == 'staged':
+        image = stage_disc(config, my_disc)
+        LOGGER.info('Disc staged, ejecting %s', config.cdrom_device)
+        eject(config.cdrom_device, config.tool_timeout)
+        record(copy_staged_image(config, image, label=my_disc.label, index=index, mover=mover))
+    elif media_type == 'DATA':
+        record(copy_large_files(config, label=my_disc.label, index=index, source=source,
+                                mover=mover))
+    elif media_type == 'AUDIO' and in_drive:
+        record(rip_audio_cd(config, mover))
+    else:
+        LOGGER.warning('Could not determine media type of %s', source)
+        return False
+    return True
+
+
+def auto_copy(config, runtime=None):
     """
     do the auto copy of stuff from optical disc
 
     config: a configParser object
+    runtime: a Runtime, as kept by the daemon. Its encoder gets the encoding
+        in staged video mode after ejecting, without one encoding is done
+        here. Its mover moves outputs to data_dir in the background.
+        Without a runtime, one is set up with a mover if output_staging_dir
+        is set, and this waits until everything was moved.
 
     """
-    # only one instance running at a time
+    # only one instance per drive running at a time
     try:
-        my_lock = Lock()
+        my_lock = Lock(device_lock_name(config.cdrom_device))
     except CouldNotAcquireLockException:
         return
     if not sanity_checks_pass(config, my_lock):
@@ -371,30 +1272,47 @@ def auto_copy(config):
     ###
     # Action
     ###
+    own_mover = None
     try:
-        media_type = determine_media_type(config)
-        if media_type == 'VIDEO_DVD':
-            rip_large_tracks(config)
-        elif media_type == 'DATA':
-            copy_large_files(config)
-        elif media_type == 'AUDIO':
-            rip_audio_cd(config)
-        else:
-            LOGGER.warn('Could not determine media type')
+        if runtime is None:
+            own_mover = open_mover(config)
+            runtime = Runtime(config, mover=own_mover)
+        if runtime.mover is not None:
+            # do not start reading while the staging disk is full
+            runtime.mover.wait_for_space()
+        my_disc = detect_disc(config)
+        process_disc(config, my_disc, runtime)
         # eject when done
-        LOGGER.info('All tasks finished, ejecting')
-        subprocess.call(['eject'], stdout=DEV_ZERO, stderr=DEV_ZERO)
+        LOGGER.info('All tasks finished, ejecting %s', config.cdrom_device)
+        eject(config.cdrom_device, config.tool_timeout)
     except Exception:
-        LOGGER.warn('Something went wrong, ejecting anyway')
-        subprocess.call(['eject'], stdout=DEV_ZERO, stderr=DEV_ZERO)
+        LOGGER.warning('Something went wrong, ejecting %s anyway', config.cdrom_device)
+        eject(config.cdrom_device, config.tool_timeout)
     finally:
         LOGGER.debug('Explicitly releasing lock in finally block')
         my_lock.release_lock(None, None)
-        subprocess.call(['eject'], stdout=DEV_ZERO, stderr=DEV_ZERO)
+        eject(config.cdrom_device, config.tool_timeout)
+        if own_mover is not None:
+            LOGGER.info('Waiting for outputs to be moved to %s', config.data_dir)
+            own_mover.join()
+
+
+def eject(cdrom_device, timeout=supervisor.TOOL_TIMEOUT):
+    """
+    Eject the disc in cdrom_device
+
+    timeout: see mount
+    """
+    supervisor.run(['eject', cdrom_device], timeout=timeout, quiet=True)
 
 
 if __name__ == '__main__':
     main_config = read_config('/etc/auto_copy.yml')
     setup_logging(main_config)
-    auto_copy(main_config)
+    # optionally pass the device to work on, e.g. auto_copy.py /dev/sr1
+    for main_drive_config in drive_configs(main_config):
+        if len(sys.argv) < 2 or main_drive_config.cdrom_device == sys.argv[1]:
+            auto_copy(main_drive_config)
+    if main_config.metrics_textfile:
+        metrics.write_textfile(main_config.metrics_textfile)
 
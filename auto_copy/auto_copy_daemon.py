@@ -3,17 +3,136 @@
 
 """
 The daemon that calls auto_copy.py uppon optical disc insertion
+
+Every configured drive gets a worker of its own, so several discs can be
+processed at the same time. The daemon is woken up right away by media
+change events from the kernel. SIGUSR1 from the udev rule works as well:
+udev tells us which drive changed by dropping a file named after the
+device into event_dir before sending the signal.
 """
 
+import asyncio
+import concurrent.futures
+import os
 import signal
 import sys
-import time
 
 sys.path.append('/usr/local/bin')
 
 import auto_copy
+import drive
+
+
+async def drive_worker(config, events, runtime, executor):
+    """
+    Process discs of a single drive, one after the other.
+    Events arriving while the drive is busy are queued, not dropped.
+
+    config: configParser object for this drive, see auto_copy.drive_configs
+    events: asyncio.Queue receiving the events for this drive
+    runtime: the auto_copy.Runtime shared by all drives
+    executor: the executor running the blocking auto_copy work
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await events.get()
+        auto_copy.LOGGER.debug('Handling event for %s, %s more queued', config.cdrom_device,
+                               events.qsize())
+        try:
+            await loop.run_in_executor(executor, auto_copy.auto_copy, config, runtime)
+        except Exception:
+            auto_copy.LOGGER.exception('Unhandled error on %s', config.cdrom_device)
+
+
+def pending_devices(event_dir):
+    """
+    Collect and remove the device events udev left in event_dir
+
+    event_dir: directory containing one file per changed device, e.g. 'sr1'
+
+    returns a list of device names
+    """
+    if not os.path.isdir(event_dir):
+        return []
+    devices = []
+    for event in os.listdir(event_dir):
+        try:
+            os.unlink(os.path.join(event_dir, event))
+        except OSError:
+            continue
+        devices.append(event)
+    return devices
+
+
+def notify(queues, devices):
+    """
+    Queue an event for each of devices. A drive that has an event waiting
+    already does not need a second one, it will look at the disc anyway.
+
+    queues: dict mapping device names (e.g. 'sr0') to asyncio.Queue objects
+    devices: list of device names
+    """
+    for device in devices:
+        events = queues.get(os.path.basename(device))
+        if events is None:
+            auto_copy.LOGGER.warning('Ignoring event for unconfigured device %s', device)
+            continue
+        if events.empty():
+            events.put_nowait(device)
+
+
+def on_signal(queues, event_dir):
+    """
+    Handle SIGUSR1. Without any device information (e.g. an old udev rule)
+    all drives are notified.
+    """
+    devices = pending_devices(event_dir)
+    notify(queues, devices or list(queues))
+
+
+def on_uevent(sock, queues):
+    """
+    Handle kernel uevents arriving on sock
+    """
+    while True:
+        try:
+            data = sock.recv(16384)
+        except BlockingIOError:
+            return
+        event = drive.parse_uevent(data)
+        if drive.is_media_change(event):
+            notify(queues, [event['DEVNAME']])
+
+
+async def serve(config):
+    """
+    Set up the workers and event sources, then run forever
+
+    config: configParser object
+    """
+    loop = asyncio.get_running_loop()
+    auto_copy.start_metrics(config)
+    # both pick up work left over from before a restart right away
+    mover = auto_copy.open_mover(config)
+    encoder = auto_copy.open_encode_queue(config, recover=True, mover=mover)
+    auto_copy.start_coordinator(config, encoder)
+    # set up once, so a disc event goes straight to work. The drives get
+    # copies of config with the tool paths resolved.
+    runtime = auto_copy.Runtime(config, encoder, mover)
+    runtime.warm_up()
+    drive_configs = auto_copy.drive_configs(config)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(drive_configs))
+    queues = {}
+    for drive_config in drive_configs:
+        events = asyncio.Queue()
+        queues[os.path.basename(drive_config.cdrom_device)] = events
+        loop.create_task(drive_worker(drive_config, events, runtime, executor))
+    loop.add_signal_handler(signal.SIGUSR1, on_signal, queues, config.event_dir)
+    sock = drive.uevent_socket()
+    if sock is not None:
+        loop.add_reader(sock.fileno(), on_uevent, sock, queues)
+    await loop.create_future()
 
-SIGNAL_RECEIVED = False
 
 def run_daemon(config):
     """
@@ -21,17 +140,7 @@ def run_daemon(config):
 
     config: configParser object
     """
-    signal.signal(signal.SIGUSR1, signal_handler)
-    while True:
-        time.sleep(1)
-        global SIGNAL_RECEIVED
-        if SIGNAL_RECEIVED:
-            auto_copy.auto_copy(config)
-            SIGNAL_RECEIVED = False
-
-def signal_handler(dump1, dump2):
-    global SIGNAL_RECEIVED
-    SIGNAL_RECEIVED = True
+    asyncio.run(serve(config))
 
 if __name__ == "__main__":
     main_config = auto_copy.read_config('/etc/auto_copy.yml')
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+batch.py
+Ingest a backlog of disc images, without a drive.
+
+Every image is looked at like a disc in a drive (see disc.py) and runs
+through the same pipeline: large files of data discs are copied, the
+titles of video DVDs are encoded. Several images are processed at once.
+Images are read in place and never removed.
+
+What was done is kept in a state file, so an interrupted batch continues
+with the images it did not finish. Images that failed are tried again on
+the next run. BIN images need 2048 byte sectors, raw images of 2352 byte
+sectors cannot be read and are skipped.
+
+    batch.py --jobs 4 /archive/isos '/archive/more/*.iso'
+"""
+
+import argparse
+import copy
+import glob
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+sys.path.append('/usr/local/bin')
+
+import auto_copy
+import copier
+import disc
+import metrics
+
+LOGGER = logging.getLogger('auto_copy')
+
+IMAGE_EXTENSIONS = ('.iso', '.bin', '.img')
+
+# results of an image
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+def find_images(paths):
+    """
+    Collect the images to process
+
+    paths: list of image files, directories (searched recursively for
+        IMAGE_EXTENSIONS) and shell patterns
+
+    returns a sorted list of absolute paths, without duplicates
+    """
+    images = set()
+    for path in paths:
+        for match in glob.glob(path) or [path]:
+            if os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    for name in files:
+                        if name.lower().endswith(IMAGE_EXTENSIONS):
+                            images.add(os.path.abspath(os.path.join(root, name)))
+            elif os.path.isfile(match):
+                images.add(os.path.abspath(match))
+            else:
+                LOGGER.warning('No images found at %s', match)
+    return sorted(images)
+
+
+class BatchState(object):
+    """
+    Results of the images processed so far, kept in a JSON file
+    """
+
+    def __init__(self, state_file):
+        """
+        state_file: path to the JSON file, created if missing
+        """
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.results = {}
+        if os.path.exists(state_file):
+            with open(state_file, 'r') as state_fh:
+                self.results = json.load(state_fh)
+
+    def finished(self, image):
+        """
+        Tell if image needs no more work, failed images need more
+        """
+        return self.results.get(image, {}).get('result') in (DONE, SKIPPED)
+
+    def record(self, image, result):
+        """
+        Store the result dict of an image, see process_image
+        """
+        with self.lock:
+            self.results[image] = result
+            state_dir = os.path.dirname(self.state_file)
+            if state_dir and not os.path.isdir(state_dir):
+                os.makedirs(state_dir)
+            with open(self.state_file + '.tmp', 'w') as state_fh:
+                json.dump(self.results, state_fh, indent=1, sort_keys=True)
+            os.rename(self.state_file + '.tmp', self.state_file)
+
+
+def process_image(config, image, runtime):
+    """
+    Detect and process a single image, see auto_copy.process_disc
+
+    config: a configParser object
+    image: path to the image
+    runtime: an auto_copy.Runtime
+
+    returns a dict with the result (DONE, FAILED or SKIPPED), media_type,
+    size in bytes, seconds taken and a note on what went wrong
+    """
+    start = time.time()
+    result = {'result': DONE, 'media_type': None, 'size': os.path.getsize(image),
+              'seconds': 0, 'note': ''}
+    try:
+        my_disc = disc.detect(image, cdparanoia=config.cdparanoia)
+        result['media_type'] = my_disc.media_type
+        if my_disc.media_type not in (disc.DATA, disc.VIDEO_DVD):
+            result['result'] = SKIPPED
+            result['note'] = 'no readable file system'
+        else:
+            if runtime.mover is not None:
+                runtime.mover.wait_for_space()
+            try:
+                if not auto_copy.process_disc(config, my_disc, runtime, in_drive=False):
+                    result['result'] = SKIPPED
+                    result['note'] = 'ingested before'
+            finally:
+                my_disc.close()
+            failed = 0
+            if runtime.encoder is not None:
+                failed = runtime.encoder.failures(image, start)
+            if failed:
+                result['result'] = FAILED
+                result['note'] = str(failed) + ' encodes failed'
+    except Exception as error:
+        LOGGER.exception('Processing %s failed', image)
+        result['result'] = FAILED
+        result['note'] = str(error)
+    result['seconds'] = round(time.time() - start, 1)
+    metrics.REGISTRY.inc('batch_images_total', result=result['result'])
+    metrics.REGISTRY.inc('batch_bytes_total', result['size'])
+    LOGGER.info('%s: %s %s, %sMB in %ss (%sMB/s)%s', image, result['result'], result['media_type'],
+                result['size'] // auto_copy.MEGA, result['seconds'],
+                copier.mb_per_s(result['size'], result['seconds']),
+                ', ' + result['note'] if result['note'] else '')
+    return result
+
+
+def run_batch(config, images, state, runtime, jobs=1):
+    """
+    Process images, jobs at a time. Images the state has as finished
+    are left out.
+
+    config: a configParser object
+    images: list of image paths, see find_images
+    state: a BatchState the results are recorded in
+    runtime: an auto_copy.Runtime shared by all images
+    jobs: images processed at once
+
+    returns a dict of image to result for the images processed
+    """
+    todo = queue.Queue()
+    for image in images:
+        if not state.finished(image):
+            todo.put(image)
+    LOGGER.info('Processing %s of %s images, %s at a time', todo.qsize(), len(images), jobs)
+    results = {}
+
+    def work(num):
+        worker_config = copy.copy(config)
+        # there is no drive. The name shows up in metrics, and every worker
+        # needs a mount point of its own.
+        worker_config.cdrom_device = 'batch' + str(num)
+        worker_config.cdrom_mnt = config.cdrom_mnt + '_batch' + str(num)
+        while True:
+            try:
+                image = todo.get_nowait()
+            except queue.Empty:
+                return
+            result = process_image(worker_config, image, runtime)
+            state.record(image, result)
+            results[image] = result
+
+    threads = [threading.Thread(target=work, args=(num,), name='batch-' + str(num))
+               for num in range(jobs)]
+    for thread in threads:
+        # an interrupted batch does not wait for running images, they are
+        # simply processed again on the next run
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    return results
+
+
+def report(results, seconds):
+    """
+    A table of the results of a batch and its total throughput
+
+    results: see run_batch
+    seconds: time the batch took
+
+    returns the report as a string
+    """
+    lines = []
+    for image, result in sorted(results.items()):
+        lines.append('%-8s %-10s %8dMB %8.1fs %8.1fMB/s  %s %s' % (
+            result['result'], result['media_type'], result['size'] // auto_copy.MEGA,
+            result['seconds'], copier.mb_per_s(result['size'], result['seconds']),
+            image, result['note']))
+    counts = dict((name, len([result for result in results.values()
+                              if result['result'] == name]))
+                  for name in (DONE, FAILED, SKIPPED))
+    total_size = sum(result['size'] for result in results.values() if result['result'] == DONE)
+    lines.append(str(len(results)) + ' images in ' + str(int(seconds)) + 's: '
+                 + ', '.join(str(counts[name]) + ' ' + name for name in (DONE, FAILED, SKIPPED))
+                 + '. ' + str(total_size // auto_copy.MEGA) + 'MB at '
+                 + str(copier.mb_per_s(total_size, seconds)) + 'MB/s')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingest a directory of disc images')
+    parser.add_argument('paths', nargs='+', help='image files, directories or shell patterns')
+    parser.add_argument('--config', default='/etc/auto_copy.yml')
+    parser.add_argument('--jobs', type=int, help='images processed at once, default batch_jobs')
+    parser.add_argument('--state', help='state file, default batch_state_file')
+    args = parser.parse_args()
+    config = auto_copy.read_config(args.config, drive_required=False)
+    auto_copy.setup_logging(config)
+    jobs = args.jobs or config.batch_jobs
+    state = BatchState(args.state or config.batch_state_file)
+    images = find_images(args.paths)
+    mover = auto_copy.open_mover(config)
+    # encodes run in the batch threads, so jobs images are encoded at once
+    encoder = auto_copy.open_encode_queue(config, workers=None, mover=mover)
+    runtime = auto_copy.Runtime(config, encoder, mover)
+    start = time.time()
+    try:
+        results = run_batch(config, images, state, runtime, jobs)
+        if mover is not None:
+            LOGGER.info('Waiting for outputs to be moved to %s', config.data_dir)
+            mover.join()
+    except KeyboardInterrupt:
+        LOGGER.warning('Interrupted, unfinished images are processed on the next run')
+        return 130
+    finally:
+        if config.metrics_textfile:
+            metrics.write_textfile(config.metrics_textfile)
+    print(report(results, time.time() - start))
+    return 1 if [result for result in results.values() if result['result'] == FAILED] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
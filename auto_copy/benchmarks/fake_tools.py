@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+fake_tools.py
+Stand-ins for the external tools auto_copy calls, so the whole flow can
+run on a box without optical drive, HandBrake or root. The first argument
+names the tool to fake, see TOOLS; run_benchmarks.py puts wrapper scripts
+named after the tools into a directory first on PATH.
+
+Speed is set with environment variables:
+
+FAKE_TOOL_LATENCY     seconds every tool takes to start (default 0.02)
+FAKE_READ_MBPS        MB/s at which mount "reads" the disc (default 200)
+FAKE_ENCODE_SPEED     times realtime at which HandBrakeCLI encodes (default 2000)
+FAKE_TRACK_SECONDS    seconds abcde or cdparanoia take per audio track (default 0.05)
+FAKE_AUDIO_ENCODE_SECONDS
+                      seconds lame, flac and opusenc take per track (default 0.05)
+FAKE_HANDBRAKE_TITLES json file with a list of [index, seconds, chapters]
+                      the scan reports (default: one title of 10 minutes)
+FAKE_STATE_DIR        where mount remembers what it mounted (default /tmp)
+
+Audio CDs are simulated by a file starting with AUDIO_MAGIC followed by
+the number of tracks.
+"""
+
+import json
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import disc_fs
+
+AUDIO_MAGIC = b'FAKE AUDIO CD'
+
+MEGA = 1024 * 1024
+
+
+def setting(name, default):
+    return float(os.environ.get(name, default))
+
+
+def audio_tracks(device):
+    """
+    Number of tracks of a fake audio CD, None if device is no fake audio CD
+    """
+    try:
+        with open(device, 'rb') as device_fh:
+            header = device_fh.read(64)
+    except (IOError, OSError):
+        return None
+    if not header.startswith(AUDIO_MAGIC):
+        return None
+    return int(header[len(AUDIO_MAGIC):].split()[0])
+
+
+def mounts_file():
+    return os.path.join(os.environ.get('FAKE_STATE_DIR', '/tmp'), 'fake_mounts.json')
+
+
+def read_mounts():
+    if not os.path.exists(mounts_file()):
+        return {}
+    with open(mounts_file(), 'r') as mounts_fh:
+        return json.load(mounts_fh)
+
+
+def write_mounts(mounts):
+    with open(mounts_file(), 'w') as mounts_fh:
+        json.dump(mounts, mounts_fh)
+
+
+def extract(volume, entry, target, rate):
+    """
+    Copy the files below entry to target, at rate bytes per second
+    """
+    for child in volume.listdir(entry):
+        path = os.path.join(target, child.name)
+        if child.is_dir:
+            os.mkdir(path)
+            extract(volume, child, path, rate)
+            continue
+        start = time.time()
+        with open(path, 'wb') as child_fh:
+            child_fh.write(volume.read_file(child))
+        time.sleep(max(0, child.size / rate - (time.time() - start)))
+
+
+def fake_mount(args):
+    """mount [-o options] <device> <mount point>"""
+    args = [arg for index, arg in enumerate(args)
+            if arg != '-o' and (index == 0 or args[index - 1] != '-o')]
+    device, mount_point = args
+    try:
+        volume = disc_fs.Volume(device)
+    except (IOError, OSError, disc_fs.NoFileSystemException) as error:
+        sys.stderr.write('mount: ' + str(error) + '\n')
+        return 32
+    extract(volume, None, mount_point, setting('FAKE_READ_MBPS', 200) * MEGA)
+    volume.close()
+    mounts = read_mounts()
+    mounts[os.path.abspath(device)] = os.path.abspath(mount_point)
+    write_mounts(mounts)
+    return 0
+
+
+def fake_umount(args):
+    """umount <device or mount point>"""
+    target = os.path.abspath(args[-1])
+    mounts = read_mounts()
+    mount_point = mounts.pop(target, None)
+    if mount_point is None and target in mounts.values():
+        mount_point = target
+        mounts = dict((device, point) for device, point in mounts.items() if point != target)
+    if mount_point is None:
+        sys.stderr.write('umount: ' + target + ': not mounted\n')
+        return 32
+    for name in os.listdir(mount_point):
+        path = os.path.join(mount_point, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+    write_mounts(mounts)
+    return 0
+
+
+def scan_output():
+    """
+    What HandBrakeCLI --scan --json prints
+    """
+    titles = [[1, 600, 10]]
+    if os.environ.get('FAKE_HANDBRAKE_TITLES'):
+        with open(os.environ['FAKE_HANDBRAKE_TITLES'], 'r') as titles_fh:
+            titles = json.load(titles_fh)
+    title_list = []
+    for index, seconds, chapters in titles:
+        title_list.append({
+            'Index': index,
+            'Name': 'FAKE_MOVIE',
+            'Duration': {'Hours': seconds // 3600, 'Minutes': seconds // 60 % 60,
+                         'Seconds': seconds % 60},
+            'ChapterList': [{'Duration': {'Hours': 0, 'Minutes': 0,
+                                          'Seconds': seconds // max(chapters, 1)}}] * chapters,
+            'AudioList': [{'LanguageCode': 'eng', 'CodecName': 'ac3'}],
+            'SubtitleList': [],
+        })
+    return 'Version: {"Name": "HandBrake"}\nJSON Title Set: ' \
+        + json.dumps({'TitleList': title_list}, indent=4) + '\n', titles
+
+
+def fake_handbrakecli(args):
+    """HandBrakeCLI --scan ... or HandBrakeCLI -i <source> -o <outfile> -t <title> ..."""
+    output, titles = scan_output()
+    if '--scan' in args:
+        sys.stdout.write(output)
+        return 0
+    outfile = args[args.index('-o') + 1]
+    title = int(args[args.index('-t') + 1])
+    seconds = dict((index, length) for index, length, chapters in titles).get(title)
+    if seconds is None:
+        sys.stderr.write('No title found.\n')
+        return 3
+    encode_time = seconds / setting('FAKE_ENCODE_SPEED', 2000)
+    fps = 25 * setting('FAKE_ENCODE_SPEED', 2000)
+    start = time.time()
+    while True:
+        elapsed = time.time() - start
+        percent = min(100.0, 100.0 * elapsed / max(encode_time, 0.001))
+        eta = int(max(0, encode_time - elapsed))
+        sys.stdout.write('Encoding: task 1 of 1, %.2f %% (%.2f fps, avg %.2f fps, ETA %02dh%02dm%02ds)\r'
+                         % (percent, fps, fps, eta // 3600, eta // 60 % 60, eta % 60))
+        sys.stdout.flush()
+        if percent >= 100:
+            break
+        time.sleep(min(0.05, encode_time))
+    with open(outfile, 'wb') as outfile_fh:
+        outfile_fh.write(b'\0' * 1024)
+    sys.stdout.write('\nEncode done!\n')
+    return 0
+
+
+def fake_cdparanoia(args):
+    """cdparanoia -d <device> -Q or cdparanoia -q -d <device> -w <track> <wav>"""
+    device = args[args.index('-d') + 1] if '-d' in args else '/dev/cdrom'
+    tracks = audio_tracks(device)
+    if tracks is None:
+        sys.stderr.write('Unable to open disc.\n')
+        return 1
+    if '-Q' in args:
+        sys.stderr.write('Table of contents (audio tracks only):\n'
+                         'track        length               begin        copy pre ch\n'
+                         '===========================================================\n')
+        for track in range(1, tracks + 1):
+            sys.stderr.write('%3d.    16500 [03:40.00]  %7d [00:00.00]    no   no  2\n'
+                             % (track, (track - 1) * 16500))
+        return 0
+    track = int(args[args.index('-w') + 1])
+    if track > tracks:
+        return 1
+    time.sleep(setting('FAKE_TRACK_SECONDS', 0.05))
+    with open(args[-1], 'wb') as wav_fh:
+        wav_fh.write(b'RIFF' + b'\0' * 1020)
+    return 0
+
+
+def fake_audio_encoder(args):
+    """lame, flac or opusenc, writing to the argument after -o or the last one"""
+    time.sleep(setting('FAKE_AUDIO_ENCODE_SECONDS', 0.05))
+    outfile = args[args.index('-o') + 1] if '-o' in args else args[-1]
+    with open(outfile, 'wb') as outfile_fh:
+        outfile_fh.write(b'\0' * 512)
+    return 0
+
+
+def fake_abcde(args):
+    """abcde -N -d <device> -o <format>"""
+    device = args[args.index('-d') + 1] if '-d' in args else '/dev/cdrom'
+    tracks = audio_tracks(device)
+    if tracks is None:
+        sys.stderr.write('abcde error: CDROM has no audio tracks\n')
+        return 1
+    for track in range(1, tracks + 1):
+        sys.stdout.write('Grabbing track %02d: Track %d...\n' % (track, track))
+        sys.stdout.flush()
+        time.sleep(setting('FAKE_TRACK_SECONDS', 0.05))
+        with open('track_%02d.mp3' % track, 'wb') as track_fh:
+            track_fh.write(b'\0' * 1024)
+    sys.stdout.write('Finished.\n')
+    return 0
+
+
+def fake_trayopen(args):
+    """trayopen <device>, exits 1 as the tray is closed"""
+    return 1
+
+
+def fake_eject(args):
+    return 0
+
+TOOLS = {
+    'HandBrakeCLI': fake_handbrakecli,
+    'cdparanoia': fake_cdparanoia,
+    'abcde': fake_abcde,
+    'mount': fake_mount,
+    'umount': fake_umount,
+    'eject': fake_eject,
+    'trayopen': fake_trayopen,
+    'lame': fake_audio_encoder,
+    'flac': fake_audio_encoder,
+    'opusenc': fake_audio_encoder,
+}
+
+if __name__ == '__main__':
+    time.sleep(setting('FAKE_TOOL_LATENCY', 0.02))
+    sys.exit(TOOLS[sys.argv[1]](sys.argv[2:]))
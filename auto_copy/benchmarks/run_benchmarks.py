@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+run_benchmarks.py
+Time auto_copy end to end for every kind of disc, on a box without
+optical drive. Discs are ISO images built on the fly, the external tools
+are replaced by fake_tools.py with a fixed speed, so the numbers measure
+auto_copy itself: how it waits, scans, mounts, copies and queues.
+
+Every flow is run a few times; the median wall time of the whole flow and
+of each stage (from the stage_seconds metric) is compared to baseline.json.
+Anything slower than the baseline by more than the tolerance fails the run.
+
+    run_benchmarks.py                   # compare against baseline.json
+    run_benchmarks.py --update-baseline # record new baselines
+    run_benchmarks.py --flow DATA -v    # a single flow, with debug log
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import auto_copy
+import metrics
+from tests.iso_fixture import make_iso
+import fake_tools
+
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+MEGA = 1024 * 1024
+
+# speed of the fake tools, kept constant so baselines stay comparable
+FAKE_SETTINGS = {
+    'FAKE_TOOL_LATENCY': '0.02',
+    'FAKE_READ_MBPS': '200',
+    'FAKE_ENCODE_SPEED': '2000',
+    'FAKE_TRACK_SECONDS': '0.05',
+    'FAKE_AUDIO_ENCODE_SECONDS': '0.05',
+}
+
+# titles of the fake DVD: [index, seconds, chapters]. Menus, the movie,
+# two copies of it differing in a second, and an extra.
+DVD_TITLES = [[1, 20, 1], [2, 1200, 24], [3, 1201, 24], [4, 360, 4]]
+
+FLOWS = {
+    'DATA': {'disc': 'data.iso', 'config': {}},
+    'DATA_STAGED': {'disc': 'data.iso', 'config': {'data_mode': 'staged'}},
+    'VIDEO_DVD': {'disc': 'dvd.iso', 'config': {}},
+    'VIDEO_DVD_STAGED': {'disc': 'dvd.iso', 'config': {'video_mode': 'staged'}},
+    'AUDIO': {'disc': 'audio.cdda', 'config': {}},
+    'AUDIO_NATIVE': {'disc': 'audio.cdda',
+                     'config': {'audio_ripper': 'native', 'audio_formats': ['mp3', 'flac']}},
+}
+
+
+def make_discs(disc_dir):
+    """
+    Build the disc images all flows read from
+    """
+    make_iso(os.path.join(disc_dir, 'data.iso'), 'BACKUP_2016', {
+        'VIDEOS/HOLIDAY.MP4': os.urandom(24 * MEGA),
+        'VIDEOS/BIRTHDAY.MP4': os.urandom(12 * MEGA),
+        'PHOTOS/IMG_0001.JPG': os.urandom(200 * 1024),
+        'README.TXT': b'backup\n',
+    })
+    vmg = b'DVDVIDEO-VMG' + b'\0' * 2036
+    make_iso(os.path.join(disc_dir, 'dvd.iso'), 'FAKE_MOVIE', {
+        'VIDEO_TS/VIDEO_TS.IFO': vmg,
+        'VIDEO_TS/VTS_01_0.IFO': b'DVDVIDEO-VTS' + b'\0' * 2036,
+        'VIDEO_TS/VTS_01_1.VOB': os.urandom(16 * MEGA),
+    })
+    with open(os.path.join(disc_dir, 'audio.cdda'), 'wb') as audio_fh:
+        audio_fh.write(fake_tools.AUDIO_MAGIC + b' 12\n' + b'\0' * MEGA)
+    with open(os.path.join(disc_dir, 'titles.json'), 'w') as titles_fh:
+        json.dump(DVD_TITLES, titles_fh)
+
+
+def install_fake_tools(bin_dir):
+    """
+    Put a wrapper for every fake tool into bin_dir
+    """
+    for tool in fake_tools.TOOLS:
+        wrapper = os.path.join(bin_dir, tool)
+        with open(wrapper, 'w') as wrapper_fh:
+            wrapper_fh.write('#!/bin/sh\nexec "' + sys.executable + '" "'
+                             + os.path.join(BENCHMARK_DIR, 'fake_tools.py') + '" '
+                             + tool + ' "$@"\n')
+        os.chmod(wrapper, 0o755)
+
+
+def write_config(work_dir, bin_dir, disc, overrides):
+    """
+    Write a configuration for a single run, with everything in work_dir
+
+    returns the configParser object
+    """
+    settings = {
+        'cdrom_device': disc,
+        'cdrom_mnt': os.path.join(work_dir, 'mnt'),
+        'data_dir': os.path.join(work_dir, 'data'),
+        'min_file_size': 1,
+        'rip_speed': 'veryfast',
+        'handbrakecli': os.path.join(bin_dir, 'HandBrakeCLI'),
+        'cdparanoia': os.path.join(bin_dir, 'cdparanoia'),
+        'abcde': os.path.join(bin_dir, 'abcde'),
+        'trayopen': os.path.join(bin_dir, 'trayopen'),
+        'lame': os.path.join(bin_dir, 'lame'),
+        'flac': os.path.join(bin_dir, 'flac'),
+        'opusenc': os.path.join(bin_dir, 'opusenc'),
+        'no_exec_file': os.path.join(work_dir, 'no_auto_copy'),
+        'staging_dir': os.path.join(work_dir, 'staging'),
+        'encode_queue_file': os.path.join(work_dir, 'encode_queue.sqlite'),
+        'encode_workers': 2,
+        'metadata_backend': 'none',
+        'metadata_cache_file': '',
+        # every run sees the same disc, it must not be skipped as known
+        'ingest_index_file': '',
+    }
+    settings.update(overrides)
+    config_file = os.path.join(work_dir, 'auto_copy.yml')
+    with open(config_file, 'w') as config_fh:
+        for key, value in sorted(settings.items()):
+            config_fh.write(key + ' : ' + json.dumps(value) + '\n')
+    return auto_copy.read_config(config_file)
+
+
+def stage_totals():
+    """
+    Seconds spent per stage so far, over all devices
+    """
+    totals = {}
+    for series in metrics.REGISTRY.snapshot().get('stage_seconds', []):
+        totals[series['stage']] = totals.get(series['stage'], 0) + series['sum']
+    return totals
+
+
+def check_outcome(flow, config, audio_dir):
+    """
+    Make sure the flow did its work, a failing flow would look fast
+
+    returns a list of problems
+    """
+    data = os.listdir(config.data_dir) if os.path.isdir(config.data_dir) else []
+    if flow.startswith('DATA'):
+        expected = ['BIRTHDAY.MP4', 'HOLIDAY.MP4']
+        found = sorted(name for name in data if not name.endswith('.sha256'))
+    elif flow.startswith('VIDEO_DVD'):
+        expected = ['Fake Movie.mp4', 'Fake Movie_4.mp4']
+        found = sorted(data)
+    elif flow == 'AUDIO_NATIVE':
+        expected = sorted('track_%02d.%s' % (track, audio_format) for track in range(1, 13)
+                          for audio_format in ('mp3', 'flac'))
+        found = sorted(name for rip_dir in data for name in
+                       os.listdir(os.path.join(config.data_dir, rip_dir)))
+    else:
+        expected = ['track_%02d.mp3' % track for track in range(1, 13)]
+        found = sorted(os.listdir(audio_dir))
+    if found != expected:
+        return [flow + ': expected ' + str(expected) + ', found ' + str(found)]
+    return []
+
+
+def run_flow(flow, disc_dir, bin_dir, runs):
+    """
+    Run a flow runs times
+
+    returns a dict of timings (median seconds) and a list of problems
+    """
+    timings = {}
+    problems = []
+    for run in range(runs):
+        work_dir = tempfile.mkdtemp(prefix='auto_copy_bench_')
+        audio_dir = os.path.join(work_dir, 'audio')
+        os.mkdir(audio_dir)
+        os.mkdir(os.path.join(work_dir, 'data'))
+        cwd = os.getcwd()
+        try:
+            os.environ['FAKE_STATE_DIR'] = work_dir
+            config = write_config(work_dir, bin_dir, os.path.join(disc_dir, FLOWS[flow]['disc']),
+                                  FLOWS[flow]['config'])
+            before = stage_totals()
+            # abcde writes to the current directory
+            os.chdir(audio_dir)
+            start = time.time()
+            auto_copy.auto_copy(config)
+            timings.setdefault('total', []).append(time.time() - start)
+            os.chdir(cwd)
+            for stage, seconds in stage_totals().items():
+                timings.setdefault(stage, []).append(seconds - before.get(stage, 0))
+            problems.extend(check_outcome(flow, config, audio_dir))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(work_dir)
+    return dict((name, round(statistics.median(values), 3))
+                for name, values in timings.items() if max(values) > 0), problems
+
+
+def compare(results, baseline, tolerance, slack):
+    """
+    returns a list of regressions: timings slower than the baseline
+    by more than tolerance (a fraction) plus slack (seconds)
+    """
+    regressions = []
+    for flow, timings in sorted(results.items()):
+        for name, seconds in sorted(timings.items()):
+            expected = baseline.get(flow, {}).get(name)
+            if expected is not None and seconds > expected * (1 + tolerance) + slack:
+                regressions.append(flow + ' ' + name + ': ' + str(seconds) + 's, baseline '
+                                   + str(expected) + 's')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark auto_copy with fake drives and tools')
+    parser.add_argument('--flow', action='append', choices=sorted(FLOWS),
+                        help='flow to run, may be given several times. Default: all')
+    parser.add_argument('--runs', type=int, default=3, help='runs per flow, the median counts')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline, as a fraction')
+    parser.add_argument('--slack', type=float, default=0.1,
+                        help='allowed slowdown in seconds on top, for very short stages')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='store the results as new baseline')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the auto_copy log')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+    if not args.verbose:
+        logging.disable(logging.INFO)
+    os.environ.update(FAKE_SETTINGS)
+    tmp_dir = tempfile.mkdtemp(prefix='auto_copy_bench_')
+    try:
+        disc_dir = os.path.join(tmp_dir, 'discs')
+        bin_dir = os.path.join(tmp_dir, 'bin')
+        os.mkdir(disc_dir)
+        os.mkdir(bin_dir)
+        make_discs(disc_dir)
+        install_fake_tools(bin_dir)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+        os.environ['FAKE_HANDBRAKE_TITLES'] = os.path.join(disc_dir, 'titles.json')
+        results = {}
+        problems = []
+        for flow in args.flow or sorted(FLOWS):
+            results[flow], flow_problems = run_flow(flow, disc_dir, bin_dir, args.runs)
+            problems.extend(flow_problems)
+            print(flow.ljust(18) + '  '.join(name + ' ' + str(seconds) + 's'
+                                             for name, seconds in sorted(results[flow].items())))
+    finally:
+        shutil.rmtree(tmp_dir)
+    if problems:
+        print('\n'.join(['FAILED'] + problems))
+        return 2
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as baseline_fh:
+                baseline = json.load(baseline_fh)
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_fh:
+            json.dump(baseline, baseline_fh, indent=4, sort_keys=True)
+            baseline_fh.write('\n')
+        print('Baseline written to ' + args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline yet, record one with --update-baseline')
+        return 0
+    with open(args.baseline, 'r') as baseline_fh:
+        regressions = compare(results, json.load(baseline_fh), args.tolerance, args.slack)
+    if regressions:
+        print('\n'.join(['REGRESSIONS'] + regressions))
+        return 1
+    print('No regressions')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -37,7 +37,8 @@ class configParser(object):
         self.config_file = config_file
         # parsing config file
         with open(self.config_file, 'r') as cfile:
-            self.config = yaml.safe_load(cfile)
+            # the C loader is a lot faster, if libyaml is there
+            self.config = yaml.load(cfile, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
         for key, value in self.config.items():
             setattr(self, key, value)
         # allowed values
@@ -0,0 +1,302 @@
+"""
+copier.py
+Copy files off a disc as fast as the drive can read them.
+
+Data is copied with large page aligned buffers and hashed in the same pass.
+Files are written to a hidden .part file first and renamed when complete,
+so an interrupted copy never looks finished, and can be resumed later.
+Next to the .part file, size, mtime and the hash of the beginning of the
+source are kept, so only a copy of the very same file is resumed.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import time
+
+LOGGER = logging.getLogger('auto_copy')
+
+MEGA = 1024 * 1024
+
+# large reads keep optical drives streaming instead of seeking
+BUFFER_SIZE = 8 * MEGA
+
+MANIFEST_SUFFIX = '.sha256'
+
+# bytes at the start of a source hashed to recognise it when resuming
+PREFIX_SIZE = 1024 * 1024
+
+
+class CopyResult(object):
+    """
+    Outcome of copying a single file
+    """
+
+    def __init__(self, source, dest, size, checksum, seconds, resumed_at=0):
+        """
+        source: path of the copied file
+        dest: path of the copy
+        size: size in bytes
+        checksum: sha256 hex digest, None if not computed
+        seconds: time spent copying
+        resumed_at: bytes that were already copied by an earlier attempt
+        """
+        self.source = source
+        self.dest = dest
+        self.size = size
+        self.checksum = checksum
+        self.seconds = seconds
+        self.resumed_at = resumed_at
+
+    @property
+    def mb_per_s(self):
+        """
+        Throughput of this copy, not counting resumed bytes
+        """
+        return mb_per_s(self.size - self.resumed_at, self.seconds)
+
+
+def mb_per_s(size, seconds):
+    """
+    Throughput in MB/s, rounded for logging
+    """
+    return round(float(size) / MEGA / max(seconds, 0.001), 1)
+
+
+def part_path(dest, source=None):
+    """
+    Where the copy of dest is written to until it is complete
+
+    dest: the final path
+    source: the file copied to dest. If given, it is part of the name, so
+        files of the same name from different directories do not meet.
+    """
+    name = '.' + os.path.basename(dest)
+    if source is not None:
+        name += '.' + hashlib.sha1(os.path.abspath(source).encode(
+            'utf-8', 'surrogateescape')).hexdigest()[:12]
+    return os.path.join(os.path.dirname(dest), name + '.part')
+
+
+def source_info_path(partial):
+    """
+    Where what identifies the source of partial is kept, see source_info
+    """
+    return partial[:-len('.part')] + '.source.part'
+
+
+def source_info(source, size):
+    """
+    What tells a source from another file of the same name: size, mtime
+    and the sha256 of its first PREFIX_SIZE bytes
+    """
+    with open(source, 'rb') as source_fh:
+        prefix = hashlib.sha256(source_fh.read(PREFIX_SIZE)).hexdigest()
+    return {'size': size, 'mtime': os.path.getmtime(source), 'prefix': prefix}
+
+
+def resume_offset(partial, info):
+    """
+    Tell how much of a source an earlier copy got to. A partial copy
+    written for another source, or without record of its source, is
+    removed.
+
+    partial: the .part file, see part_path
+    info: see source_info
+
+    returns the bytes that need not be copied again
+    """
+    if not os.path.exists(partial):
+        return 0
+    try:
+        with open(source_info_path(partial), 'r') as info_fh:
+            resumable = json.load(info_fh) == info
+    except (OSError, ValueError):
+        resumable = False
+    if resumable and os.path.getsize(partial) <= info['size']:
+        return os.path.getsize(partial)
+    LOGGER.info('Discarding %s, it is not a copy of the current source', partial)
+    os.unlink(partial)
+    return 0
+
+
+def hash_file(path, hasher, buffer_size=BUFFER_SIZE):
+    """
+    Feed the content of path into hasher
+    """
+    with open(path, 'rb') as file_fh:
+        while True:
+            chunk = file_fh.read(buffer_size)
+            if not chunk:
+                return
+            hasher.update(chunk)
+
+
+def write_all(fd, data):
+    """
+    os.write may write less than asked for
+    """
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def copy_range(src_fd, dest_fd, offset, size, buffer_size):
+    """
+    Copy without passing the data through python: copy_file_range, then
+    sendfile, then plain read and write, whichever the system supports.
+    """
+    remaining = size - offset
+    try:
+        while remaining > 0:
+            copied = os.copy_file_range(src_fd, dest_fd, min(remaining, buffer_size))
+            if copied == 0:
+                break
+            remaining -= copied
+        return
+    except (AttributeError, OSError):
+        pass
+    try:
+        while remaining > 0:
+            copied = os.sendfile(dest_fd, src_fd, None, min(remaining, buffer_size))
+            if copied == 0:
+                break
+            remaining -= copied
+        return
+    except (AttributeError, OSError):
+        pass
+    while remaining > 0:
+        chunk = os.read(src_fd, min(remaining, buffer_size))
+        if not chunk:
+            break
+        write_all(dest_fd, chunk)
+        remaining -= len(chunk)
+
+
+def copy_hashed(src_fd, dest_fd, hasher, buffer_size):
+    """
+    Copy through an aligned buffer, feeding everything into hasher
+    """
+    buffer = mmap.mmap(-1, buffer_size)
+    view = memoryview(buffer)
+    try:
+        while True:
+            length = os.readv(src_fd, [buffer])
+            if length == 0:
+                break
+            hasher.update(view[:length])
+            write_all(dest_fd, view[:length])
+    finally:
+        view.release()
+        buffer.close()
+
+
+def copy_file(source, dest_dir, checksum=True, buffer_size=BUFFER_SIZE):
+    """
+    Copy source into dest_dir, resuming an earlier interrupted copy.
+
+    source: path of the file to copy
+    dest_dir: directory to copy to
+    checksum: compute the sha256 of the data while copying
+    buffer_size: bytes read at once
+
+    returns a CopyResult
+    """
+    dest = os.path.join(dest_dir, os.path.basename(source))
+    partial = part_path(dest, source)
+    size = os.path.getsize(source)
+    hasher = hashlib.sha256() if checksum else None
+    info = source_info(source, size)
+    offset = resume_offset(partial, info)
+    if offset:
+        LOGGER.info('Resuming copy of %s at %sMB', source, offset // MEGA)
+        if hasher is not None:
+            hash_file(partial, hasher)
+    else:
+        with open(source_info_path(partial), 'w') as info_fh:
+            json.dump(info, info_fh)
+    start = time.time()
+    src_fd = os.open(source, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        dest_fd = os.open(partial, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(dest_fd, offset)
+            os.lseek(dest_fd, offset, os.SEEK_SET)
+            os.lseek(src_fd, offset, os.SEEK_SET)
+            if hasher is not None:
+                copy_hashed(src_fd, dest_fd, hasher, buffer_size)
+            else:
+                copy_range(src_fd, dest_fd, offset, size, buffer_size)
+            os.fsync(dest_fd)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+    os.rename(partial, dest)
+    os.unlink(source_info_path(partial))
+    fsync_dir(dest_dir)
+    result = CopyResult(source, dest, size, hasher.hexdigest() if hasher else None,
+                        time.time() - start, offset)
+    LOGGER.info('Copied %s (%sMB) at %sMB/s', source, size // MEGA, result.mb_per_s)
+    return result
+
+
+def fsync_dir(path):
+    """
+    Make a rename in directory path durable
+    """
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def verify(result):
+    """
+    Read the copy back and compare its checksum
+
+    result: a CopyResult with a checksum
+
+    returns True if the copy matches
+    """
+    hasher = hashlib.sha256()
+    hash_file(result.dest, hasher)
+    return hasher.hexdigest() == result.checksum
+
+
+def discard(result):
+    """
+    Remove a copy, e.g. one that failed verify, together with what an
+    interrupted copy of the same source left behind
+
+    result: a CopyResult
+    """
+    partial = part_path(result.dest, result.source)
+    for path in (result.dest, partial, source_info_path(partial)):
+        if os.path.exists(path):
+            LOGGER.debug('Removing %s', path)
+            os.unlink(path)
+
+
+def write_manifest(results, manifest, manifest_dir=None):
+    """
+    Write the checksums of copied files in the format of sha256sum, so the
+    copies can be checked with 'sha256sum -c'
+
+    results: list of CopyResult objects
+    manifest: path of the manifest, usually in the directory of the copies
+    manifest_dir: the directory the manifest ends up in, if it is moved
+        after writing. Defaults to the directory of manifest
+    """
+    manifest_dir = manifest_dir or os.path.dirname(manifest)
+    with open(part_path(manifest), 'w') as manifest_fh:
+        for result in results:
+            if result.checksum:
+                manifest_fh.write(result.checksum + '  '
+                                  + os.path.relpath(result.dest, manifest_dir) + '\n')
+    os.rename(part_path(manifest), manifest)
@@ -0,0 +1,107 @@
+"""
+disc.py
+Find out what kind of disc is in a drive (or image), without mounting it.
+The resulting Disc object is handed on to the later stages, so the disc
+does not need to be probed again.
+"""
+
+import hashlib
+import logging
+
+import disc_fs
+import drive
+import supervisor
+
+LOGGER = logging.getLogger('auto_copy')
+
+AUDIO = 'AUDIO'
+VIDEO_DVD = 'VIDEO_DVD'
+DATA = 'DATA'
+
+
+class Disc(object):
+    """
+    Everything we learned about a disc while looking at it
+    """
+
+    def __init__(self, device, media_type=None, disc_status=None, volume=None):
+        """
+        device: the device or image the disc was read from
+        media_type: one of AUDIO, VIDEO_DVD, DATA or None if unknown
+        disc_status: the CDS_* constant reported by the drive, None for images
+        volume: a disc_fs.Volume for discs with a file system
+        """
+        self.device = device
+        self.media_type = media_type
+        self.disc_status = disc_status
+        self.volume = volume
+
+    @property
+    def label(self):
+        """
+        The volume name, None if there is none
+        """
+        if self.volume is None:
+            return None
+        return self.volume.volume_id or None
+
+    @property
+    def fingerprint(self):
+        """
+        Identifies a disc across insertions: a hash of the volume descriptor,
+        which carries name, size and creation time. None without file system.
+        """
+        if self.volume is None or self.volume.primary_descriptor is None:
+            return None
+        hasher = hashlib.sha256(self.volume.primary_descriptor)
+        hasher.update(str(self.volume.volume_sectors).encode('ascii'))
+        return hasher.hexdigest()
+
+    def close(self):
+        """
+        Release the device, see disc_fs.Volume.close
+        """
+        if self.volume is not None:
+            self.volume.close()
+
+    def __repr__(self):
+        return 'Disc(' + self.device + ', ' + str(self.media_type) + ', ' + str(self.label) + ')'
+
+
+def is_audio(device, cdparanoia, timeout=supervisor.TOOL_TIMEOUT):
+    """
+    Ask cdparanoia whether there are audio tracks. Only needed if the
+    drive does not answer the disc status ioctl.
+
+    timeout: seconds cdparanoia may take
+    """
+    return supervisor.run([cdparanoia, '-d', device, '-Q'], timeout=timeout,
+                          quiet=True).returncode == 0
+
+
+def detect(device, cdparanoia='/bin/cdparanoia'):
+    """
+    Determine the media type of the disc in device
+
+    device: a device or image file
+    cdparanoia: path to cdparanoia, for drives without status ioctl
+
+    returns a Disc object. Its media_type is None if the disc could not be read.
+    """
+    try:
+        status = drive.disc_status(device)
+    except OSError as error:
+        LOGGER.debug('Disc status not available for %s: %s', device, error)
+        status = None
+        if is_audio(device, cdparanoia):
+            return Disc(device, AUDIO)
+    if status in (drive.CDS_AUDIO, drive.CDS_MIXED):
+        return Disc(device, AUDIO, status)
+    try:
+        volume = disc_fs.Volume(device)
+    except (IOError, OSError, disc_fs.NoFileSystemException) as error:
+        LOGGER.debug('Could not read file system of %s: %s', device, error)
+        return Disc(device, None, status)
+    media_type = VIDEO_DVD if volume.find('VIDEO_TS') is not None else DATA
+    volume.close()
+    return Disc(device, media_type, status, volume)
@@ -0,0 +1,316 @@
+"""
+disc_fs.py
+Read the file system of a disc or image directly, without mounting it.
+Supports enough of ISO9660 and UDF to read the volume name, list
+directories and read small files like the IFOs of a video DVD.
+"""
+
+import logging
+import struct
+
+LOGGER = logging.getLogger('auto_copy')
+
+SECTOR_SIZE = 2048
+
+# ISO9660
+ISO_DESCRIPTOR_START = 16
+ISO_PRIMARY = 1
+ISO_TERMINATOR = 255
+
+# UDF descriptor tags
+UDF_ANCHOR_SECTOR = 256
+TAG_ANCHOR = 2
+TAG_PARTITION = 5
+TAG_LOGICAL_VOLUME = 6
+TAG_TERMINATING = 8
+TAG_FILE_SET = 256
+TAG_FILE_IDENTIFIER = 257
+TAG_FILE_ENTRY = 261
+TAG_EXTENDED_FILE_ENTRY = 266
+
+
+class NoFileSystemException(Exception):
+    pass
+
+
+class Entry(object):
+    """
+    A file or directory on the disc
+    """
+
+    def __init__(self, name, is_dir, size, extents):
+        """
+        name: file name, without ISO9660 version suffix
+        is_dir: True for directories
+        size: size in bytes
+        extents: list of (absolute sector, length in bytes) holding the data
+        """
+        self.name = name
+        self.is_dir = is_dir
+        self.size = size
+        self.extents = extents
+
+    def __repr__(self):
+        return 'Entry(' + self.name + (', dir' if self.is_dir else ', ' + str(self.size)) + ')'
+
+
+def decode_dstring(data):
+    """
+    Decode a UDF dstring or file identifier (OSTA compressed unicode)
+    """
+    if not data:
+        return ''
+    if data[0] == 16:
+        return data[1:].decode('utf-16-be', 'replace')
+    return data[1:].decode('latin-1')
+
+
+class Volume(object):
+    """
+    The file system of a disc or image. ISO9660 is used if present (DVDs
+    are UDF bridge discs carrying both), UDF otherwise.
+    """
+
+    def __init__(self, path):
+        """
+        path: a device or image file
+
+        raises NoFileSystemException if neither ISO9660 nor UDF is found
+        """
+        self.path = path
+        self.fh = None
+        self.file_system = None
+        self.volume_id = None
+        self.volume_sectors = None
+        self.primary_descriptor = None
+        self.root = None
+        try:
+            if not self.read_iso9660():
+                self.read_udf()
+        except (IOError, OSError, struct.error, IndexError) as error:
+            raise NoFileSystemException(path + ': ' + str(error))
+        finally:
+            self.close()
+        if self.root is None:
+            raise NoFileSystemException(path + ': no ISO9660 or UDF file system found')
+
+    def close(self):
+        """
+        Close the device. An open optical drive keeps its tray locked, so
+        this must be called before ejecting. Reading again reopens it.
+        """
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def read(self, offset, length):
+        """
+        Read length bytes at offset
+        """
+        if self.fh is None:
+            self.fh = open(self.path, 'rb')
+        self.fh.seek(offset)
+        return self.fh.read(length)
+
+    def read_sectors(self, sector, count=1):
+        """
+        Read count sectors starting at sector
+        """
+        return self.read(sector * SECTOR_SIZE, count * SECTOR_SIZE)
+
+    def read_extents(self, extents, size):
+        """
+        Read size bytes spread over extents
+        """
+        chunks = []
+        for sector, length in extents:
+            chunks.append(self.read(sector * SECTOR_SIZE, length))
+        return b''.join(chunks)[:size]
+
+    ###
+    # ISO9660
+    ###
+
+    def read_iso9660(self):
+        """
+        Look for the ISO9660 primary volume descriptor
+
+        returns True if found
+        """
+        sector = ISO_DESCRIPTOR_START
+        while True:
+            descriptor = self.read_sectors(sector)
+            if len(descriptor) < SECTOR_SIZE or descriptor[1:6] != b'CD001':
+                return False
+            if descriptor[0] == ISO_TERMINATOR:
+                return False
+            if descriptor[0] == ISO_PRIMARY:
+                break
+            sector += 1
+        self.file_system = 'iso9660'
+        self.primary_descriptor = descriptor
+        self.volume_id = descriptor[40:72].decode('latin-1').strip()
+        self.volume_sectors = struct.unpack('<I', descriptor[80:84])[0]
+        self.root = self.iso_record(descriptor[156:190])
+        return True
+
+    def iso_record(self, record):
+        """
+        Parse an ISO9660 directory record into an Entry
+        """
+        sector, size = struct.unpack('<I', record[2:6])[0], struct.unpack('<I', record[10:14])[0]
+        name = record[33:33 + record[32]].decode('latin-1').split(';')[0]
+        return Entry(name, bool(record[25] & 2), size, [(sector, size)])
+
+    def iso_listdir(self, entry):
+        data = self.read_extents(entry.extents, entry.size)
+        entries = []
+        pos = 0
+        while pos < len(data):
+            length = data[pos]
+            if length == 0:
+                # records never cross sector boundaries
+                pos = (pos // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            record = data[pos:pos + length]
+            pos += length
+            if record[32] == 1 and record[33] in (0, 1):
+                # '.' and '..'
+                continue
+            entries.append(self.iso_record(record))
+        return entries
+
+    ###
+    # UDF
+    ###
+
+    def read_udf(self):
+        """
+        Find the UDF root directory via anchor, volume descriptors and file set
+        """
+        anchor = self.read_sectors(UDF_ANCHOR_SECTOR)
+        if struct.unpack('<H', anchor[0:2])[0] != TAG_ANCHOR:
+            return
+        vds_length, vds_sector = struct.unpack('<II', anchor[16:24])
+        self.partitions = {}
+        file_set = None
+        for sector in range(vds_sector, vds_sector + vds_length // SECTOR_SIZE):
+            descriptor = self.read_sectors(sector)
+            tag = struct.unpack('<H', descriptor[0:2])[0]
+            if tag == TAG_PARTITION:
+                number = struct.unpack('<H', descriptor[22:24])[0]
+                self.partitions[number] = struct.unpack('<I', descriptor[188:192])[0]
+            elif tag == TAG_LOGICAL_VOLUME:
+                self.volume_id = decode_dstring(descriptor[84:84 + descriptor[211]]).strip()
+                file_set = struct.unpack('<IIH', descriptor[248:258])
+            elif tag == TAG_TERMINATING:
+                break
+        if file_set is None or not self.partitions:
+            return
+        # partition reference numbers count the partition maps, we only support one
+        self.partition_start = list(self.partitions.values())[0]
+        fsd = self.read_sectors(self.partition_start + file_set[1])
+        if struct.unpack('<H', fsd[0:2])[0] != TAG_FILE_SET:
+            return
+        root_icb = struct.unpack('<IIH', fsd[400:410])
+        self.file_system = 'udf'
+        # holds the recording time, as unique as an ISO9660 primary descriptor
+        self.primary_descriptor = fsd
+        self.root = self.udf_entry('', root_icb[1])
+
+    def udf_entry(self, name, icb_block):
+        """
+        Read a (extended) file entry into an Entry
+        """
+        fe = self.read_sectors(self.partition_start + icb_block)
+        tag = struct.unpack('<H', fe[0:2])[0]
+        if tag == TAG_FILE_ENTRY:
+            ad_start = 176
+            ea_length, ad_length = struct.unpack('<II', fe[168:176])
+        elif tag == TAG_EXTENDED_FILE_ENTRY:
+            ad_start = 216
+            ea_length, ad_length = struct.unpack('<II', fe[208:216])
+        else:
+            raise NoFileSystemException('Unexpected UDF tag ' + str(tag))
+        is_dir = fe[27] == 4
+        size = struct.unpack('<Q', fe[56:64])[0]
+        ad_type = struct.unpack('<H', fe[34:36])[0] & 7
+        ads = fe[ad_start + ea_length:ad_start + ea_length + ad_length]
+        extents = []
+        if ad_type == 3:
+            # data embedded in the file entry itself
+            entry = Entry(name, is_dir, size, [])
+            entry.embedded = ads
+            return entry
+        ad_size = 8 if ad_type == 0 else 16
+        for pos in range(0, len(ads) - ad_size + 1, ad_size):
+            length, block = struct.unpack('<II', ads[pos:pos + 8])
+            length &= 0x3fffffff
+            if length:
+                extents.append((self.partition_start + block, length))
+        return Entry(name, is_dir, size, extents)
+
+    def udf_listdir(self, entry):
+        data = getattr(entry, 'embedded', None) or self.read_extents(entry.extents, entry.size)
+        entries = []
+        pos = 0
+        while pos + 38 <= len(data):
+            if struct.unpack('<H', data[pos:pos + 2])[0] != TAG_FILE_IDENTIFIER:
+                break
+            characteristics = data[pos + 18]
+            name_length = data[pos + 19]
+            icb_block = struct.unpack('<I', data[pos + 24:pos + 28])[0]
+            iu_length = struct.unpack('<H', data[pos + 36:pos + 38])[0]
+            name_start = pos + 38 + iu_length
+            name = decode_dstring(data[name_start:name_start + name_length])
+            pos += (38 + iu_length + name_length + 3) & ~3
+            if characteristics & 8 or characteristics & 4:
+                # parent directory or deleted entry
+                continue
+            entries.append(self.udf_entry(name, icb_block))
+        return entries
+
+    ###
+    # public interface
+    ###
+
+    def listdir(self, entry=None):
+        """
+        List a directory
+
+        entry: an Entry of a directory, defaults to the root directory
+
+        returns a list of Entry objects
+        """
+        if entry is None:
+            entry = self.root
+        if self.file_system == 'iso9660':
+            return self.iso_listdir(entry)
+        return self.udf_listdir(entry)
+
+    def find(self, path):
+        """
+        Look up path (e.g. 'VIDEO_TS/VIDEO_TS.IFO'), ignoring case
+
+        returns an Entry or None
+        """
+        entry = self.root
+        for part in [part for part in path.split('/') if part]:
+            if not entry.is_dir:
+                return None
+            matches = [child for child in self.listdir(entry)
+                       if child.name.upper() == part.upper()]
+            if not matches:
+                return None
+            entry = matches[0]
+        return entry
+
+    def read_file(self, entry):
+        """
+        Read the whole content of a file
+
+        entry: an Entry of a file
+        """
+        if getattr(entry, 'embedded', None) is not None:
+            return entry.embedded[:entry.size]
+        return self.read_extents(entry.extents, entry.size)
@@ -0,0 +1,638 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+distributed.py
+Encode staged titles on other machines of the LAN.
+
+The daemon on the drive host runs a coordinator next to its encode queue.
+Workers on other machines ask it for jobs over HTTP, download the staged
+image in chunks, encode it with their own HandBrakeCLI and upload the
+result in chunks. Local and remote workers take jobs from the same queue.
+
+A worker holds a lease on its job and renews it with heartbeats. If it
+stops doing so - crashed, switched off, cable pulled - the job is queued
+again and picked up by the next worker asking. Downloads and uploads are
+retried and continue where they stopped.
+
+Protocol, all bodies JSON except for the chunks:
+
+    POST /claim                  {"worker": name} -> job, 204 if none
+    GET  /jobs/<id>/source       the staged image, with a Range header
+    POST /jobs/<id>/heartbeat    {"worker": name, "percent": p}
+    GET  /jobs/<id>/result       {"size": bytes uploaded so far}
+    PUT  /jobs/<id>/result       a chunk, at the offset in X-Offset
+    POST /jobs/<id>/finish       {"worker", "returncode", "size", "sha256", "fps"}
+
+409 means the worker lost the job. Requests carry the worker name in
+X-Worker and the shared token in X-Token. Without a token, the
+coordinator only listens on the loopback interface.
+
+Run a worker with
+
+    distributed.py --coordinator http://drivehost:8765 --work-dir /var/tmp/auto_copy_worker
+"""
+
+import argparse
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import encode_queue
+import metrics
+import scheduler
+import supervisor
+
+LOGGER = logging.getLogger('auto_copy')
+
+# bytes per download or upload request
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# attempts per request before a worker gives up on a job
+RETRIES = 5
+
+# seconds a worker waits before asking for work again
+POLL_INTERVAL = 10
+
+# the only addresses a coordinator without a token listens on
+LOOPBACK_ADDRESSES = ('127.0.0.1', '::1', 'localhost')
+
+JOB_PATH = re.compile(r'^/jobs/(\d+)/(source|heartbeat|result|finish)$')
+RANGE = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class WorkerError(Exception):
+    pass
+
+
+def option_value(command, option):
+    """
+    returns the value following option in command, None if not there
+    """
+    if option not in command[:-1]:
+        return None
+    return command[command.index(option) + 1]
+
+
+def portable(job):
+    """
+    Tell if a job can run elsewhere: a plain HandBrakeCLI run on a staged
+    image. Jobs reading a drive or encoding in segments stay local.
+
+    job: a job row of encode_queue.EncodeQueue
+    """
+    command = json.loads(job['command'])
+    return os.path.isfile(job['source']) and '--' not in command \
+        and option_value(command, '-i') == job['source'] \
+        and option_value(command, '-o') == job['outfile']
+
+
+def upload_file(job):
+    """
+    Where the result of a remote job is uploaded to, next to its outfile
+    """
+    return os.path.join(os.path.dirname(job['outfile']),
+                        '.' + os.path.basename(job['outfile']) + '.upload')
+
+
+def file_sha256(path):
+    """
+    returns the hex sha256 of a file
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as path_fh:
+        for chunk in iter(lambda: path_fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    The coordinator's side of the protocol
+    """
+
+    coordinator = None
+
+    def reply(self, status, data=None, body=None, headers=()):
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body or b'')))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def held_job(self, job_id):
+        """
+        returns the job if the requesting worker holds it, None otherwise
+        """
+        job = self.coordinator.queue.get(job_id)
+        if job is None or job['worker'] != self.headers.get('X-Worker') \
+                or job['state'] != encode_queue.RUNNING:
+            return None
+        return job
+
+    def authorized(self):
+        token = self.coordinator.token
+        if token and not hmac.compare_digest(self.headers.get('X-Token', ''), token):
+            self.reply(403, {'error': 'wrong token'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        match = JOB_PATH.match(self.path)
+        if match is None or match.group(2) not in ('source', 'result'):
+            self.send_error(404)
+            return
+        job = self.held_job(int(match.group(1)))
+        if job is None:
+            self.reply(409, {'error': 'job lost'})
+        elif match.group(2) == 'result':
+            upload = upload_file(job)
+            self.reply(200, {'size': os.path.getsize(upload) if os.path.exists(upload) else 0})
+        else:
+            self.send_source(job)
+
+    def send_source(self, job):
+        size = os.path.getsize(job['source'])
+        start, end = 0, size - 1
+        byte_range = RANGE.match(self.headers.get('Range', ''))
+        if byte_range:
+            start = int(byte_range.group(1))
+            if byte_range.group(2):
+                end = min(int(byte_range.group(2)), end)
+        if start > end:
+            self.reply(416, {'size': size})
+            return
+        with open(job['source'], 'rb') as source_fh:
+            source_fh.seek(start)
+            data = source_fh.read(min(end - start + 1, CHUNK_SIZE))
+        self.reply(206, body=data, headers=[
+            ('Content-Range', 'bytes ' + str(start) + '-' + str(start + len(data) - 1) + '/'
+             + str(size))])
+
+    def do_PUT(self):
+        if not self.authorized():
+            return
+        match = JOB_PATH.match(self.path)
+        if match is None or match.group(2) != 'result':
+            self.send_error(404)
+            return
+        data = self.body()
+        job = self.held_job(int(match.group(1)))
+        if job is None:
+            self.reply(409, {'error': 'job lost'})
+            return
+        upload = upload_file(job)
+        size = os.path.getsize(upload) if os.path.exists(upload) else 0
+        if int(self.headers.get('X-Offset', -1)) != size:
+            self.reply(416, {'size': size})
+            return
+        with open(upload, 'ab') as upload_fh:
+            upload_fh.write(data)
+        self.reply(200, {'size': size + len(data)})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        try:
+            data = json.loads(self.body().decode('utf-8') or '{}')
+        except ValueError:
+            self.reply(400, {'error': 'not json'})
+            return
+        if self.path == '/claim':
+            job = self.coordinator.claim(data.get('worker') or self.client_address[0])
+            if job is None:
+                self.reply(204)
+            else:
+                self.reply(200, job)
+            return
+        match = JOB_PATH.match(self.path)
+        if match is None or match.group(2) not in ('heartbeat', 'finish'):
+            self.send_error(404)
+            return
+        job_id = int(match.group(1))
+        if match.group(2) == 'heartbeat':
+            if self.coordinator.queue.renew(job_id, data.get('worker'), self.coordinator.lease):
+                self.reply(200, {'lease': self.coordinator.lease})
+            else:
+                self.reply(409, {'error': 'job lost'})
+            return
+        job = self.held_job(job_id)
+        if job is None:
+            self.reply(409, {'error': 'job lost'})
+            return
+        status, reply = self.coordinator.finish(job, data)
+        self.reply(status, reply)
+
+    def log_message(self, format, *args):
+        LOGGER.debug('coordinator: ' + format, *args)
+
+
+class Coordinator(object):
+    """
+    Hands out the jobs of an encode queue to remote workers
+    """
+
+    def __init__(self, queue, token='', lease=60):
+        """
+        queue: an encode_queue.EncodeQueue
+        token: shared secret workers must send. optional
+        lease: seconds a worker may stay silent before its job is taken away
+        """
+        self.queue = queue
+        self.token = token
+        self.lease = lease
+        self.server = None
+
+    def claim(self, worker):
+        """
+        Take the oldest job that can run elsewhere for worker
+
+        returns what the worker needs to know about the job, None if there is none
+        """
+        self.queue.expire_leases()
+        job = self.queue.claim(accept=portable, worker=worker, lease=self.lease)
+        if job is None:
+            return None
+        upload = upload_file(job)
+        if os.path.exists(upload):
+            os.unlink(upload)
+        LOGGER.info('Job %s %s taken by %s', job['id'], job['outfile'], worker)
+        return {
+            'id': job['id'],
+            'command': json.loads(job['command']),
+            'source': job['source'],
+            'source_size': os.path.getsize(job['source']),
+            'outfile': job['outfile'],
+            'lease': self.lease,
+        }
+
+    def finish(self, job, report):
+        """
+        Put the uploaded result of a job in place and record the outcome
+
+        job: the job row
+        report: what the worker sent
+
+        returns the http status and the reply
+        """
+        upload = upload_file(job)
+        returncode = report.get('returncode', 1)
+        if returncode == 0:
+            size = os.path.getsize(upload) if os.path.exists(upload) else 0
+            if size != report.get('size') or file_sha256(upload) != report.get('sha256'):
+                LOGGER.warning('Upload of job %s by %s is damaged, %s bytes', job['id'],
+                               job['worker'], size)
+                if os.path.exists(upload):
+                    os.unlink(upload)
+                return 400, {'error': 'upload damaged', 'size': 0}
+            os.rename(upload, job['outfile'])
+        elif os.path.exists(upload):
+            os.unlink(upload)
+        self.queue.finish(job, returncode, scheduler.current_preset(json.loads(job['command'])),
+                          report.get('fps'), worker=job['worker'], max_rss=report.get('max_rss'),
+                          retry=report.get('stalled', False))
+        return 200, {}
+
+    def expire_forever(self):
+        while True:
+            time.sleep(max(1, self.lease / 4.0))
+            try:
+                self.queue.expire_leases()
+            except Exception:
+                LOGGER.exception('Could not expire leases')
+
+    def serve(self, port, address='0.0.0.0'):
+        """
+        Serve workers from background threads
+
+        port: tcp port, 0 picks a free one
+        address: to listen on. Without a token, only a loopback address is
+            allowed, anyone else could take jobs
+
+        returns the server, its port is server.server_address[1]
+        """
+        if not self.token and address not in LOOPBACK_ADDRESSES:
+            raise ValueError('Refusing to coordinate on ' + address + ' without a token')
+        handler = type('CoordinatorHandler', (Handler,), {'coordinator': self})
+        self.server = http.server.ThreadingHTTPServer((address, port), handler)
+        for target, name in ((self.server.serve_forever, 'coordinator-http'),
+                             (self.expire_forever, 'coordinator-leases')):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+        LOGGER.info('Coordinating remote encodes on %s:%s', address, self.server.server_address[1])
+        return self.server
+
+
+class Worker(object):
+    """
+    Takes jobs from a coordinator and encodes them here
+    """
+
+    def __init__(self, coordinator, work_dir, handbrakecli='/bin/HandBrakeCLI', name=None,
+                 token='', stall_timeout=supervisor.STALL_TIMEOUT):
+        """
+        coordinator: url of the coordinator, e.g. http://drivehost:8765
+        work_dir: where images and results are kept while working on them
+        handbrakecli: the HandBrakeCLI of this machine
+        name: how the worker calls itself, defaults to host name and pid
+        token: see Coordinator
+        stall_timeout: seconds an encode may go without progress, see
+            supervisor.run. The coordinator queues a stalled job again.
+        """
+        self.coordinator = coordinator.rstrip('/')
+        self.work_dir = work_dir
+        self.handbrakecli = handbrakecli
+        self.name = name or socket.gethostname() + '-' + str(os.getpid())
+        self.token = token
+        self.stall_timeout = stall_timeout
+        self.download_lock = threading.Lock()
+        # images in use by running jobs, with the number of jobs
+        self.in_use = {}
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+
+    def call(self, method, path, data=None, body=None, headers=None):
+        """
+        Make a request to the coordinator, retrying on network errors
+
+        returns the status and the body of the reply
+        raises LeaseLost on 409, WorkerError if the coordinator cannot be reached
+        """
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+        all_headers = {'X-Worker': self.name, 'X-Token': self.token}
+        all_headers.update(headers or {})
+        for attempt in range(RETRIES):
+            request = urllib.request.Request(self.coordinator + path, data=body,
+                                             headers=all_headers, method=method)
+            try:
+                with urllib.request.urlopen(request, timeout=60) as response:
+                    return response.status, response.read()
+            except urllib.error.HTTPError as error:
+                if error.code == 409:
+                    raise LeaseLost(path)
+                if error.code < 500:
+                    return error.code, error.read()
+                reason = 'HTTP ' + str(error.code)
+            except (urllib.error.URLError, OSError) as error:
+                reason = str(error)
+            LOGGER.warning('%s %s failed (%s), attempt %s of %s', method, path, reason,
+                           attempt + 1, RETRIES)
+            time.sleep(min(2 ** attempt, 30))
+        raise WorkerError('Coordinator ' + self.coordinator + ' unreachable')
+
+    def claim(self):
+        """
+        returns the next job, None if there is none
+        """
+        status, body = self.call('POST', '/claim', {'worker': self.name})
+        if status == 204:
+            return None
+        if status != 200:
+            raise WorkerError('Claiming a job failed with HTTP ' + str(status))
+        return json.loads(body.decode('utf-8'))
+
+    def download(self, job):
+        """
+        Fetch the image of a job, continuing a download that was interrupted.
+        Images no job uses anymore are kept until another image is needed,
+        the next title of the same disc is usually encoded next.
+        Call release when done with the image.
+
+        returns the local path of the image
+        """
+        key = hashlib.sha256((job['source'] + ':' + str(job['source_size'])).encode('utf-8'))
+        local = os.path.join(self.work_dir, key.hexdigest()[:16] + '.iso')
+        with self.download_lock:
+            self.in_use[local] = self.in_use.get(local, 0) + 1
+            if os.path.exists(local):
+                return local
+            for name in os.listdir(self.work_dir):
+                path = os.path.join(self.work_dir, name)
+                if name.endswith('.iso') and path not in self.in_use \
+                        or name.endswith('.iso.part') and path[:-5] not in self.in_use:
+                    os.unlink(path)
+            part = local + '.part'
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            LOGGER.info('Downloading %s (%s bytes) from %s', job['source'], job['source_size'],
+                        offset)
+            with open(part, 'ab') as part_fh:
+                while offset < job['source_size']:
+                    status, data = self.call(
+                        'GET', '/jobs/' + str(job['id']) + '/source',
+                        headers={'Range': 'bytes=' + str(offset) + '-'
+                                 + str(offset + CHUNK_SIZE - 1)})
+                    if status != 206 or not data:
+                        raise WorkerError('Downloading ' + job['source'] + ' failed with HTTP '
+                                          + str(status))
+                    part_fh.write(data)
+                    offset += len(data)
+            os.rename(part, local)
+        return local
+
+    def release(self, local):
+        """
+        Tell that a job is done with an image returned by download
+        """
+        with self.download_lock:
+            self.in_use[local] -= 1
+            if not self.in_use[local]:
+                del self.in_use[local]
+
+    def upload(self, job, result):
+        """
+        Send the result of a job, continuing where the coordinator stopped
+        receiving it
+        """
+        path = '/jobs/' + str(job['id']) + '/result'
+        size = os.path.getsize(result)
+        status, body = self.call('GET', path)
+        offset = json.loads(body.decode('utf-8'))['size'] if status == 200 else 0
+        with open(result, 'rb') as result_fh:
+            # at least one chunk, even if empty, so the coordinator has a file
+            while True:
+                result_fh.seek(offset)
+                chunk = result_fh.read(CHUNK_SIZE)
+                status, body = self.call('PUT', path, body=chunk,
+                                         headers={'X-Offset': str(offset)})
+                if status not in (200, 416):
+                    raise WorkerError('Uploading ' + result + ' failed with HTTP ' + str(status))
+                # 416: the coordinator has a different part, go on from there
+                offset = json.loads(body.decode('utf-8'))['size']
+                if offset >= size:
+                    break
+
+    def local_command(self, job, source, result):
+        """
+        The command of job, run with this machine's HandBrakeCLI and files
+        """
+        command = list(job['command'])
+        command[0] = self.handbrakecli
+        command[command.index('-i') + 1] = source
+        command[command.index('-o') + 1] = result
+        return command
+
+    def heartbeat(self, job, state):
+        """
+        Renew the lease on job until state['done'] is set. If the job was
+        lost, the encode is stopped.
+        """
+        interval = max(0.1, job['lease'] / 3.0)
+        while not state['done'].wait(interval):
+            try:
+                self.call('POST', '/jobs/' + str(job['id']) + '/heartbeat',
+                          {'worker': self.name, 'percent': state['percent']})
+            except LeaseLost:
+                LOGGER.warning('Lost job %s to another worker', job['id'])
+                state['lost'] = True
+                if state['process'] is not None:
+                    supervisor.stop(state['process'])
+                return
+            except WorkerError as error:
+                LOGGER.warning('%s', error)
+
+    def run_job(self, job):
+        """
+        Download, encode and upload a single job, and report how it went
+        """
+        state = {'done': threading.Event(), 'process': None, 'percent': 0.0, 'lost': False}
+        beat = threading.Thread(target=self.heartbeat, args=(job, state),
+                                name='heartbeat-' + str(job['id']))
+        beat.daemon = True
+        beat.start()
+        result = os.path.join(self.work_dir, str(job['id']) + '-' + os.path.basename(job['outfile']))
+        source = None
+        try:
+            source = self.download(job)
+            returncode, fps, max_rss, stalled = self.encode(
+                job, self.local_command(job, source, result), state)
+            if state['lost']:
+                raise LeaseLost(str(job['id']))
+            report = {'worker': self.name, 'returncode': returncode, 'fps': fps,
+                      'max_rss': max_rss, 'stalled': stalled}
+            if returncode == 0:
+                self.upload(job, result)
+                report.update(size=os.path.getsize(result), sha256=file_sha256(result))
+            status, body = self.call('POST', '/jobs/' + str(job['id']) + '/finish', report)
+            if status != 200:
+                raise WorkerError('Finishing job ' + str(job['id']) + ' failed: '
+                                  + body.decode('utf-8', 'replace'))
+            LOGGER.info('Job %s finished with %s', job['id'], returncode)
+        finally:
+            state['done'].set()
+            if source is not None:
+                self.release(source)
+            if os.path.exists(result):
+                os.unlink(result)
+
+    def encode(self, job, command, state):
+        """
+        Run the encode of a job, keeping state['percent'] up to date and
+        the process in state['process'], so the heartbeat can stop it
+
+        returns the exit code, the average fps, the peak memory in bytes
+        and whether the encode was stopped as it stalled
+        """
+        progress = metrics.HandbrakeProgress(job=os.path.basename(job['outfile']))
+
+        def on_start(process):
+            state['process'] = process
+            if state['lost']:
+                supervisor.stop(process)
+
+        def on_line(line):
+            progress(line)
+            parsed = metrics.parse_handbrake(line)
+            if parsed is not None:
+                state['percent'] = parsed['percent']
+        LOGGER.info('Encoding job %s: %s', job['id'], ' '.join(command))
+        try:
+            with metrics.timed('encode'):
+                result = supervisor.run(command, stall_timeout=self.stall_timeout,
+                                        on_line=on_line, on_start=on_start)
+        except OSError as error:
+            LOGGER.warning('Could not execute %s: %s', command[0], error)
+            return 127, progress.avg_fps, None, False
+        finally:
+            progress.finish()
+        return (result.returncode, progress.avg_fps, result.max_rss,
+                result.stopped == supervisor.STALLED)
+
+    def run(self, once=False):
+        """
+        Work on jobs forever
+
+        once: stop as soon as there is nothing to do
+        """
+        while True:
+            try:
+                job = self.claim()
+            except WorkerError as error:
+                LOGGER.warning('%s', error)
+                job = None
+            if job is None:
+                if once:
+                    return
+                time.sleep(POLL_INTERVAL)
+                continue
+            try:
+                self.run_job(job)
+            except LeaseLost:
+                LOGGER.warning('Gave up job %s, it was taken away', job['id'])
+            except (WorkerError, IOError, OSError) as error:
+                # the lease runs out and someone else gets the job
+                LOGGER.warning('Job %s failed: %s', job['id'], error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Encode jobs of an auto_copy coordinator')
+    parser.add_argument('--coordinator', required=True, help='e.g. http://drivehost:8765')
+    parser.add_argument('--work-dir', default='/var/tmp/auto_copy_worker')
+    parser.add_argument('--handbrakecli', default='/bin/HandBrakeCLI')
+    parser.add_argument('--name', help='name of this worker, defaults to host name and pid')
+    parser.add_argument('--token', default=os.environ.get('AUTO_COPY_TOKEN', ''),
+                        help='shared secret, also read from AUTO_COPY_TOKEN')
+    parser.add_argument('--jobs', type=int, default=1, help='jobs encoded at the same time')
+    parser.add_argument('--once', action='store_true', help='exit when there is nothing to do')
+    parser.add_argument('--stall-timeout', type=int, default=supervisor.STALL_TIMEOUT,
+                        help='seconds an encode may go without progress, 0 for no limit')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s %(threadName)s %(message)s')
+    worker = Worker(args.coordinator, args.work_dir, args.handbrakecli, args.name, args.token,
+                    args.stall_timeout)
+    threads = [threading.Thread(target=worker.run, args=(args.once,), name='job-' + str(num))
+               for num in range(args.jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+hb_worker.py
+Runs HandBrakeCLI for the host, inside a container that keeps running,
+instead of starting a new container for every scan and every title.
+
+Jobs are handed over in a spool directory, shared with the host under the
+same path:
+
+    new/<id>.json       a job, {"args": [...], "limits": {...}}, written by the host client
+    running/<id>.json   a job being run, moved there by the worker taking it
+    <id>.out, <id>.err  stdout and stderr of HandBrakeCLI, as they come
+    <id>.cancel         created by the client to stop the job
+    done/<id>.json      {"returncode": N}, written when the job is finished
+    worker.alive        touched every few seconds while the worker lives
+
+The host side is hb_client.py, which behaves like HandBrakeCLI itself.
+The priority and limits of a job are applied here with nice, ionice,
+taskset and prlimit, whichever the container has. cpus the container
+cannot use are left out. Limit the container itself with docker run
+--cpus and --memory for a cap on all jobs together.
+
+    hb_worker.py --spool /var/spool/handbrake --workers 2
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+LOGGER = logging.getLogger('hb_worker')
+
+# seconds between looks into the spool directory
+POLL_INTERVAL = 0.2
+
+# seconds between touches of worker.alive
+HEARTBEAT_INTERVAL = 2
+
+
+def write_json(path, data):
+    """
+    Write data to path atomically
+    """
+    with open(path + '.tmp', 'w') as json_fh:
+        json.dump(data, json_fh)
+    os.rename(path + '.tmp', path)
+
+
+def limit_prefix(limits):
+    """
+    The argument list to put in front of HandBrakeCLI to apply the limits
+    of a job. Tools the container lacks are left out.
+
+    limits: dict with the optional keys nice, idle_io, cpus (list of cpu
+        numbers), memory_mb and cpu_seconds
+    """
+    prefix = []
+    if limits.get('nice') and shutil.which('nice'):
+        prefix.extend([shutil.which('nice'), '-n', str(limits['nice'])])
+    if limits.get('idle_io') and shutil.which('ionice'):
+        prefix.extend([shutil.which('ionice'), '-c', '3', '-t'])
+    cpus = sorted(set(limits.get('cpus') or []) & os.sched_getaffinity(0))
+    if cpus and shutil.which('taskset'):
+        prefix.extend([shutil.which('taskset'), '-c', ','.join(str(cpu) for cpu in cpus)])
+    rlimits = []
+    if limits.get('memory_mb'):
+        rlimits.append('--as=' + str(limits['memory_mb'] * 1024 * 1024))
+    if limits.get('cpu_seconds'):
+        rlimits.append('--cpu=' + str(limits['cpu_seconds']))
+    if rlimits and shutil.which('prlimit'):
+        prefix.extend([shutil.which('prlimit')] + rlimits)
+    elif rlimits:
+        LOGGER.warning('prlimit not found, not limiting %s', ' '.join(rlimits))
+    return prefix
+
+
+class Worker(object):
+    """
+    Takes jobs from the spool directory and runs them
+    """
+
+    def __init__(self, spool, handbrakecli='HandBrakeCLI'):
+        self.spool = spool
+        self.handbrakecli = handbrakecli
+        self.stopped = threading.Event()
+        for sub_dir in ('new', 'running', 'done'):
+            if not os.path.isdir(os.path.join(spool, sub_dir)):
+                os.makedirs(os.path.join(spool, sub_dir))
+        self.recover()
+
+    def recover(self):
+        """
+        Fail the jobs a previous worker was running when it stopped
+        """
+        for name in os.listdir(os.path.join(self.spool, 'running')):
+            if name.endswith('.json'):
+                LOGGER.info('Failing interrupted job %s', name[:-5])
+                self.finish(name[:-5], 1)
+
+    def claim(self):
+        """
+        Take the oldest new job. Renaming is atomic, so of several workers
+        only one gets it.
+
+        returns the job id and the job, None if there is nothing to do
+        """
+        new_dir = os.path.join(self.spool, 'new')
+        names = [name for name in os.listdir(new_dir) if name.endswith('.json')]
+        names.sort(key=lambda name: os.path.getmtime(os.path.join(new_dir, name))
+                   if os.path.exists(os.path.join(new_dir, name)) else 0)
+        for name in names:
+            running = os.path.join(self.spool, 'running', name)
+            try:
+                os.rename(os.path.join(new_dir, name), running)
+            except OSError:
+                continue
+            with open(running, 'r') as job_fh:
+                return name[:-5], json.load(job_fh)
+        return None
+
+    def run_job(self, job_id, job):
+        """
+        Run HandBrakeCLI for a job, stopping it if the client cancels
+
+        returns the exit code
+        """
+        base = os.path.join(self.spool, job_id)
+        command = limit_prefix(job.get('limits') or {}) + [self.handbrakecli] + job['args']
+        LOGGER.info('Job %s: %s', job_id, ' '.join(command))
+        with open(base + '.out', 'wb') as out_fh, open(base + '.err', 'wb') as err_fh:
+            try:
+                process = subprocess.Popen(command, stdout=out_fh,
+                                           stderr=err_fh, stdin=subprocess.DEVNULL)
+            except OSError as error:
+                err_fh.write((str(error) + '\n').encode('utf-8'))
+                return 127
+            while process.poll() is None:
+                if os.path.exists(base + '.cancel'):
+                    LOGGER.info('Job %s cancelled', job_id)
+                    process.terminate()
+                    try:
+                        process.wait(10)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                    break
+                time.sleep(POLL_INTERVAL)
+            return process.wait()
+
+    def finish(self, job_id, returncode):
+        """
+        Report the exit code of a job and forget about it. Nobody waits
+        for a cancelled job, its output is removed right away.
+        """
+        base = os.path.join(self.spool, job_id)
+        if os.path.exists(base + '.cancel'):
+            for suffix in ('.out', '.err', '.cancel'):
+                if os.path.exists(base + suffix):
+                    os.unlink(base + suffix)
+        else:
+            write_json(os.path.join(self.spool, 'done', job_id + '.json'),
+                       {'returncode': returncode})
+        os.unlink(os.path.join(self.spool, 'running', job_id + '.json'))
+        LOGGER.info('Job %s finished with %s', job_id, returncode)
+
+    def run(self):
+        """
+        Worker loop, until stopped is set
+        """
+        while not self.stopped.is_set():
+            claimed = self.claim()
+            if claimed is None:
+                self.stopped.wait(POLL_INTERVAL)
+                continue
+            job_id, job = claimed
+            try:
+                returncode = self.run_job(job_id, job)
+            except Exception:
+                LOGGER.exception('Job %s crashed', job_id)
+                returncode = 1
+            self.finish(job_id, returncode)
+
+
+def heartbeat(spool):
+    """
+    Tell clients a worker is alive, forever
+    """
+    alive = os.path.join(spool, 'worker.alive')
+    while True:
+        with open(alive, 'a'):
+            os.utime(alive, None)
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run HandBrakeCLI jobs from a spool directory')
+    parser.add_argument('--spool', default='/var/spool/handbrake')
+    parser.add_argument('--workers', type=int, default=2, help='jobs run at the same time')
+    parser.add_argument('--handbrakecli', default='HandBrakeCLI')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s %(threadName)s %(message)s')
+    worker = Worker(args.spool, args.handbrakecli)
+    for num in range(args.workers):
+        thread = threading.Thread(target=worker.run, name='job-' + str(num))
+        thread.daemon = True
+        thread.start()
+    LOGGER.info('Waiting for jobs in %s with %s workers', args.spool, args.workers)
+    heartbeat(args.spool)
+
+if __name__ == '__main__':
+    sys.exit(main())
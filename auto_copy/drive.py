@@ -0,0 +1,176 @@
+"""
+drive.py
+Talk to optical drives directly: status ioctls and kernel uevents.
+This is what trayopen.c does, without the need for an external binary.
+"""
+
+import fcntl
+import logging
+import os
+import socket
+import struct
+import time
+
+LOGGER = logging.getLogger('auto_copy')
+
+# from linux/cdrom.h
+CDROM_DRIVE_STATUS = 0x5326
+CDROM_DISC_STATUS = 0x5327
+CDSL_CURRENT = 0x7fffffff
+CDROMREADTOCHDR = 0x5305
+CDROMREADTOCENTRY = 0x5306
+CDROM_LBA = 0x01
+CDROM_LEADOUT = 0xAA
+CDROM_DATA_TRACK = 0x04
+
+# audio CDs have 75 sectors of 2352 bytes per second
+CD_FRAMES = 75
+CD_FRAMESIZE_RAW = 2352
+
+CDS_NO_INFO = 0
+CDS_NO_DISC = 1
+CDS_TRAY_OPEN = 2
+CDS_DRIVE_NOT_READY = 3
+CDS_DISC_OK = 4
+
+CDS_AUDIO = 100
+CDS_DATA_1 = 101
+CDS_DATA_2 = 102
+CDS_XA_2_1 = 103
+CDS_XA_2_2 = 104
+CDS_MIXED = 105
+
+STATUS_NAMES = {
+    CDS_NO_INFO: 'no info',
+    CDS_NO_DISC: 'no disc',
+    CDS_TRAY_OPEN: 'tray open',
+    CDS_DRIVE_NOT_READY: 'drive not ready',
+    CDS_DISC_OK: 'disc ok',
+}
+
+# from linux/netlink.h
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+
+
+def drive_status(device):
+    """
+    Ask the drive about its status. Images are always ready.
+
+    device: path to the device, e.g. /dev/sr0
+
+    returns one of the CDS_* constants, raises OSError if device is no optical drive
+    """
+    if os.path.isfile(device):
+        return CDS_DISC_OK
+    fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        return fcntl.ioctl(fd, CDROM_DRIVE_STATUS, CDSL_CURRENT)
+    finally:
+        os.close(fd)
+
+
+def disc_status(device):
+    """
+    Ask the drive what kind of disc it holds, based on the TOC
+
+    device: path to the device
+
+    returns one of the CDS_* constants, None for images,
+    raises OSError if device is no optical drive
+    """
+    if os.path.isfile(device):
+        return None
+    fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        return fcntl.ioctl(fd, CDROM_DISC_STATUS)
+    finally:
+        os.close(fd)
+
+
+def read_toc(device):
+    """
+    Read the table of contents of a CD
+
+    device: path to the device
+
+    returns a list of tuples (track number, first sector, number of sectors,
+    True for audio tracks), raises OSError if device is no optical drive
+    """
+    fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        first, last = struct.unpack('BB', fcntl.ioctl(fd, CDROMREADTOCHDR, b'\0' * 2))
+        entries = []
+        for track in list(range(first, last + 1)) + [CDROM_LEADOUT]:
+            # struct cdrom_tocentry: track, adr/ctrl nibbles, format, lba, datamode
+            request = struct.pack('BBBxiBxxx', track, 0, CDROM_LBA, 0, 0)
+            entry = fcntl.ioctl(fd, CDROMREADTOCENTRY, request)
+            adr_ctrl, start = struct.unpack('xBxxi4x', entry)
+            entries.append((track, start, not ((adr_ctrl >> 4) & CDROM_DATA_TRACK)))
+    finally:
+        os.close(fd)
+    toc = []
+    for (track, start, audio), (next_track, next_start, next_audio) in zip(entries, entries[1:]):
+        toc.append((track, start, next_start - start, audio))
+    return toc
+
+
+def wait_until_ready(device, timeout=30, interval=0.2):
+    """
+    Poll the drive until it made up its mind about the disc, instead of
+    sleeping for a fixed time after the tray was closed.
+
+    device: path to the device
+    timeout: give up after this many seconds
+    interval: seconds between two polls
+
+    returns the last status seen, raises OSError if device is no optical drive
+    """
+    start = time.time()
+    status = drive_status(device)
+    while status in (CDS_DRIVE_NOT_READY, CDS_NO_INFO) and time.time() - start < timeout:
+        time.sleep(interval)
+        status = drive_status(device)
+    LOGGER.debug('%s status after %ss: %s', device, round(time.time() - start, 1),
+                 STATUS_NAMES.get(status, str(status)))
+    return status
+
+
+def uevent_socket():
+    """
+    Open a netlink socket receiving the kernel's device events
+
+    returns a non blocking socket, or None if netlink is not available
+    """
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, UEVENT_GROUP_KERNEL))
+    except (AttributeError, OSError) as error:
+        LOGGER.info('Kernel uevents not available: %s', error)
+        return None
+    sock.setblocking(False)
+    return sock
+
+
+def parse_uevent(data):
+    """
+    Parse a kernel uevent message
+
+    data: the raw bytes received from the netlink socket
+
+    returns a dict of the event's properties
+    """
+    event = {}
+    for field in data.split(b'\0')[1:]:
+        key, sep, value = field.decode('utf-8', 'replace').partition('=')
+        if sep:
+            event[key] = value
+    return event
+
+
+def is_media_change(event):
+    """
+    Tell if a parsed uevent reports a change of an optical drive
+    """
+    return event.get('SUBSYSTEM') == 'block' and event.get('ACTION') == 'change' \
+        and event.get('DEVNAME', '').startswith('sr')
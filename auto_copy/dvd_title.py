@@ -9,12 +9,21 @@ Can be used as a standalone tool or as library.
 
 # 30-AUG-2018 - Isaac Hailperin <isaac.hailperin@gmail.com> - initial version
 
-from subprocess import PIPE, Popen
-import subprocess
-from imdb import IMDb
+import hashlib
 import logging
+import re
+import disc_fs
+import metadata_cache
+import supervisor
+import title_scan
 
-TMP_FILE = '/tmp/dvd_title.tmp'
+# volume names that say nothing about the movie
+GENERIC_LABELS = ['DVD', 'DVD_VIDEO', 'DVDVIDEO', 'DVDVOLUME', 'DVD_VOLUME', 'VIDEO_TS',
+                  'NO_LABEL', 'CDROM', 'VOLUME']
+
+# the VMG provider id, see http://dvd.sourceforge.net/dvdinfo/ifo.html
+PROVIDER_ID_OFFSET = 0x40
+PROVIDER_ID_LENGTH = 32
 
 ###
 # logging setup
@@ -26,68 +35,155 @@ LOG_LEVELS = {
     'error': logging.ERROR,
     'critical': logging.CRITICAL, }
 
-# default log level
-DEFAULT_LOG_LEVEL = 'debug'
+# log level when run standalone. As a library, the level and handlers of
+# the auto_copy logger apply.
+DEFAULT_LOG_LEVEL = 'info'
 
-# should shell command output be printed to stdout?
-DEBUG = True 
+LOGGER = logging.getLogger('auto_copy.dvd_title')
 
-# used for subprocess calls - print stdout and stderr if log level is debug
-if DEBUG:
-    DEV_ZERO = None
-else:
-    DEV_ZERO = open('/dev/zero', 'w')
 
-LOGGER = logging.getLogger('dvd_title')
-LOGGER.setLevel(LOG_LEVELS[DEFAULT_LOG_LEVEL])
+def normalize_title(label):
+    """
+    Turn a volume name like 'THE_BIG_MOVIE' into 'The Big Movie'
 
+    returns None for names that do not tell anything about the movie
+    """
+    label = label.strip().strip('\0')
+    if not label or label.upper() in GENERIC_LABELS:
+        return None
+    return re.sub(r'\s+', ' ', label.replace('_', ' ')).strip().title()
 
-def read_title(device='/dev/sr0', handbrakecli='/bin/HandBrakeCLI'):
-    "Read the title of the dvd, as printed by libdvdnav"
-    # invoking awk is a dirty hack, however there were strange characters in the handbrake
-    # output, which I could not get rid of. piping the output through awk did the trick
-    hb_command = [handbrakecli, ' --scan', '-i ', device]
-    LOGGER.debug('hb_command: ' + ' '.join(hb_command))
-    with open(TMP_FILE, 'w+') as tmp_file_fh:
-        subprocess.call(hb_command, stdout=tmp_file_fh, stderr=subprocess.STDOUT)
-    LOGGER.debug('Done with scanning')
 
-def read_title_old(device='/dev/sr0', handbrakecli='/bin/HandBrakeCLI'):
-    "Read the title of the dvd, as printed by libdvdnav"
-    # invoking awk is a dirty hack, however there were strange characters in the handbrake
-    # output, which I could not get rid of. piping the output through awk did the trick
-    hb_command = handbrakecli + ' --scan -i ' + device + " | awk -F: '/DVD Title/ {print $3}' "
-    LOGGER.debug('deterime title, hb_command: ' + hb_command)
-    process = Popen(hb_command, stdout=PIPE, shell=True)
-    while True:
-        line = process.stdout.readline()
-        if line == '' and process.poll() is not None:
-            break
-        if line:
-            dvd_title = line.title().replace('_', ' ').strip()
-            return dvd_title
-    return None
+def open_volume(device):
+    """
+    Read the file system of device, returns a disc_fs.Volume or None
+    """
+    try:
+        return disc_fs.Volume(device)
+    except (IOError, OSError, disc_fs.NoFileSystemException) as error:
+        LOGGER.debug('Could not read file system of %s: %s', device, error)
+        return None
 
-def get_year(movie_title):
-    "Get the year a movie title was published"
-    myimdb = IMDb()
-    # This search will most likely return multiple results.
-    # I have currently no other method to identify a dvd,
-    # so I am just using the first result in the hope that it
-    # has the highest likelyhood of being correct
-    movies = myimdb.search_movie(movie_title)
-    if movies:
-        return movies[0].get('year')
-    else:
+
+def ifo_files(volume):
+    """
+    Yield name and content of the IFO files libdvdread uses for its disc id:
+    VIDEO_TS.IFO and VTS_01_0.IFO up to VTS_09_0.IFO, as far as they exist
+    """
+    for title_set in range(10):
+        if title_set == 0:
+            name = 'VIDEO_TS/VIDEO_TS.IFO'
+        else:
+            name = 'VIDEO_TS/VTS_%02d_0.IFO' % title_set
+        entry = volume.find(name)
+        if entry is not None:
+            yield name, volume.read_file(entry)
+
+
+def disc_id(volume):
+    """
+    A stable id of a video DVD, computed like libdvdread's DVDDiscID:
+    the md5 sum over the first ten IFO files
+
+    volume: a disc_fs.Volume
+
+    returns the hex digest, None if there is no VIDEO_TS.IFO
+    """
+    md5 = hashlib.md5()
+    found = False
+    for name, content in ifo_files(volume):
+        md5.update(content)
+        found = True
+    volume.close()
+    if not found:
         return None
+    return md5.hexdigest()
+
+
+def read_native_title(device='/dev/sr0', volume=None):
+    """
+    Read the title straight from the disc: the volume name, or the provider
+    id of VIDEO_TS.IFO if the volume name is a generic one.
+
+    volume: a disc_fs.Volume of device, if it was read already
+    """
+    if volume is None:
+        volume = open_volume(device)
+        if volume is None:
+            return None
+    title = normalize_title(volume.volume_id or '')
+    if title is None:
+        entry = volume.find('VIDEO_TS/VIDEO_TS.IFO')
+        if entry is not None:
+            ifo = volume.read_file(entry)
+            provider_id = ifo[PROVIDER_ID_OFFSET:PROVIDER_ID_OFFSET + PROVIDER_ID_LENGTH]
+            title = normalize_title(provider_id.decode('latin-1'))
+    volume.close()
+    LOGGER.debug('Native title of %s: %s', device, title)
+    return title
+
+
+def read_title(device='/dev/sr0', handbrakecli='/bin/HandBrakeCLI', titles=None, volume=None,
+               timeout=supervisor.SCAN_TIMEOUT, env=None):
+    """
+    Read the title of the dvd. The file system is read directly; a
+    HandBrake scan is only used if that does not yield a title.
+
+    titles: result of title_scan.scan, if the disc was scanned already
+    volume: a disc_fs.Volume of device, if it was read already
+    timeout, env: see title_scan.scan
+    """
+    native_title = read_native_title(device=device, volume=volume)
+    if native_title:
+        return native_title
+    if titles is None:
+        titles = title_scan.scan(device, handbrakecli=handbrakecli, timeout=timeout, env=env)
+    LOGGER.debug('Done with scanning')
+    for title in titles:
+        if title.name and normalize_title(title.name):
+            return normalize_title(title.name)
+    return None
 
+def read_title_old(device='/dev/sr0', handbrakecli='/bin/HandBrakeCLI',
+                   timeout=supervisor.SCAN_TIMEOUT):
+    "Read the title of the dvd, as printed by libdvdnav"
+    hb_command = [handbrakecli, '--scan', '-i', device]
+    LOGGER.debug('deterime title, hb_command: %s', ' '.join(hb_command))
+    result = supervisor.run(hb_command, timeout=timeout, capture=True, quiet=True)
+    # the third field of e.g. "libdvdnav: DVD Title: THE_MOVIE", as awk -F: used to
+    for line in result.output.decode('utf-8', 'replace').splitlines():
+        if 'DVD Title' in line and len(line.split(':')) > 2:
+            return line.split(':')[2].title().replace('_', ' ').strip()
+    return None
 
-def title_with_year(device='/dev/sr0', handbrakecli='/bin/HandBrakeCLI'):
-    "get dvd title with year"
-    LOGGER.debug('device: ' + device + '; handbrakecli: ' + handbrakecli)
-    dvd_title = read_title(device=device, handbrakecli=handbrakecli)
+def get_year(movie_title, disc_id=None, metadata=None):
+    """
+    Get the year a movie title was published
+
+    disc_id: see disc_id, used as cache key. optional
+    metadata: a metadata_cache.MetadataLookup. Defaults to an uncached IMDb lookup
+    """
+    if metadata is None:
+        metadata = metadata_cache.MetadataLookup(metadata_cache.ImdbBackend())
+    return metadata.year(movie_title, disc_id=disc_id)
+
+
+def title_with_year(device='/dev/sr0', handbrakecli='/bin/HandBrakeCLI', titles=None,
+                    volume=None, metadata=None, timeout=supervisor.SCAN_TIMEOUT, env=None):
+    """
+    get dvd title with year
+
+    titles, volume, timeout, env: see read_title
+    metadata: see get_year
+    """
+    LOGGER.debug('device: %s; handbrakecli: %s', device, handbrakecli)
+    if volume is None:
+        volume = open_volume(device)
+    dvd_title = read_title(device=device, handbrakecli=handbrakecli, titles=titles,
+                           volume=volume, timeout=timeout, env=env)
     if dvd_title:
-        year = get_year(dvd_title)
+        year = get_year(dvd_title, disc_id=disc_id(volume) if volume else None,
+                        metadata=metadata)
     else:
         return None
     if year:
@@ -98,12 +194,12 @@ def title_with_year(device='/dev/sr0', handbrakecli='/bin/HandBrakeCLI'):
 def setup_logging():
     # create console handler
     ch = logging.StreamHandler()
-    ch.setLevel(LOG_LEVELS[DEFAULT_LOG_LEVEL])
     # create formatter and add it to the handlers
     ch_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     ch.setFormatter(ch_formatter)
     # add the handlers to LOGGER
     LOGGER.addHandler(ch)
+    LOGGER.setLevel(LOG_LEVELS[DEFAULT_LOG_LEVEL])
 
 def main():
     setup_logging()
@@ -0,0 +1,522 @@
+"""
+encode_queue.py
+A persistent queue of encode jobs, drained by a pool of worker threads.
+
+Every job is one HandBrakeCLI invocation (one title of one disc). Jobs and
+their state are kept in a small SQLite database, so a restart of the daemon
+continues where it stopped instead of encoding everything again.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+import scheduler
+import supervisor
+
+LOGGER = logging.getLogger('auto_copy')
+
+# job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT NOT NULL,
+    title INTEGER NOT NULL,
+    outfile TEXT NOT NULL,
+    command TEXT NOT NULL,
+    cleanup TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    returncode INTEGER,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    preset TEXT,
+    fps REAL,
+    worker TEXT,
+    lease REAL,
+    max_rss INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+
+# columns added after the first release, with their type
+ADDED_COLUMNS = [('duration', 'REAL'), ('preset', 'TEXT'), ('fps', 'REAL'),
+                 ('worker', 'TEXT'), ('lease', 'REAL'), ('max_rss', 'INTEGER')]
+
+# a job whose lease ran out, or that stalled, this often is not handed out again
+MAX_ATTEMPTS = 3
+
+# finished jobs per preset the speed of a preset is averaged over
+SPEED_HISTORY = 20
+
+
+# cores a single HandBrakeCLI keeps busy, x264 runs several threads
+THREADS_PER_ENCODE = 4
+
+
+def default_workers(threads_per_encode=THREADS_PER_ENCODE):
+    """
+    Number of parallel encodes if not configured: as many as keep the
+    cores busy without making the encodes compete for them
+    """
+    return max(1, (os.cpu_count() or 1) // threads_per_encode)
+
+
+class EncodeQueue(object):
+    """
+    Persistent encode jobs plus the worker threads running them.
+    """
+
+    def __init__(self, db_file, workers=0, recover=False, scheduler=None, on_done=None,
+                 timeout=0, stall_timeout=0, limits=None, accept=None, env=None):
+        """
+        Open (or create) the job database and start the workers.
+
+        db_file: path to the SQLite database
+        workers: number of jobs run in parallel. 0 means default_workers(),
+            None starts no workers at all - jobs can then only be run with run_now
+        recover: pick up jobs interrupted by a crash, see recover. Only the
+            daemon may do this, a manual run must not touch its running jobs.
+        scheduler: a scheduler.Scheduler choosing preset and priority of
+            each job. optional
+        on_done: called with the job row of every job that succeeded, e.g.
+            to move its output elsewhere. optional
+        timeout, stall_timeout: see supervisor.run. A job that stalled is
+            queued again, if it reads an image
+        limits: argument list capping the resources of a job, see
+            supervisor.limit_prefix. optional
+        accept: the workers only take jobs this callable returns True for,
+            see claim. A manual run sharing the database with the daemon
+            must leave the jobs of the daemon alone. optional
+        env: environment of the jobs, see supervisor.run. Defaults to ours
+        """
+        db_dir = os.path.dirname(db_file)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.db_file = db_file
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.upgrade()
+        self.scheduler = scheduler
+        self.on_done = on_done
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.limits = limits or []
+        self.accept = accept
+        self.env = env
+        self.db_lock = threading.Lock()
+        self.wakeup = threading.Condition()
+        # (job ids, callback) waiting for the jobs to finish, see when_finished
+        self.waiting = []
+        self.waiting_lock = threading.Lock()
+        if recover:
+            self.recover()
+        if workers == 0:
+            workers = default_workers()
+        self.workers = []
+        for num in range(workers or 0):
+            worker = threading.Thread(target=self.run, name='encoder-' + str(num))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        LOGGER.debug('Encode queue %s started with %s workers', db_file, len(self.workers))
+
+    def execute(self, sql, args=()):
+        """
+        Run a statement and commit it, returns the cursor
+        """
+        with self.db_lock:
+            cursor = self.db.execute(sql, args)
+            self.db.commit()
+            return cursor
+
+    def upgrade(self):
+        """
+        Add the columns a database from an older version lacks
+        """
+        columns = [row['name'] for row in self.db.execute('PRAGMA table_info(jobs)')]
+        for name, column_type in ADDED_COLUMNS:
+            if name not in columns:
+                self.db.execute('ALTER TABLE jobs ADD COLUMN ' + name + ' ' + column_type)
+        self.db.commit()
+
+    def recover(self):
+        """
+        Deal with jobs that were running when we last stopped. Jobs reading a
+        staged image are simply queued again. Jobs reading straight from a
+        drive are failed, as the disc may have been changed since.
+        """
+        for job in self.execute('SELECT * FROM jobs WHERE state = ?', (RUNNING,)).fetchall():
+            if os.path.isfile(job['source']):
+                LOGGER.info('Requeueing interrupted job %s %s', job['id'], job['outfile'])
+                self.execute('UPDATE jobs SET state = ?, worker = NULL, lease = NULL WHERE id = ?',
+                             (QUEUED, job['id']))
+            else:
+                LOGGER.info('Failing interrupted job %s %s', job['id'], job['outfile'])
+                self.execute('UPDATE jobs SET state = ?, finished = ? WHERE id = ?',
+                             (FAILED, time.time(), job['id']))
+
+    def insert(self, job, state, cleanup=None):
+        """
+        Store a new job
+
+        job: dict with keys source, title, outfile and command (argv list),
+            optionally duration (seconds of video)
+        state: initial state of the job
+        cleanup: file to remove once all jobs reading it are finished. optional
+
+        returns the id of the job
+        """
+        return self.execute(
+            'INSERT INTO jobs (source, title, outfile, command, cleanup, state, created, duration)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (job['source'], job['title'], job['outfile'], json.dumps(job['command']),
+             cleanup, state, time.time(), job.get('duration'))).lastrowid
+
+    def submit(self, jobs, cleanup=None):
+        """
+        Queue jobs for the workers
+
+        jobs: list of dicts, see insert
+        cleanup: see insert
+
+        returns the list of job ids. A job that was done before is not
+        queued again, the id of the earlier job is returned instead.
+        """
+        ids = []
+        for job in jobs:
+            job_id = self.done(job)
+            if job_id is None:
+                job_id = self.insert(job, QUEUED, cleanup)
+            ids.append(job_id)
+        LOGGER.info('Queued %s encode jobs, %s jobs waiting or running', len(ids), self.pending())
+        with self.wakeup:
+            self.wakeup.notify_all()
+        return ids
+
+    def run_now(self, jobs):
+        """
+        Record jobs and run them one after the other in the calling thread.
+        Used when reading straight from a drive, which must not be shared.
+
+        jobs: list of dicts, see insert
+
+        returns the list of job ids, see submit for jobs done before
+        """
+        ids = []
+        for job in jobs:
+            job_id = self.done(job)
+            if job_id is None:
+                job_id = self.insert(job, RUNNING)
+                self.execute('UPDATE jobs SET started = ? WHERE id = ?', (time.time(), job_id))
+                self.run_job(self.get(job_id))
+            ids.append(job_id)
+        return ids
+
+    def done(self, job):
+        """
+        Look for an earlier job that encoded the same title of the same
+        source to the same file, e.g. before a crash in the middle of a disc
+
+        job: dict, see insert
+
+        returns the id of that job, None if there is none
+        """
+        row = self.execute('SELECT id FROM jobs WHERE source = ? AND title = ? AND outfile = ?'
+                           ' AND state = ? ORDER BY id DESC LIMIT 1',
+                           (job['source'], job['title'], job['outfile'], DONE)).fetchone()
+        if row is None:
+            return None
+        LOGGER.info('Title %s of %s was encoded to %s by job %s already, skipping it',
+                    job['title'], job['source'], job['outfile'], row['id'])
+        return row['id']
+
+    def get(self, job_id):
+        """
+        Get a single job row
+        """
+        return self.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    def claim(self, accept=None, worker=None, lease=None):
+        """
+        Atomically take the oldest queued job
+
+        accept: only take jobs this callable returns True for. optional
+        worker: name of a remote worker taking the job, see distributed.py
+        lease: seconds the remote worker has to report back, see renew
+
+        returns a job row or None
+        """
+        with self.db_lock:
+            jobs = self.db.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id',
+                                   (QUEUED,)).fetchall()
+            for job in jobs:
+                if accept is not None and not accept(job):
+                    continue
+                # another process on the same database, e.g. a manual run
+                # next to the daemon, may have taken the job meanwhile
+                claimed = self.db.execute(
+                    'UPDATE jobs SET state = ?, started = ?, worker = ?, lease = ?'
+                    ' WHERE id = ? AND state = ?',
+                    (RUNNING, time.time(), worker, time.time() + lease if lease else None,
+                     job['id'], QUEUED)).rowcount == 1
+                self.db.commit()
+                if claimed:
+                    return job
+            return None
+
+    def renew(self, job_id, worker, lease):
+        """
+        Extend the lease of a remote worker on a job
+
+        returns False if the worker lost the job, e.g. to another worker
+        after its lease ran out
+        """
+        return self.execute('UPDATE jobs SET lease = ? WHERE id = ? AND worker = ? AND state = ?',
+                            (time.time() + lease, job_id, worker, RUNNING)).rowcount == 1
+
+    def expire_leases(self):
+        """
+        Take jobs away from remote workers that stopped reporting back.
+        They are queued again for anyone to pick up, unless this happened
+        MAX_ATTEMPTS times already.
+        """
+        expired = self.execute('SELECT * FROM jobs WHERE state = ? AND lease < ?',
+                               (RUNNING, time.time())).fetchall()
+        for job in expired:
+            state = QUEUED if job['attempts'] + 1 < MAX_ATTEMPTS else FAILED
+            LOGGER.warning('Worker %s stopped reporting on job %s %s, job %s', job['worker'],
+                           job['id'], job['outfile'], state)
+            with self.db_lock:
+                self.db.execute('UPDATE jobs SET state = ?, attempts = attempts + 1, worker = NULL,'
+                                ' lease = NULL, finished = ? WHERE id = ? AND state = ?',
+                                (state, time.time() if state == FAILED else None, job['id'],
+                                 RUNNING))
+                self.db.commit()
+                if state == FAILED:
+                    self.cleanup(job['cleanup'])
+        if expired:
+            self.call_finished()
+            with self.wakeup:
+                self.wakeup.notify_all()
+
+    def finish(self, job, returncode, preset=None, fps=None, worker=None, max_rss=None,
+               retry=False):
+        """
+        Record the outcome of a job and remove its image, if it was the last
+        one needing it
+
+        job: the job row
+        worker: the remote worker reporting, the job is only finished if it
+            still holds it
+        max_rss: peak memory of the job in bytes. optional
+        retry: queue a failed job again, unless it ran MAX_ATTEMPTS times
+
+        returns False if the job was not finished as the worker lost it
+        """
+        state = DONE if returncode == 0 else FAILED
+        if state == FAILED and retry and job['attempts'] + 1 < MAX_ATTEMPTS:
+            state = QUEUED
+        LOGGER.info('Job %s %s %s (exit code %s, preset %s, avg %s fps%s)', job['id'],
+                    job['outfile'], state, returncode, preset, fps,
+                    ', on ' + worker if worker else '')
+        # finishing the job and removing its image happen in one go, so
+        # nobody waiting for the job sees the image still around
+        with self.db_lock:
+            sql = 'UPDATE jobs SET state = ?, returncode = ?, attempts = attempts + 1,' \
+                ' finished = ?, preset = ?, fps = ?, max_rss = ?, lease = NULL WHERE id = ?'
+            args = (state, returncode, time.time() if state != QUEUED else None, preset, fps,
+                    max_rss, job['id'])
+            if worker is not None:
+                sql += ' AND worker = ? AND state = ?'
+                args += (worker, RUNNING)
+            if self.db.execute(sql, args).rowcount != 1:
+                self.db.commit()
+                return False
+            self.db.commit()
+            self.cleanup(job['cleanup'])
+        if state == DONE and self.on_done is not None:
+            self.on_done(job)
+        self.call_finished()
+        with self.wakeup:
+            self.wakeup.notify_all()
+        return True
+
+    def run_job(self, job):
+        """
+        Execute a job and record its outcome
+        """
+        command = json.loads(job['command'])
+        name = os.path.basename(command[0])
+        if self.scheduler is not None:
+            command, preset = self.scheduler.prepare(self, job, command)
+        else:
+            preset = scheduler.current_preset(command)
+        command = self.limits + command
+        LOGGER.debug('Executing job %s: %s', job['id'], ' '.join(command))
+        progress = metrics.HandbrakeProgress(job=os.path.basename(job['outfile']))
+        max_rss = None
+        stalled = False
+        try:
+            with metrics.timed('encode'):
+                result = supervisor.run(command, timeout=self.timeout,
+                                        stall_timeout=self.stall_timeout, on_line=progress,
+                                        name=name, env=self.env)
+            returncode = result.returncode
+            max_rss = result.max_rss
+            stalled = result.stopped == supervisor.STALLED
+        except OSError as error:
+            LOGGER.warning('Could not execute %s: %s', command[0], error)
+            returncode = 127
+        finally:
+            progress.finish()
+        # a hang is often over on the next try. Only workers take queued
+        # jobs, and a drive may hold another disc by then.
+        retry = stalled and bool(self.workers) and os.path.isfile(job['source'])
+        self.finish(job, returncode, preset, progress.avg_fps, max_rss=max_rss, retry=retry)
+
+    def cleanup(self, path):
+        """
+        Remove path if no unfinished job needs it anymore.
+        Must be called with db_lock held.
+        """
+        if not path:
+            return
+        unfinished = self.db.execute(
+            'SELECT COUNT(*) FROM jobs WHERE cleanup = ? AND state IN (?, ?)',
+            (path, QUEUED, RUNNING)).fetchone()[0]
+        if unfinished == 0 and os.path.exists(path):
+            LOGGER.debug('Removing %s', path)
+            os.unlink(path)
+
+    def pending(self):
+        """
+        Number of jobs queued or running
+        """
+        return self.execute('SELECT COUNT(*) FROM jobs WHERE state IN (?, ?)',
+                            (QUEUED, RUNNING)).fetchone()[0]
+
+    def count(self, ids, *states):
+        """
+        Number of the jobs with ids that are in one of states
+        """
+        if not ids:
+            return 0
+        return self.execute('SELECT COUNT(*) FROM jobs WHERE id IN ('
+                            + ', '.join('?' * len(ids)) + ') AND state IN ('
+                            + ', '.join('?' * len(states)) + ')',
+                            tuple(ids) + states).fetchone()[0]
+
+    def when_finished(self, ids, callback):
+        """
+        Call callback once none of the jobs with ids is queued or running
+        anymore, with True if all of them succeeded. This is kept in memory
+        only, callback is not called for jobs finished after a restart.
+        """
+        with self.waiting_lock:
+            self.waiting.append((list(ids), callback))
+        self.call_finished()
+
+    def call_finished(self):
+        """
+        Call the callbacks of when_finished whose jobs all finished
+        """
+        with self.waiting_lock:
+            finished = [entry for entry in self.waiting
+                        if not self.count(entry[0], QUEUED, RUNNING)]
+            for entry in finished:
+                self.waiting.remove(entry)
+        for ids, callback in finished:
+            try:
+                callback(self.count(ids, FAILED) == 0)
+            except Exception:
+                LOGGER.exception('Callback for jobs %s failed', ids)
+
+    def failures(self, source, since=0):
+        """
+        Number of jobs reading source that failed, of those started at
+        or after since
+        """
+        return self.execute('SELECT COUNT(*) FROM jobs WHERE source = ? AND state = ?'
+                            ' AND started >= ?', (source, FAILED, since)).fetchone()[0]
+
+    def unfinished(self, source):
+        """
+        The ids of the jobs reading source that are queued or running
+        """
+        return [row['id'] for row in self.execute(
+            'SELECT id FROM jobs WHERE source = ? AND state IN (?, ?) ORDER BY id',
+            (source, QUEUED, RUNNING)).fetchall()]
+
+    def backlog(self):
+        """
+        The video waiting to be encoded
+
+        returns the number of jobs queued or running and their length in
+        seconds. Jobs of unknown length count as scheduler.DEFAULT_JOB_SECONDS.
+        """
+        jobs, seconds = self.execute(
+            'SELECT COUNT(*), SUM(COALESCE(duration, ?)) FROM jobs WHERE state IN (?, ?)',
+            (scheduler.DEFAULT_JOB_SECONDS, QUEUED, RUNNING)).fetchone()
+        return jobs, seconds or 0
+
+    def preset_speeds(self):
+        """
+        returns a dict of preset to the average fps of its last SPEED_HISTORY
+        finished jobs
+        """
+        speeds = {}
+        for row in self.execute('SELECT preset, fps FROM jobs WHERE state = ? AND fps IS NOT NULL'
+                                ' AND preset IS NOT NULL ORDER BY finished DESC', (DONE,)):
+            fps = speeds.setdefault(row['preset'], [])
+            if len(fps) < SPEED_HISTORY:
+                fps.append(row['fps'])
+        return dict((preset, sum(fps) / len(fps)) for preset, fps in speeds.items())
+
+    def run(self):
+        """
+        Worker loop
+        """
+        while True:
+            job = self.claim(self.accept)
+            if job is None:
+                with self.wakeup:
+                    self.wakeup.wait(10)
+                continue
+            try:
+                self.run_job(job)
+            except Exception:
+                LOGGER.exception('Job %s crashed', job['id'])
+                # as in finish, the image goes in the same step, or it
+                # would stay around forever
+                with self.db_lock:
+                    self.db.execute('UPDATE jobs SET state = ?, finished = ?'
+                                    ' WHERE id = ? AND state = ?',
+                                    (FAILED, time.time(), job['id'], RUNNING))
+                    self.db.commit()
+                    self.cleanup(job['cleanup'])
+            finally:
+                self.call_finished()
+                with self.wakeup:
+                    self.wakeup.notify_all()
+
+    def join(self, ids):
+        """
+        Wait until none of the jobs with ids is queued or running anymore.
+        Jobs others submitted to the same queue are not waited for.
+        """
+        while self.count(ids, QUEUED, RUNNING):
+            with self.wakeup:
+                self.wakeup.wait(1)
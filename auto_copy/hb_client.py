@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+hb_client.py
+A stand-in for HandBrakeCLI that hands the work to the HandBrake worker
+container (docker/hb_worker.py) through its spool directory, instead of
+starting a container per call. Output and exit code are those of
+HandBrakeCLI in the container, so callers cannot tell the difference:
+
+    HANDBRAKE_SPOOL=/var/spool/handbrake hb_client.py -i /dev/sr0 --scan
+
+auto_copy uses it for every scan and encode if handbrake_spool is set.
+Paths in the arguments must be the same inside the container.
+
+Priority and limits put in front of the client, like nice or prlimit,
+would only reach the client. They are passed on in HANDBRAKE_LIMITS
+instead, a JSON object with the keys nice, idle_io, cpus, memory_mb and
+cpu_seconds, and applied to HandBrakeCLI by the worker.
+"""
+
+import json
+import os
+import signal
+import sys
+import time
+import uuid
+
+# seconds between looks at the output and the result
+POLL_INTERVAL = 0.1
+
+# a worker that did not touch worker.alive for this long is gone
+HEARTBEAT_TIMEOUT = 30
+
+# exit code if no worker is running, as docker run uses it for its own errors
+NO_WORKER = 125
+
+
+class NoWorkerError(Exception):
+    pass
+
+
+def worker_alive(spool):
+    """
+    Tell if a worker touched worker.alive lately
+    """
+    try:
+        return time.time() - os.path.getmtime(os.path.join(spool, 'worker.alive')) \
+            < HEARTBEAT_TIMEOUT
+    except OSError:
+        return False
+
+
+def submit(spool, args, limits=None):
+    """
+    Put a job into the spool directory
+
+    limits: dict of priority and limits of the job, see HANDBRAKE_LIMITS. optional
+
+    returns the id of the job
+    """
+    if not worker_alive(spool):
+        raise NoWorkerError('No HandBrake worker is running on ' + spool)
+    job_id = uuid.uuid4().hex
+    job_file = os.path.join(spool, 'new', job_id + '.json')
+    with open(job_file + '.tmp', 'w') as job_fh:
+        json.dump({'args': args, 'limits': limits or {}}, job_fh)
+    os.rename(job_file + '.tmp', job_file)
+    return job_id
+
+
+def relay(source, position, target):
+    """
+    Copy what was appended to source since position to target
+
+    returns the new position
+    """
+    try:
+        with open(source, 'rb') as source_fh:
+            source_fh.seek(position)
+            data = source_fh.read()
+    except (IOError, OSError):
+        return position
+    if data:
+        target.write(data)
+        target.flush()
+    return position + len(data)
+
+
+def wait(spool, job_id, stdout, stderr):
+    """
+    Pass on the output of a job until it is finished
+
+    returns its exit code
+    """
+    base = os.path.join(spool, job_id)
+    done = os.path.join(spool, 'done', job_id + '.json')
+    positions = [0, 0]
+    while True:
+        finished = os.path.exists(done)
+        positions = [relay(base + '.out', positions[0], stdout),
+                     relay(base + '.err', positions[1], stderr)]
+        if finished:
+            break
+        if not worker_alive(spool):
+            raise NoWorkerError('The HandBrake worker on ' + spool + ' went away')
+        time.sleep(POLL_INTERVAL)
+    with open(done, 'r') as done_fh:
+        returncode = json.load(done_fh)['returncode']
+    for path in (done, base + '.out', base + '.err', base + '.cancel'):
+        if os.path.exists(path):
+            os.unlink(path)
+    return returncode
+
+
+def cancel(spool, job_id):
+    """
+    Ask the worker to stop a job, or withdraw it if it did not start yet
+    """
+    try:
+        os.unlink(os.path.join(spool, 'new', job_id + '.json'))
+        return
+    except OSError:
+        pass
+    open(os.path.join(spool, job_id + '.cancel'), 'w').close()
+
+
+def main():
+    spool = os.environ.get('HANDBRAKE_SPOOL', '/var/spool/handbrake')
+    try:
+        limits = json.loads(os.environ.get('HANDBRAKE_LIMITS', '{}'))
+        job_id = submit(spool, sys.argv[1:], limits)
+
+        # killing the client, e.g. on a timeout, stops the job too
+        def stop(signum, frame):
+            cancel(spool, job_id)
+            raise SystemExit(128 + signum)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        return wait(spool, job_id, sys.stdout.buffer, sys.stderr.buffer)
+    except NoWorkerError as error:
+        sys.stderr.write('hb_client.py: ' + str(error) + '\n')
+        return NO_WORKER
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ingest_index.py
+Remember which discs and which file contents were ingested already, so
+re-inserted discs and files shared between discs are not copied twice.
+
+Files are identified by size and a cheap partial hash (beginning, middle
+and end of the file). Only if that matches an indexed file, the full
+sha256 is computed to be sure.
+
+Can be used as library, or to rebuild the index of an existing data_dir:
+
+    ingest_index.py rebuild /mnt/video/new
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+LOGGER = logging.getLogger('auto_copy')
+
+DEFAULT_INDEX_FILE = '/var/lib/auto_copy/ingest_index.sqlite'
+
+# bytes hashed at each of the three places of a partial hash
+PARTIAL_CHUNK = 64 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS discs (
+    fingerprint TEXT PRIMARY KEY,
+    label TEXT,
+    media_type TEXT,
+    ingested REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    partial TEXT NOT NULL,
+    full TEXT
+);
+CREATE INDEX IF NOT EXISTS files_size_partial ON files (size, partial);
+"""
+
+
+def partial_hash(path, size=None):
+    """
+    Hash the size and three chunks of a file: beginning, middle and end
+
+    path: the file
+    size: its size, if known already
+    """
+    if size is None:
+        size = os.path.getsize(path)
+    hasher = hashlib.sha256(str(size).encode('ascii'))
+    with open(path, 'rb') as file_fh:
+        for offset in sorted(set([0, max(0, size // 2 - PARTIAL_CHUNK // 2),
+                                  max(0, size - PARTIAL_CHUNK)])):
+            file_fh.seek(offset)
+            hasher.update(file_fh.read(PARTIAL_CHUNK))
+    return hasher.hexdigest()
+
+
+def full_hash(path):
+    """
+    sha256 of the whole file, as computed by copier while copying
+    """
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as file_fh:
+        while True:
+            chunk = file_fh.read(8 * 1024 * 1024)
+            if not chunk:
+                return hasher.hexdigest()
+            hasher.update(chunk)
+
+
+class IngestIndex(object):
+    """
+    The persistent index of ingested discs and files
+    """
+
+    def __init__(self, db_file=DEFAULT_INDEX_FILE):
+        """
+        db_file: path to the SQLite database
+        """
+        db_dir = os.path.dirname(db_file)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.db_file = os.path.abspath(db_file)
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.db_lock = threading.Lock()
+
+    def execute(self, sql, args=()):
+        """
+        Run a statement and commit it, returns the cursor
+        """
+        with self.db_lock:
+            cursor = self.db.execute(sql, args)
+            self.db.commit()
+            return cursor
+
+    def has_disc(self, fingerprint):
+        """
+        Tell if the disc with fingerprint was ingested already
+        """
+        return self.execute('SELECT 1 FROM discs WHERE fingerprint = ?',
+                            (fingerprint,)).fetchone() is not None
+
+    def add_disc(self, fingerprint, label=None, media_type=None):
+        """
+        Record a disc as ingested
+        """
+        self.execute('INSERT OR REPLACE INTO discs (fingerprint, label, media_type, ingested)'
+                     ' VALUES (?, ?, ?, ?)', (fingerprint, label, media_type, time.time()))
+
+    def add_file(self, path, size=None, partial=None, full=None):
+        """
+        Record a file in data_dir
+
+        path: path of the file
+        size, partial, full: size and hashes, computed if not given (full is
+            only stored if given, it is computed when needed)
+        """
+        if size is None:
+            size = os.path.getsize(path)
+        if partial is None:
+            partial = partial_hash(path, size)
+        self.execute('INSERT OR REPLACE INTO files (path, size, partial, full) VALUES (?, ?, ?, ?)',
+                     (os.path.abspath(path), size, partial, full))
+
+    def find_copy(self, path, size=None):
+        """
+        Look for an indexed file with the same content as path
+
+        path: a file, e.g. on a disc
+        size: its size, if known already
+
+        returns a tuple (path of the existing copy or None, partial hash, full hash
+        or None). The hashes can be passed on to add_file after copying.
+        """
+        if size is None:
+            size = os.path.getsize(path)
+        partial = partial_hash(path, size)
+        candidates = self.execute('SELECT path, full FROM files WHERE size = ? AND partial = ?',
+                                  (size, partial)).fetchall()
+        if not candidates:
+            return None, partial, None
+        # the partial hash matches, only the full content can tell for sure
+        full = full_hash(path)
+        for candidate, candidate_full in candidates:
+            if not os.path.exists(candidate):
+                # deleted, or still waiting for the mover to put it there.
+                # Only rebuild forgets it.
+                continue
+            if candidate_full is None:
+                candidate_full = full_hash(candidate)
+                self.execute('UPDATE files SET full = ? WHERE path = ?', (candidate_full, candidate))
+            if candidate_full == full:
+                return candidate, partial, full
+        return None, partial, full
+
+    def rebuild(self, data_dir):
+        """
+        Index every file in data_dir. Only partial hashes are computed,
+        full hashes follow when they are needed. Files no longer in data_dir
+        are forgotten.
+
+        returns the number of files indexed
+        """
+        count = 0
+        data_dir = os.path.abspath(data_dir)
+        with self.db_lock:
+            for (path,) in self.db.execute('SELECT path FROM files').fetchall():
+                if path.startswith(os.path.join(data_dir, '')) and not os.path.exists(path):
+                    self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+            for root, sub_folders, files in os.walk(data_dir):
+                for name in files:
+                    if name.startswith('.') and name.endswith('.part'):
+                        continue
+                    path = os.path.abspath(os.path.join(root, name))
+                    if path.startswith(self.db_file):
+                        continue
+                    size = os.path.getsize(path)
+                    self.db.execute('INSERT OR REPLACE INTO files (path, size, partial, full)'
+                                    ' VALUES (?, ?, ?, NULL)', (path, size, partial_hash(path, size)))
+                    count += 1
+                    if count % 1000 == 0:
+                        self.db.commit()
+                        LOGGER.info('Indexed %s files', count)
+            self.db.commit()
+        return count
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Maintain the auto_copy ingest index')
+    parser.add_argument('command', choices=['rebuild'])
+    parser.add_argument('data_dir', help='directory holding the ingested files')
+    parser.add_argument('--index', default=DEFAULT_INDEX_FILE, help='path of the index database')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    index = IngestIndex(args.index)
+    start = time.time()
+    count = index.rebuild(args.data_dir)
+    print('Indexed ' + str(count) + ' files in ' + str(round(time.time() - start, 1)) + 's')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
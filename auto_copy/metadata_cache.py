@@ -0,0 +1,240 @@
+"""
+metadata_cache.py
+Look up the year of a movie, with a persistent cache in front of the
+lookup backend. A lookup never takes longer than its time budget, so
+a slow or unreachable backend cannot hold up a rip.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+LOGGER = logging.getLogger('auto_copy')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    year INTEGER,
+    stored REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed);
+"""
+
+
+def normalize_key(title):
+    """
+    Cache key for a title: lower case, single spaces
+    """
+    return 'title:' + ' '.join(title.lower().split())
+
+
+class ImdbBackend(object):
+    """
+    Look up movies on IMDb. The client is only created on first use.
+    """
+
+    name = 'imdb'
+
+    def __init__(self):
+        self.client = None
+
+    def prepare(self):
+        """
+        Create the client, importing imdb takes a while
+        """
+        if self.client is None:
+            from imdb import IMDb
+            self.client = IMDb()
+
+    def year(self, title):
+        """
+        returns the year of the first search result, None if nothing was found
+        """
+        self.prepare()
+        # This search will most likely return multiple results.
+        # I have currently no other method to identify a dvd,
+        # so I am just using the first result in the hope that it
+        # has the highest likelyhood of being correct
+        movies = self.client.search_movie(title)
+        if movies:
+            return movies[0].get('year')
+        return None
+
+
+class LocalBackend(object):
+    """
+    Look up movies in a local yaml file mapping titles to years.
+    For offline operation and tests.
+    """
+
+    name = 'local'
+
+    def __init__(self, movies=None, movie_file=None):
+        """
+        movies: dict mapping titles to years. optional
+        movie_file: yaml file with such a dict. optional
+        """
+        self.movies = {}
+        if movie_file and os.path.exists(movie_file):
+            import yaml
+            with open(movie_file, 'r') as movie_fh:
+                movies = dict(yaml.safe_load(movie_fh) or {}, **(movies or {}))
+        for title, year in (movies or {}).items():
+            self.movies[normalize_key(title)] = year
+
+    def prepare(self):
+        pass
+
+    def year(self, title):
+        return self.movies.get(normalize_key(title))
+
+
+class NoBackend(object):
+    """
+    Never finds anything
+    """
+
+    name = 'none'
+
+    def prepare(self):
+        pass
+
+    def year(self, title):
+        return None
+
+
+class MetadataCache(object):
+    """
+    Persistent cache of lookup results, including misses
+    """
+
+    def __init__(self, db_file, ttl=90 * 86400, negative_ttl=86400, max_entries=10000):
+        """
+        db_file: path to the SQLite database
+        ttl: seconds a found year stays valid
+        negative_ttl: seconds a miss stays valid
+        max_entries: the least recently used entries beyond this are dropped
+        """
+        db_dir = os.path.dirname(db_file)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db_lock = threading.Lock()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+    def get(self, key):
+        """
+        returns (True, year) for a valid entry - year is None for a cached
+        miss - and (False, None) if key is unknown or expired
+        """
+        now = time.time()
+        with self.db_lock:
+            row = self.db.execute('SELECT year, stored FROM metadata WHERE key = ?',
+                                  (key,)).fetchone()
+            if row is None:
+                return False, None
+            year, stored = row
+            ttl = self.ttl if year is not None else self.negative_ttl
+            if now - stored > ttl:
+                self.db.execute('DELETE FROM metadata WHERE key = ?', (key,))
+                self.db.commit()
+                return False, None
+            self.db.execute('UPDATE metadata SET accessed = ? WHERE key = ?', (now, key))
+            self.db.commit()
+        return True, year
+
+    def put(self, key, year):
+        """
+        Store year (None for a miss) under key
+        """
+        now = time.time()
+        with self.db_lock:
+            self.db.execute('INSERT OR REPLACE INTO metadata (key, year, stored, accessed)'
+                            ' VALUES (?, ?, ?, ?)', (key, year, now, now))
+            self.db.execute('DELETE FROM metadata WHERE key IN (SELECT key FROM metadata'
+                            ' ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self.db.commit()
+
+
+class MetadataLookup(object):
+    """
+    Cache and backend put together
+    """
+
+    def __init__(self, backend, cache=None, timeout=5):
+        """
+        backend: an object with year(title) and prepare() methods, e.g. ImdbBackend
+        cache: a MetadataCache. optional
+        timeout: seconds a backend lookup may take at most
+        """
+        self.backend = backend
+        self.cache = cache
+        self.timeout = timeout
+
+    def year(self, title, disc_id=None):
+        """
+        Get the year of title
+
+        title: the movie title
+        disc_id: a stable id of the disc, e.g. dvd_title.disc_id. optional
+
+        returns the year or None
+        """
+        keys = [normalize_key(title)]
+        if disc_id:
+            keys.insert(0, 'disc:' + disc_id)
+        if self.cache is not None:
+            for key in keys:
+                hit, year = self.cache.get(key)
+                if hit:
+                    LOGGER.debug('Metadata cache hit for %s: %s', key, year)
+                    return year
+        found, year = self.lookup(title)
+        if found and self.cache is not None:
+            for key in keys:
+                self.cache.put(key, year)
+        return year
+
+    def prepare(self):
+        """
+        Get the backend ready for the first lookup. Failures are left for
+        the lookups to report.
+        """
+        try:
+            self.backend.prepare()
+        except Exception as error:
+            LOGGER.warning('Could not prepare %s lookups: %s', self.backend.name, error)
+
+    def lookup(self, title):
+        """
+        Ask the backend, giving up after timeout seconds
+
+        returns (True, year) if the backend answered, (False, None) otherwise
+        """
+        result = {}
+        def run():
+            try:
+                result['year'] = self.backend.year(title)
+            except Exception as error:
+                result['error'] = error
+        start = time.time()
+        worker = threading.Thread(target=run, name='metadata-lookup')
+        worker.daemon = True
+        worker.start()
+        worker.join(self.timeout)
+        if worker.is_alive():
+            LOGGER.warning('Metadata lookup for "%s" took longer than %ss, giving up', title,
+                           self.timeout)
+            return False, None
+        if 'error' in result:
+            LOGGER.warning('Metadata lookup for "%s" failed: %s', title, result['error'])
+            return False, None
+        LOGGER.debug('%s lookup for "%s" took %ss: %s', self.backend.name, title,
+                     round(time.time() - start, 2), result['year'])
+        return True, result['year']
@@ -0,0 +1,320 @@
+"""
+metrics.py
+Progress and throughput of rips, encodes and copies, for people and for
+monitoring. The output of HandBrakeCLI and abcde is parsed as it comes in,
+instead of being thrown away.
+
+Metrics are served as JSON and in the Prometheus text format on a local
+port, and/or written to a file for the node exporter textfile collector.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+LOGGER = logging.getLogger('auto_copy')
+
+# name: (type, help)
+METRICS = {
+    'encode_percent': ('gauge', 'Progress of running encodes in percent'),
+    'encode_fps': ('gauge', 'Current frames per second of running encodes'),
+    'encode_avg_fps': ('gauge', 'Average frames per second of running encodes'),
+    'encode_eta_seconds': ('gauge', 'Estimated time left of running encodes'),
+    'rip_track': ('gauge', 'Audio track currently being ripped'),
+    'rip_track_seconds': ('histogram', 'Time taken to rip a single audio track'),
+    'rip_speed': ('gauge', 'Read speed of the last audio track, in multiples of realtime'),
+    'copy_bytes_total': ('counter', 'Bytes copied from data discs'),
+    'copy_bytes_per_second': ('gauge', 'Throughput of the last file copied'),
+    'stage_seconds': ('histogram', 'Time taken by a stage of processing a disc'),
+    'mover_queue_files': ('gauge', 'Files waiting to be moved to data_dir'),
+    'mover_bytes_total': ('counter', 'Bytes moved to data_dir'),
+    'mover_bytes_per_second': ('gauge', 'Throughput of the last file moved to data_dir'),
+    'batch_images_total': ('counter', 'Images processed by batch.py, by result'),
+    'batch_bytes_total': ('counter', 'Bytes of the images processed by batch.py'),
+    'process_seconds': ('histogram', 'Time taken by a run of an external tool'),
+    'process_max_rss_bytes': ('gauge', 'Peak memory of the last run of an external tool'),
+    'process_stopped_total': ('counter', 'Runs of external tools stopped, by reason'),
+}
+
+BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, float('inf'))
+
+HANDBRAKE_PROGRESS = re.compile(
+    r'Encoding: task (\d+) of (\d+), ([\d.]+) %'
+    r'(?: \(([\d.]+) fps, avg ([\d.]+) fps, ETA (\d+)h(\d+)m(\d+)s\))?')
+
+ABCDE_GRAB = re.compile(r'Grabbing track (\d+)')
+
+
+def label_key(labels):
+    """
+    Hashable, sorted version of a labels dict
+    """
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    """
+    Prometheus notation of labels, e.g. {device="sr0"}
+    """
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('"', '\\"') + '"'
+                          for name, value in pairs) + '}'
+
+
+class Registry(object):
+    """
+    Current values of all metrics
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = collections.defaultdict(dict)
+        self.histograms = collections.defaultdict(dict)
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge
+        """
+        with self.lock:
+            self.values[name][label_key(labels)] = value
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase a counter
+        """
+        with self.lock:
+            key = label_key(labels)
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def remove(self, name, **labels):
+        """
+        Drop a gauge, e.g. the progress of a finished encode
+        """
+        with self.lock:
+            self.values[name].pop(label_key(labels), None)
+
+    def observe(self, name, value, **labels):
+        """
+        Add value to a histogram
+        """
+        with self.lock:
+            key = label_key(labels)
+            histogram = self.histograms[name].setdefault(
+                key, {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        """
+        returns all metrics as a dict, for JSON
+        """
+        with self.lock:
+            result = {}
+            for name, series in self.values.items():
+                result[name] = [dict(key, value=value) for key, value in series.items()]
+            for name, series in self.histograms.items():
+                result[name] = [dict(key, count=histogram['count'], sum=histogram['sum'])
+                                for key, histogram in series.items()]
+            return result
+
+    def prometheus(self):
+        """
+        returns all metrics in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            for name in sorted(set(self.values) | set(self.histograms)):
+                metric_type, help_text = METRICS.get(name, ('untyped', name))
+                lines.append('# HELP auto_copy_' + name + ' ' + help_text)
+                lines.append('# TYPE auto_copy_' + name + ' ' + metric_type)
+                for key, value in sorted(self.values.get(name, {}).items()):
+                    lines.append('auto_copy_' + name + format_labels(key) + ' ' + str(value))
+                for key, histogram in sorted(self.histograms.get(name, {}).items()):
+                    for bound, count in zip(BUCKETS, histogram['buckets']):
+                        le = '+Inf' if bound == float('inf') else str(bound)
+                        lines.append('auto_copy_' + name + '_bucket'
+                                     + format_labels(key, [('le', le)]) + ' ' + str(count))
+                    lines.append('auto_copy_' + name + '_sum' + format_labels(key)
+                                 + ' ' + str(histogram['sum']))
+                    lines.append('auto_copy_' + name + '_count' + format_labels(key)
+                                 + ' ' + str(histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+@contextlib.contextmanager
+def timed(stage, registry=REGISTRY, **labels):
+    """
+    Record the duration of the with block as stage_seconds
+
+    stage: name of the stage, e.g. 'copy'
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        registry.observe('stage_seconds', time.time() - start, stage=stage, **labels)
+
+
+def parse_handbrake(line):
+    """
+    Parse a HandBrakeCLI progress line, e.g.
+    Encoding: task 1 of 1, 45.67 % (123.45 fps, avg 110.23 fps, ETA 00h12m34s)
+
+    returns a dict with percent and, once HandBrake knows them, fps, avg_fps
+    and eta (seconds). None if line is no progress line.
+    """
+    match = HANDBRAKE_PROGRESS.search(line)
+    if match is None:
+        return None
+    progress = {'percent': float(match.group(3))}
+    if match.group(4) is not None:
+        progress['fps'] = float(match.group(4))
+        progress['avg_fps'] = float(match.group(5))
+        progress['eta'] = int(match.group(6)) * 3600 + int(match.group(7)) * 60 \
+            + int(match.group(8))
+    return progress
+
+
+class HandbrakeProgress(object):
+    """
+    Turns HandBrakeCLI output into encode_* gauges
+    """
+
+    def __init__(self, registry=REGISTRY, **labels):
+        self.registry = registry
+        self.labels = labels
+        self.avg_fps = None
+
+    def __call__(self, line):
+        progress = parse_handbrake(line)
+        if progress is None:
+            return
+        self.registry.set('encode_percent', progress['percent'], **self.labels)
+        if 'fps' in progress:
+            self.avg_fps = progress['avg_fps']
+            self.registry.set('encode_fps', progress['fps'], **self.labels)
+            self.registry.set('encode_avg_fps', progress['avg_fps'], **self.labels)
+            self.registry.set('encode_eta_seconds', progress['eta'], **self.labels)
+
+    def finish(self):
+        """
+        Remove the gauges of the finished encode
+        """
+        for name in ('encode_percent', 'encode_fps', 'encode_avg_fps', 'encode_eta_seconds'):
+            self.registry.remove(name, **self.labels)
+
+
+class AbcdeProgress(object):
+    """
+    Turns abcde output into the rip_track gauge and the time per track
+    """
+
+    def __init__(self, registry=REGISTRY, **labels):
+        self.registry = registry
+        self.labels = labels
+        self.track_start = None
+
+    def __call__(self, line):
+        match = ABCDE_GRAB.search(line)
+        if match is None:
+            return
+        self.finish()
+        self.track_start = time.time()
+        self.registry.set('rip_track', int(match.group(1)), **self.labels)
+
+    def finish(self):
+        """
+        Record the time of the track ripped last
+        """
+        if self.track_start is not None:
+            self.registry.observe('rip_track_seconds', time.time() - self.track_start,
+                                  **self.labels)
+            self.track_start = None
+        self.registry.remove('rip_track', **self.labels)
+
+
+def serve(port, address='127.0.0.1', registry=REGISTRY):
+    """
+    Serve the metrics over HTTP from a background thread: /metrics in
+    the Prometheus format and /metrics.json
+
+    port: tcp port, 0 picks a free one
+    address: address to listen on, only locally by default
+
+    returns the server, its port is server.server_address[1]
+    """
+    # only the daemon serves metrics, a single run need not import this
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = registry.prometheus().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path in ('/', '/metrics.json'):
+                body = json.dumps(registry.snapshot(), sort_keys=True).encode('utf-8')
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            LOGGER.debug('metrics: ' + format, *args)
+
+    server = http.server.ThreadingHTTPServer((address, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    LOGGER.info('Serving metrics on http://%s:%s/metrics', address, server.server_address[1])
+    return server
+
+
+def write_textfile(textfile, registry=REGISTRY):
+    """
+    Write the metrics for the node exporter textfile collector. The file is
+    replaced atomically, so the collector never reads half of it.
+    """
+    with open(textfile + '.tmp', 'w') as textfile_fh:
+        textfile_fh.write(registry.prometheus())
+    os.rename(textfile + '.tmp', textfile)
+
+
+def start(port=None, textfile=None, interval=15):
+    """
+    Start exporting metrics, as configured
+
+    port: serve over HTTP on this port. optional
+    textfile: write to this file every interval seconds. optional
+    """
+    if port:
+        serve(port)
+    if textfile:
+        def write_forever():
+            while True:
+                try:
+                    write_textfile(textfile)
+                except (IOError, OSError) as error:
+                    LOGGER.warning('Could not write metrics to %s: %s', textfile, error)
+                time.sleep(interval)
+        writer = threading.Thread(target=write_forever, name='metrics-textfile')
+        writer.daemon = True
+        writer.start()
@@ -0,0 +1,350 @@
+"""
+mover.py
+Move finished outputs from a fast local staging directory to data_dir.
+
+data_dir is often on the network, and writing to it directly makes
+encodes and copies wait for every stall of the network or the file
+server. With a mover, they write to a local staging directory instead and
+hand finished files over. A few background threads then transfer them in
+large sequential writes, optionally limited in bandwidth. Each file is
+written to a hidden .part file, flushed to disk and renamed, so data_dir
+never shows half a file. Failed transfers are retried later, continuing
+where they stopped.
+
+A file whose name is taken in data_dir gets a number added. The name is
+chosen when the file is handed over, so callers can record where it will
+end up. Files handed over are listed in a journal in the staging
+directory with their destination, so a restart picks them up again. If
+the staging disk runs low on space, wait_for_space blocks, so reading
+the next disc waits for the mover instead of filling the disk.
+"""
+
+import errno
+import json
+import logging
+import os
+import threading
+import time
+
+import copier
+import metrics
+
+LOGGER = logging.getLogger('auto_copy')
+
+MEGA = 1024 * 1024
+
+# bytes per read and write
+BUFFER_SIZE = copier.BUFFER_SIZE
+
+# a failed transfer is retried after this many seconds, doubling up to
+# MAX_RETRY_DELAY each time it fails again
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 3600
+
+JOURNAL = '.mover_journal.json'
+
+
+class Throttle(object):
+    """
+    Limits the bytes per second of all transfers together
+    """
+
+    def __init__(self, bytes_per_second):
+        """
+        bytes_per_second: 0 for no limit
+        """
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.next_free = time.time()
+
+    def consume(self, size):
+        """
+        Account for size bytes, sleeping if they came too early
+        """
+        if not self.bytes_per_second:
+            return
+        with self.lock:
+            now = time.time()
+            self.next_free = max(self.next_free, now) + float(size) / self.bytes_per_second
+            delay = self.next_free - now - 1.0
+        # a second worth of bytes may go out at once
+        if delay > 0:
+            time.sleep(delay)
+
+
+def free_bytes(path):
+    """
+    returns the bytes available to us on the file system of path
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def free_name(dest):
+    """
+    returns dest, or dest with a number added if it exists already
+    """
+    base, extension = os.path.splitext(dest)
+    num = 1
+    while os.path.exists(dest):
+        dest = base + '_' + str(num) + extension
+        num += 1
+    return dest
+
+
+def fsync_dir(path):
+    """
+    Make a rename in directory path durable
+    """
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    except OSError as error:
+        # not every file system can sync a directory
+        if error.errno not in (errno.EINVAL, errno.ENOTSUP):
+            raise
+    finally:
+        os.close(dir_fd)
+
+
+def transfer(source, dest, throttle=None, buffer_size=None):
+    """
+    Copy source to dest through a .part file, flushed and renamed when
+    complete. A .part file left by an earlier attempt is continued, its
+    last buffer is written again as it may not have reached the disk.
+
+    returns the number of bytes written
+    """
+    buffer_size = buffer_size or BUFFER_SIZE
+    part = copier.part_path(dest)
+    size = os.path.getsize(source)
+    offset = 0
+    if os.path.exists(part) and os.path.getsize(part) <= size:
+        offset = max(0, os.path.getsize(part) - buffer_size)
+        offset -= offset % buffer_size
+    with open(source, 'rb') as source_fh, open(part, 'ab' if offset else 'wb') as part_fh:
+        if offset:
+            part_fh.truncate(offset)
+            part_fh.seek(offset)
+            source_fh.seek(offset)
+        while True:
+            chunk = source_fh.read(buffer_size)
+            if not chunk:
+                break
+            if throttle is not None:
+                throttle.consume(len(chunk))
+            part_fh.write(chunk)
+        part_fh.flush()
+        os.fsync(part_fh.fileno())
+    if os.path.getsize(part) != size:
+        raise IOError('Size of ' + part + ' differs from ' + source)
+    os.rename(part, dest)
+    fsync_dir(os.path.dirname(dest))
+    return size - offset
+
+
+class Mover(object):
+    """
+    Moves files handed over from staging_dir to dest_dir in the background
+    """
+
+    def __init__(self, staging_dir, dest_dir, workers=2, bandwidth=0, min_free=0,
+                 retry_delay=RETRY_DELAY):
+        """
+        staging_dir: where outputs are written first, on a local disk
+        dest_dir: where they end up, usually data_dir
+        workers: transfers running at once
+        bandwidth: bytes per second of all transfers together, 0 for no limit
+        min_free: bytes to keep free in staging_dir, see wait_for_space
+        retry_delay: seconds before a failed transfer is tried again
+        """
+        self.staging_dir = staging_dir
+        self.dest_dir = dest_dir
+        self.min_free = min_free
+        self.retry_delay = retry_delay
+        self.throttle = Throttle(bandwidth)
+        if not os.path.isdir(staging_dir):
+            os.makedirs(staging_dir)
+        self.journal = os.path.join(staging_dir, JOURNAL)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # relative path: time of the next attempt
+        self.pending = {}
+        self.active = set()
+        self.failures = {}
+        # relative path: relative path in dest_dir it is moved to
+        self.dests = {}
+        if os.path.exists(self.journal):
+            with open(self.journal, 'r') as journal_fh:
+                journal = json.load(journal_fh)
+            # a list of relative paths before destinations were kept
+            if isinstance(journal, list):
+                journal = dict((relpath, relpath) for relpath in journal)
+            for relpath, dest in journal.items():
+                self.pending[relpath] = 0
+                self.dests[relpath] = dest
+            LOGGER.info('Resuming moving %s files to %s', len(self.pending), dest_dir)
+        self.workers = []
+        for num in range(workers):
+            worker = threading.Thread(target=self.run, name='mover-' + str(num))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def save(self):
+        """
+        Write the journal. Must be called with lock held.
+        """
+        with open(self.journal + '.tmp', 'w') as journal_fh:
+            json.dump(dict((relpath, self.dests.get(relpath, relpath))
+                           for relpath in set(self.pending) | self.active),
+                      journal_fh, sort_keys=True)
+        os.rename(self.journal + '.tmp', self.journal)
+        metrics.REGISTRY.set('mover_queue_files', len(self.pending) + len(self.active))
+
+    def final_path(self, path):
+        """
+        Where a file written below staging_dir will end up, see submit
+        """
+        relpath = os.path.relpath(path, self.staging_dir)
+        with self.lock:
+            return os.path.join(self.dest_dir, self.dests.get(relpath, relpath))
+
+    def free_dest(self, relpath):
+        """
+        Choose the relative path in dest_dir for relpath: the same, unless
+        a file exists there or another file handed over goes there.
+        Must be called with lock held.
+        """
+        if relpath in self.dests:
+            return self.dests[relpath]
+        taken = set(self.dests.values())
+        dest = relpath
+        base, extension = os.path.splitext(relpath)
+        num = 1
+        while dest in taken or os.path.exists(os.path.join(self.dest_dir, dest)):
+            dest = base + '_' + str(num) + extension
+            num += 1
+        return dest
+
+    def submit(self, path):
+        """
+        Hand over a finished file below staging_dir
+
+        returns the path the file will have in dest_dir
+        """
+        relpath = os.path.relpath(path, self.staging_dir)
+        if relpath.startswith(os.pardir):
+            raise ValueError(path + ' is not below ' + self.staging_dir)
+        with self.lock:
+            dest = self.free_dest(relpath)
+            if dest != relpath:
+                LOGGER.warning('%s exists, %s will be moved to %s',
+                               os.path.join(self.dest_dir, relpath), relpath, dest)
+            self.dests[relpath] = dest
+            self.pending[relpath] = 0
+            self.save()
+            self.changed.notify_all()
+        return os.path.join(self.dest_dir, dest)
+
+    def wait_for_space(self, needed=0):
+        """
+        Block until staging_dir has min_free plus needed bytes free, or
+        nothing is left to move that would free them
+
+        returns the seconds waited
+        """
+        start = time.time()
+        logged = False
+        with self.lock:
+            while free_bytes(self.staging_dir) < self.min_free + needed \
+                    and (self.pending or self.active):
+                if not logged:
+                    LOGGER.warning('Staging %s is full, waiting for %s files to be moved',
+                                   self.staging_dir, len(self.pending) + len(self.active))
+                    logged = True
+                self.changed.wait(5)
+        if logged:
+            LOGGER.info('Waited %ss for space in %s', int(time.time() - start), self.staging_dir)
+        return time.time() - start
+
+    def join(self):
+        """
+        Wait until every file handed over was moved. Files failing over and
+        over keep this waiting.
+        """
+        with self.lock:
+            while self.pending or self.active:
+                self.changed.wait(1)
+
+    def take(self):
+        """
+        Wait for the next file due for a transfer and mark it active
+        """
+        with self.lock:
+            while True:
+                now = time.time()
+                due = [relpath for relpath, next_try in self.pending.items() if next_try <= now]
+                if due:
+                    relpath = sorted(due)[0]
+                    del self.pending[relpath]
+                    self.active.add(relpath)
+                    return relpath
+                self.changed.wait(1)
+
+    def move(self, relpath):
+        """
+        Transfer a single file and remove it from staging
+        """
+        source = os.path.join(self.staging_dir, relpath)
+        with self.lock:
+            dest = os.path.join(self.dest_dir, self.dests.get(relpath, relpath))
+        if not os.path.exists(source):
+            LOGGER.warning('Nothing to move, %s is gone', source)
+            return
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        if os.path.exists(dest):
+            # written by someone else since it was handed over
+            original = dest
+            dest = free_name(dest)
+            LOGGER.warning('%s exists, moving %s to %s instead', original, relpath, dest)
+        start = time.time()
+        written = transfer(source, dest, self.throttle)
+        seconds = time.time() - start
+        os.unlink(source)
+        # drop directories the outputs were written to, e.g. of an audio CD
+        source_dir = os.path.dirname(source)
+        while source_dir != self.staging_dir and not os.listdir(source_dir):
+            os.rmdir(source_dir)
+            source_dir = os.path.dirname(source_dir)
+        metrics.REGISTRY.inc('mover_bytes_total', written)
+        metrics.REGISTRY.set('mover_bytes_per_second', int(written / max(seconds, 0.001)))
+        LOGGER.info('Moved %s to %s at %sMB/s', relpath, self.dest_dir,
+                    copier.mb_per_s(written, seconds))
+
+    def run(self):
+        """
+        Worker loop
+        """
+        while True:
+            relpath = self.take()
+            try:
+                self.move(relpath)
+                next_try = None
+            except (IOError, OSError) as error:
+                failures = self.failures.get(relpath, 0) + 1
+                self.failures[relpath] = failures
+                delay = min(self.retry_delay * 2 ** (failures - 1), MAX_RETRY_DELAY)
+                LOGGER.warning('Moving %s failed (%s), attempt %s, retrying in %ss', relpath,
+                               error, failures, delay)
+                next_try = time.time() + delay
+            with self.lock:
+                self.active.discard(relpath)
+                if next_try is None:
+                    self.failures.pop(relpath, None)
+                    self.dests.pop(relpath, None)
+                else:
+                    self.pending[relpath] = next_try
+                self.save()
+                self.changed.notify_all()
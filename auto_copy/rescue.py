@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+rescue.py
+Image a disc the way ddrescue does, so a scratched disc does not stall
+everything in read retries.
+
+The first pass reads large blocks and skips every block that fails. Then
+the failed areas are read again with smaller and smaller blocks, until
+the time budget is used up. A limit on the whole imaging stops the first
+pass as well, which on a badly damaged disc can take hours by itself.
+What could not be read is left zeroed in the image. A map of good and
+bad areas is kept in a file while imaging, so an interrupted run
+continues where it stopped.
+
+Can be used as library, or from the command line:
+
+    rescue.py /dev/sr0 disc.iso disc.map --retry-time 600
+"""
+
+import logging
+import os
+import sys
+import time
+
+LOGGER = logging.getLogger('auto_copy')
+
+KILO = 1024
+MEGA = KILO * KILO
+
+SECTOR_SIZE = 2048
+
+# read size of the first pass
+BLOCK_SIZE = 1 * MEGA
+
+# the map is written at most this often, and after the passes
+MAP_SAVE_INTERVAL = 5
+
+# states of an area, as in ddrescue map files
+NON_TRIED = '?'
+NON_TRIMMED = '*'
+BAD = '-'
+FINISHED = '+'
+
+
+class RescueMap(object):
+    """
+    The state of each area of a disc, as a sorted list of
+    [start, size, state] with neighbours in the same state merged
+    """
+
+    def __init__(self, size):
+        """
+        size: size of the disc in bytes, all of it NON_TRIED
+        """
+        self.size = size
+        self.areas = [[0, size, NON_TRIED]] if size else []
+
+    def set(self, start, size, state):
+        """
+        Mark size bytes at start as state
+        """
+        end = start + size
+        areas = []
+        for area_start, area_size, area_state in self.areas:
+            area_end = area_start + area_size
+            if area_end <= start or area_start >= end:
+                areas.append([area_start, area_size, area_state])
+                continue
+            if area_start < start:
+                areas.append([area_start, start - area_start, area_state])
+            if area_end > end:
+                areas.append([end, area_end - end, area_state])
+        areas.append([start, size, state])
+        areas.sort()
+        self.areas = []
+        for area in areas:
+            if self.areas and self.areas[-1][2] == area[2]:
+                self.areas[-1][1] += area[1]
+            else:
+                self.areas.append(area)
+
+    def find(self, state):
+        """
+        returns a list of (start, size) of all areas in state
+        """
+        return [(start, size) for start, size, area_state in self.areas if area_state == state]
+
+    def count(self, state):
+        """
+        returns the number of bytes in state
+        """
+        return sum(size for start, size in self.find(state))
+
+    @property
+    def complete(self):
+        """
+        True if every byte was either read or given up on
+        """
+        return not self.find(NON_TRIED) and not self.find(NON_TRIMMED)
+
+    def save(self, map_file):
+        """
+        Write the map, replacing the old one atomically
+        """
+        with open(map_file + '.tmp', 'w') as map_fh:
+            map_fh.write('# auto_copy rescue map\n')
+            map_fh.write('# size ' + str(self.size) + '\n')
+            for start, size, state in self.areas:
+                map_fh.write('0x%08X  0x%08X  %s\n' % (start, size, state))
+        os.rename(map_file + '.tmp', map_file)
+
+    @classmethod
+    def load(cls, map_file):
+        """
+        Read a map written by save
+
+        returns a RescueMap
+        """
+        rescue_map = cls(0)
+        with open(map_file, 'r') as map_fh:
+            for line in map_fh:
+                fields = line.split()
+                if line.startswith('# size'):
+                    rescue_map.size = int(fields[2])
+                elif fields and not line.startswith('#'):
+                    rescue_map.areas.append([int(fields[0], 16), int(fields[1], 16), fields[2]])
+        return rescue_map
+
+
+def device_size(fd):
+    """
+    Size of a device or image in bytes
+    """
+    size = os.lseek(fd, 0, os.SEEK_END)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return size
+
+
+class Rescuer(object):
+    """
+    Copies a device to an image, see rescue
+    """
+
+    def __init__(self, src_fd, dest_fd, rescue_map, map_file=None):
+        self.src_fd = src_fd
+        self.dest_fd = dest_fd
+        self.map = rescue_map
+        self.map_file = map_file
+        self.saved = time.time()
+
+    def save(self, force=False):
+        """
+        Write the map, unless that happened just now
+        """
+        if self.map_file and (force or time.time() - self.saved > MAP_SAVE_INTERVAL):
+            self.map.save(self.map_file)
+            self.saved = time.time()
+
+    def pread(self, size, start):
+        """
+        Read from the device
+        """
+        return os.pread(self.src_fd, size, start)
+
+    def read_block(self, start, size):
+        """
+        Copy a single block
+
+        returns True if it could be read
+        """
+        try:
+            data = self.pread(size, start)
+        except OSError as error:
+            LOGGER.debug('Read error at %s (%sB): %s', start, size, error)
+            return False
+        if len(data) < size:
+            LOGGER.debug('Short read at %s: %sB of %s', start, len(data), size)
+            return False
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.dest_fd, view, start)
+            view = view[written:]
+            start += written
+        return True
+
+    def read_areas(self, state, block_size, failed_state, deadline=None):
+        """
+        Read all areas in state in blocks of block_size
+
+        state: which areas to read
+        block_size: bytes read at once
+        failed_state: state of blocks that could not be read
+        deadline: time.time() after which no more reads are started. optional
+
+        returns False if the deadline was hit
+        """
+        for area_start, area_size in self.map.find(state):
+            offset = area_start
+            while offset < area_start + area_size:
+                if deadline is not None and time.time() > deadline:
+                    return False
+                size = min(block_size, area_start + area_size - offset)
+                ok = self.read_block(offset, size)
+                self.map.set(offset, size, FINISHED if ok else failed_state)
+                self.save(force=not ok)
+                offset += size
+        return True
+
+
+def rescue(device, image, map_file=None, block_size=BLOCK_SIZE, retry_time=300, time_limit=0):
+    """
+    Image device to image, reading around bad areas
+
+    device: the device (or any file) to read
+    image: path of the image to write
+    map_file: keeps track of the progress, a run interrupted before is
+        resumed from it. optional
+    block_size: read size of the first pass
+    retry_time: seconds spent re-reading bad areas at most
+    time_limit: seconds the whole imaging may take, first pass included.
+        What was not read by then is left zeroed. 0 for no limit
+
+    returns the RescueMap. The image is complete if map.count(FINISHED) equals map.size
+    """
+    start = time.time()
+    src_fd = os.open(device, os.O_RDONLY)
+    try:
+        size = device_size(src_fd)
+        if map_file and os.path.exists(map_file) and os.path.exists(image):
+            rescue_map = RescueMap.load(map_file)
+            LOGGER.info('Resuming imaging of %s, %sMB done before', device,
+                        rescue_map.count(FINISHED) // MEGA)
+        else:
+            rescue_map = RescueMap(size)
+        dest_fd = os.open(image, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            # unread areas stay zero
+            os.ftruncate(dest_fd, size)
+            rescuer = Rescuer(src_fd, dest_fd, rescue_map, map_file)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            end = start + time_limit if time_limit else None
+            if not rescuer.read_areas(NON_TRIED, block_size, NON_TRIMMED, end):
+                LOGGER.warning('Imaging %s takes longer than %ss, stopping', device, time_limit)
+            elif rescue_map.find(NON_TRIMMED):
+                LOGGER.warning('Could not read %sKB of %s, retrying for up to %ss',
+                               rescue_map.count(NON_TRIMMED) // KILO, device, retry_time)
+            deadline = time.time() + retry_time
+            if end is not None:
+                deadline = min(deadline, end)
+            retry_size = block_size
+            while rescue_map.find(NON_TRIMMED) and time.time() < deadline:
+                retry_size = max(SECTOR_SIZE, retry_size // 8)
+                # the smallest blocks that fail are given up on
+                failed = BAD if retry_size == SECTOR_SIZE else NON_TRIMMED
+                if not rescuer.read_areas(NON_TRIMMED, retry_size, failed, deadline):
+                    break
+            os.fsync(dest_fd)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+    rescuer.save(force=True)
+    unreadable = rescue_map.size - rescue_map.count(FINISHED)
+    if unreadable:
+        LOGGER.warning('Imaged %s in %ss, %sKB could not be read and are zeroed', device,
+                       int(time.time() - start), unreadable // KILO)
+    else:
+        LOGGER.info('Imaged %s (%sMB) in %ss', device, size // MEGA, int(time.time() - start))
+    return rescue_map
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Image a possibly damaged disc')
+    parser.add_argument('device')
+    parser.add_argument('image')
+    parser.add_argument('map_file')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE // KILO,
+                        help='read size of the first pass in KB')
+    parser.add_argument('--retry-time', type=int, default=300,
+                        help='seconds spent re-reading bad areas at most')
+    parser.add_argument('--time-limit', type=int, default=0,
+                        help='seconds the whole imaging may take, 0 for no limit')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    rescue_map = rescue(args.device, args.image, args.map_file,
+                        block_size=args.block_size * KILO, retry_time=args.retry_time,
+                        time_limit=args.time_limit)
+    return 0 if rescue_map.count(FINISHED) == rescue_map.size else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+scheduler.py
+Decide how hard each encode job works, and how much it leaves to the rest.
+
+The x264 preset of a job is chosen when the job starts, from the amount of
+video waiting in the encode queue, the load of the machine and the speed
+each preset reached on earlier jobs. The slowest preset - the best quality
+per byte - that still clears the backlog within the target time is used,
+but never one slower than rip_speed.
+
+Encoders also run with a lower cpu and io priority and away from the cpus
+reserved for reading discs and copying, so a busy encoder never slows down
+a rip.
+"""
+
+import logging
+import os
+import shutil
+
+LOGGER = logging.getLogger('auto_copy')
+
+# x264 presets, fastest first
+PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium',
+           'slow', 'slower', 'veryslow', 'placebo']
+
+# rough speed of each preset relative to medium, used for presets that
+# did not encode anything on this machine yet
+RELATIVE_SPEED = {
+    'ultrafast': 8.0,
+    'superfast': 6.0,
+    'veryfast': 4.0,
+    'faster': 2.5,
+    'fast': 1.5,
+    'medium': 1.0,
+    'slow': 0.6,
+    'slower': 0.35,
+    'veryslow': 0.15,
+    'placebo': 0.05,
+}
+
+# frames per second of medium, assumed before anything was measured
+DEFAULT_FPS = 60.0
+
+# frames per second of video, to turn the backlog into frames
+SOURCE_FPS = 25.0
+
+# length assumed for jobs whose title length is not known
+DEFAULT_JOB_SECONDS = 3600
+
+# the machine is never assumed to give an encoder less than this share
+MIN_CPU_SHARE = 0.1
+
+
+def preset_speeds(measured):
+    """
+    Expected frames per second of every preset
+
+    measured: dict of preset to average fps of earlier jobs, may lack presets
+
+    returns a dict of preset to fps. Presets without measurements are
+    estimated from the measured ones, or from DEFAULT_FPS.
+    """
+    measured = dict((preset, fps) for preset, fps in measured.items()
+                    if preset in RELATIVE_SPEED and fps)
+    if measured:
+        # what medium would do here, according to each preset measured
+        medium = sum(fps / RELATIVE_SPEED[preset] for preset, fps in measured.items()) \
+            / len(measured)
+    else:
+        medium = DEFAULT_FPS
+    return dict((preset, measured.get(preset, medium * RELATIVE_SPEED[preset]))
+                for preset in PRESETS)
+
+
+def cpu_share(load, cpus):
+    """
+    Share of its usual speed an encoder can expect at the current load
+
+    load: the one minute load average
+    cpus: number of cpus
+    """
+    return max(MIN_CPU_SHARE, min(1.0, float(cpus) / max(load, 0.01)))
+
+
+def choose_preset(backlog_seconds, target_seconds, speeds, share=1.0, parallel=1,
+                  slowest='slow', fastest='veryfast'):
+    """
+    Pick the slowest preset clearing the backlog within the target
+
+    backlog_seconds: seconds of video waiting to be encoded
+    target_seconds: time the backlog should be cleared in
+    speeds: dict of preset to fps, see preset_speeds
+    share: see cpu_share
+    parallel: number of jobs running at the same time
+    slowest, fastest: range of presets to choose from
+
+    returns the preset and the estimated seconds to clear the backlog with it.
+    If no preset is fast enough, the fastest one.
+    """
+    candidates = PRESETS[PRESETS.index(fastest):PRESETS.index(slowest) + 1]
+    frames = backlog_seconds * SOURCE_FPS
+    for preset in reversed(candidates):
+        estimate = frames / (speeds[preset] * share * max(parallel, 1))
+        if estimate <= target_seconds:
+            return preset, estimate
+    return preset, estimate
+
+
+def current_preset(command):
+    """
+    returns the value of --x264-preset in command, None if not there
+    """
+    if '--x264-preset' not in command[:-1]:
+        return None
+    return command[command.index('--x264-preset') + 1]
+
+
+def replace_preset(command, preset):
+    """
+    returns command with the value of --x264-preset replaced by preset
+    """
+    command = list(command)
+    for index, arg in enumerate(command[:-1]):
+        if arg == '--x264-preset':
+            command[index + 1] = preset
+    return command
+
+
+def encoder_cpus(reserved):
+    """
+    The cpus encoders may run on: all this process may use, except for the
+    first reserved ones. None if nothing would be left for the encoders.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if reserved <= 0 or len(cpus) <= reserved:
+        return None
+    return cpus[reserved:]
+
+
+def priority_prefix(nice=10, idle_io=True, cpus=None):
+    """
+    The argument list to put in front of a command to run it with lower
+    priority. Tools that are not installed are left out.
+
+    nice: niceness, 0 leaves it as it is
+    idle_io: only do io when no one else does
+    cpus: list of cpus to run on, None for all
+    """
+    prefix = []
+    if nice and shutil.which('nice'):
+        prefix.extend([shutil.which('nice'), '-n', str(nice)])
+    if idle_io and shutil.which('ionice'):
+        # -t: run the command anyway if the io scheduler does not support this
+        prefix.extend([shutil.which('ionice'), '-c', '3', '-t'])
+    if cpus and shutil.which('taskset'):
+        prefix.extend([shutil.which('taskset'), '-c', ','.join(str(cpu) for cpu in cpus)])
+    return prefix
+
+
+class Scheduler(object):
+    """
+    Prepares the command of each encode job before it is run
+    """
+
+    def __init__(self, slowest='slow', fastest='veryfast', target_hours=0, nice=10,
+                 idle_io=True, reserved_cpus=1):
+        """
+        slowest: the preset wanted if there is time, usually rip_speed
+        fastest: the fastest preset used to catch up
+        target_hours: clear the backlog within this many hours. 0 always
+            uses slowest.
+        nice, idle_io: see priority_prefix
+        reserved_cpus: number of cpus kept free of encoders
+        """
+        self.slowest = slowest
+        self.fastest = fastest
+        self.target_seconds = target_hours * 3600
+        self.cpus = encoder_cpus(reserved_cpus)
+        self.prefix = priority_prefix(nice, idle_io, self.cpus)
+
+    def prepare(self, queue, job, command):
+        """
+        Choose the preset of a job and lower its priority
+
+        queue: the encode_queue.EncodeQueue the job is from
+        job: the job row
+        command: the argument list of the job
+
+        returns the argument list to run and the preset chosen, None if the
+        command has no preset
+        """
+        preset = current_preset(command)
+        if preset is not None and self.target_seconds > 0:
+            jobs, backlog = queue.backlog()
+            speeds = preset_speeds(queue.preset_speeds())
+            load = os.getloadavg()[0]
+            share = cpu_share(load, len(self.cpus or os.sched_getaffinity(0)))
+            parallel = min(max(len(queue.workers), 1), jobs)
+            preset, estimate = choose_preset(backlog, self.target_seconds, speeds, share,
+                                             parallel, self.slowest, self.fastest)
+            LOGGER.info('Job %s: preset %s, %d jobs with %.1fh of video waiting, load %.2f,'
+                        ' estimated %.1fh to clear at %.1f fps', job['id'], preset, jobs,
+                        backlog / 3600.0, load, estimate / 3600.0, speeds[preset])
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug('Expected fps per preset: %s', ', '.join(
+                    preset_name + ' ' + str(round(speeds[preset_name], 1))
+                    for preset_name in PRESETS))
+        return self.prefix + replace_preset(command, preset), preset
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+segment_encode.py
+Encode a single long title with several HandBrakeCLI processes at once.
+
+A single HandBrake process does not keep a big machine busy. The title is
+split at chapter boundaries into segments of about the same length, the
+segments are encoded in parallel, and joined without re-encoding by
+ffmpeg. All audio and subtitle tracks are kept, the chapter markers are
+written anew for the joined file, and its duration is checked against the
+title before it is put in place.
+
+Runs as a command of its own, so the encode queue can run it like
+HandBrakeCLI. It prints HandBrake style progress lines for the whole title:
+
+    segment_encode.py --chapters 312,280,... --workers 4 -- HandBrakeCLI -i ... -o movie.mp4 ...
+
+Finished segments are kept until the join succeeded, so a job that was
+interrupted only encodes the missing segments again. The tools run in the
+process group of the job, so stopping the job stops them too.
+"""
+
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+import metrics
+import supervisor
+
+LOGGER = logging.getLogger('auto_copy')
+
+# segments shorter than this are not worth an extra process
+MIN_SEGMENT_SECONDS = 300
+
+# the joined file may differ from the title by this many seconds, or this
+# fraction of the title, whichever is more
+DURATION_TOLERANCE = 2.0
+DURATION_TOLERANCE_FRACTION = 0.005
+
+
+class SegmentEncodeError(Exception):
+    pass
+
+
+def plan_segments(chapters, workers, min_seconds=MIN_SEGMENT_SECONDS):
+    """
+    Split a title into ranges of chapters of about the same length
+
+    chapters: list of chapter lengths in seconds
+    workers: number of segments wanted at most
+    min_seconds: no segment is planned shorter than this
+
+    returns a list of (first, last) chapter numbers, counting from 1
+    """
+    total = sum(chapters)
+    count = max(1, min(workers, len(chapters), int(total // max(min_seconds, 1))))
+    target = float(total) / count
+    segments = []
+    first = 1
+    done = 0
+    for number, length in enumerate(chapters[:-1], 1):
+        done += length
+        # cut at the chapter boundary closest to the next multiple of target
+        if done + chapters[number] / 2.0 >= target * (len(segments) + 1) \
+                and len(segments) < count - 1:
+            segments.append((first, number))
+            first = number + 1
+    if first <= len(chapters):
+        segments.append((first, len(chapters)))
+    return segments
+
+
+def option_value(command, option):
+    """
+    returns the value following option in command, None if not there
+    """
+    if option not in command:
+        return None
+    return command[command.index(option) + 1]
+
+
+def segment_command(command, first, last, outfile, threads=None):
+    """
+    Turn the HandBrakeCLI command for a whole title into the one for a segment
+
+    command: HandBrakeCLI argument list, see auto_copy.handbrake_command
+    first, last: chapters of the segment
+    outfile: where to write the segment
+    threads: encoder threads per segment. optional
+    """
+    segment = []
+    skip = False
+    for index, arg in enumerate(command):
+        if skip:
+            skip = False
+            continue
+        if arg == '-o':
+            segment.extend(['-o', outfile])
+            skip = True
+        elif arg in ('-m', '--markers'):
+            # the markers of the joined file are written when joining
+            continue
+        else:
+            segment.append(arg)
+    segment.extend(['--chapters', str(first) + '-' + str(last)])
+    if threads:
+        segment.extend(['--encopts', 'threads=' + str(threads)])
+    return segment
+
+
+def probe_duration(path, ffprobe):
+    """
+    returns the duration of a media file in seconds
+    """
+    result = supervisor.run([ffprobe, '-v', 'error', '-show_entries', 'format=duration',
+                             '-of', 'default=noprint_wrappers=1:nokey=1', path],
+                            timeout=supervisor.TOOL_TIMEOUT, capture=True, merge_stderr=False,
+                            new_group=False)
+    if result.returncode != 0:
+        raise SegmentEncodeError('Probing ' + path + ' failed with ' + str(result.returncode))
+    return float(result.output.decode('ascii').strip())
+
+
+def chapter_metadata(chapters, segments, segment_durations):
+    """
+    Chapter markers in the ffmetadata format. Chapters start where their
+    segment really starts in the joined file, so rounding in the scan does
+    not add up over the title.
+
+    chapters: list of chapter lengths in seconds, from the scan
+    segments: list of (first, last) chapter numbers
+    segment_durations: measured duration of each encoded segment
+    """
+    lines = [';FFMETADATA1']
+    offset = 0.0
+    for (first, last), duration in zip(segments, segment_durations):
+        start = offset
+        for number in range(first, last + 1):
+            end = min(start + chapters[number - 1], offset + duration) if number < last \
+                else offset + duration
+            lines.extend(['[CHAPTER]', 'TIMEBASE=1/1000', 'START=' + str(int(start * 1000)),
+                          'END=' + str(int(end * 1000)), 'title=Chapter ' + str(number)])
+            start = end
+        offset += duration
+    return '\n'.join(lines) + '\n'
+
+
+def join_segments(segment_files, metadata_file, outfile, ffmpeg):
+    """
+    Concatenate the segments without re-encoding, keeping every stream
+
+    returns the exit code of ffmpeg
+    """
+    list_file = metadata_file + '.list'
+    with open(list_file, 'w') as list_fh:
+        for segment_file in segment_files:
+            list_fh.write("file '" + segment_file.replace("'", "'\\''") + "'\n")
+    command = [ffmpeg, '-nostdin', '-y', '-v', 'error', '-f', 'concat', '-safe', '0',
+               '-i', list_file, '-i', metadata_file, '-map', '0', '-map_metadata', '1',
+               '-map_chapters', '1', '-c', 'copy', '-f', 'mp4', outfile]
+    LOGGER.debug('Joining segments: %s', ' '.join(command))
+    return supervisor.run(command, new_group=False).returncode
+
+
+class Progress(object):
+    """
+    Adds up the progress of all segments into HandBrake style lines
+    for the whole title
+    """
+
+    def __init__(self, weights, out=sys.stdout):
+        """
+        weights: share of the title of each segment, adding up to 1
+        """
+        self.weights = weights
+        self.percent = [0.0] * len(weights)
+        self.fps = [0.0] * len(weights)
+        self.avg_fps = [0.0] * len(weights)
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.out = out
+
+    def update(self, segment, line):
+        progress = metrics.parse_handbrake(line)
+        if progress is None:
+            return
+        with self.lock:
+            self.percent[segment] = progress['percent']
+            self.fps[segment] = progress.get('fps', 0.0)
+            self.avg_fps[segment] = progress.get('avg_fps', 0.0)
+            self.report()
+
+    def done(self, segment):
+        with self.lock:
+            self.percent[segment] = 100.0
+            self.fps[segment] = 0.0
+            self.report()
+
+    def report(self):
+        percent = sum(weight * done for weight, done in zip(self.weights, self.percent))
+        elapsed = time.time() - self.start
+        eta = int(elapsed * (100 - percent) / percent) if percent > 0 else 0
+        self.out.write('Encoding: task 1 of 1, %.2f %% (%.2f fps, avg %.2f fps, ETA %02dh%02dm%02ds)\r'
+                       % (percent, sum(self.fps), sum(self.avg_fps),
+                          eta // 3600, eta // 60 % 60, eta % 60))
+        self.out.flush()
+
+
+def encode_segment(command, segment_file, progress, segment):
+    """
+    Encode a single segment, unless an earlier run finished it already
+
+    returns the exit code of HandBrakeCLI
+    """
+    if os.path.exists(segment_file):
+        LOGGER.info('Segment %s was encoded before', segment_file)
+        progress.done(segment)
+        return 0
+    part_file = segment_file + '.part.mp4'
+    command = [part_file if arg == segment_file else arg for arg in command]
+    returncode = supervisor.run(command, on_line=lambda line: progress.update(segment, line),
+                                new_group=False).returncode
+    if returncode == 0:
+        os.rename(part_file, segment_file)
+        progress.done(segment)
+    return returncode
+
+
+def encode_title(command, chapters, workers, ffmpeg='/usr/bin/ffmpeg',
+                 ffprobe='/usr/bin/ffprobe', duration=None):
+    """
+    Encode a title in parallel segments and join them
+
+    command: HandBrakeCLI argument list for the whole title
+    chapters: list of chapter lengths in seconds
+    workers: number of HandBrake processes at once
+    ffmpeg, ffprobe: paths to the tools
+    duration: length of the title in seconds, defaults to the sum of chapters
+
+    raises SegmentEncodeError if any step fails
+    """
+    import concurrent.futures
+    outfile = option_value(command, '-o')
+    if duration is None:
+        duration = sum(chapters)
+    segments = plan_segments(chapters, workers)
+    work_dir = os.path.join(os.path.dirname(outfile), '.' + os.path.basename(outfile) + '.segments')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    threads = max(1, (os.cpu_count() or 1) // len(segments))
+    LOGGER.info('Encoding %s in %s segments: %s', outfile, len(segments),
+                ', '.join(str(first) + '-' + str(last) for first, last in segments))
+    segment_files = []
+    weights = []
+    for first, last in segments:
+        segment_files.append(os.path.join(work_dir, 'chapters_%03d-%03d.mp4' % (first, last)))
+        weights.append(float(sum(chapters[first - 1:last])) / max(sum(chapters), 1))
+    progress = Progress(weights)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        results = list(executor.map(
+            lambda segment: encode_segment(
+                segment_command(command, segments[segment][0], segments[segment][1],
+                                segment_files[segment], threads),
+                segment_files[segment], progress, segment),
+            range(len(segments))))
+    sys.stdout.write('\n')
+    failed = [segment_files[index] for index, result in enumerate(results) if result != 0]
+    if failed:
+        raise SegmentEncodeError('Encoding failed for ' + ', '.join(failed))
+    segment_durations = [probe_duration(segment_file, ffprobe) for segment_file in segment_files]
+    metadata_file = os.path.join(work_dir, 'chapters.ffmeta')
+    with open(metadata_file, 'w') as metadata_fh:
+        metadata_fh.write(chapter_metadata(chapters, segments, segment_durations))
+    part_file = os.path.join(work_dir, 'joined.mp4')
+    if join_segments(segment_files, metadata_file, part_file, ffmpeg) != 0:
+        raise SegmentEncodeError('Joining the segments of ' + outfile + ' failed')
+    joined = probe_duration(part_file, ffprobe)
+    if abs(joined - duration) > max(DURATION_TOLERANCE, duration * DURATION_TOLERANCE_FRACTION):
+        raise SegmentEncodeError(outfile + ' is ' + str(round(joined, 1)) + 's long, the title '
+                                 + str(duration) + 's. Keeping the segments in ' + work_dir)
+    os.rename(part_file, outfile)
+    shutil.rmtree(work_dir)
+    LOGGER.info('Joined %s (%ss)', outfile, round(joined, 1))
+
+
+def command_line(handbrake_command, chapters, workers, ffmpeg, ffprobe, duration=None,
+                 program=None):
+    """
+    The argument list to run encode_title as a job of the encode queue
+
+    handbrake_command: HandBrakeCLI argument list for the whole title
+    chapters: list of chapter lengths in seconds
+    program: argument list running this script, defaults to the running
+        python and where this script lives
+    """
+    command = (program or [sys.executable, os.path.abspath(__file__)]) + ['--chapters',
+               ','.join(str(length) for length in chapters), '--workers', str(workers),
+               '--ffmpeg', ffmpeg, '--ffprobe', ffprobe]
+    if duration is not None:
+        command.extend(['--duration', str(duration)])
+    return command + ['--'] + handbrake_command
+
+
+def default_workers():
+    """
+    Segments encoded at once if not configured: x264 keeps about four
+    cores busy per process
+    """
+    return max(2, (os.cpu_count() or 1) // 4)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Encode a title in parallel chapter segments')
+    parser.add_argument('--chapters', required=True, help='comma separated chapter lengths in seconds')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--ffmpeg', default='/usr/bin/ffmpeg')
+    parser.add_argument('--ffprobe', default='/usr/bin/ffprobe')
+    parser.add_argument('--duration', type=float, help='length of the title in seconds')
+    parser.add_argument('handbrake_command', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    command = args.handbrake_command
+    if command and command[0] == '--':
+        command = command[1:]
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    try:
+        encode_title(command, [float(length) for length in args.chapters.split(',')],
+                     args.workers, args.ffmpeg, args.ffprobe, args.duration)
+    except (SegmentEncodeError, OSError, ValueError) as error:
+        LOGGER.error('%s', error)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,17 @@
 #!/bin/bash
+# Notify auto_copy_daemon.py about a changed optical drive.
+# The kernel name of the device (e.g. sr1) is passed by udev as first argument.
+# The event directory is AUTO_COPY_EVENT_DIR if set, otherwise event_dir of the
+# configuration (AUTO_COPY_CONFIG, /etc/auto_copy.yml by default).
+config=${AUTO_COPY_CONFIG:-/etc/auto_copy.yml}
+event_dir=${AUTO_COPY_EVENT_DIR}
+if [ -z "${event_dir}" ] && [ -f "${config}" ]; then
+    event_dir=$(sed -n "s/^event_dir *: *['\"]\{0,1\}\([^'\"#]*[^'\"# ]\).*/\1/p" "${config}")
+fi
+event_dir=${event_dir:-/tmp/auto_copy_events}
+if [ -n "$1" ]; then
+    mkdir -p "${event_dir}"
+    touch "${event_dir}/$1"
+fi
 kill -SIGUSR1 $(ps -elf |grep auto_copy_daemon.py |awk '/python/ {print $4}')
 sleep 1
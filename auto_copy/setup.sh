@@ -5,10 +5,28 @@
 files="
     /usr/local/sbin/auto_copy_daemon.py
     /usr/local/bin/auto_copy.py
+    /usr/local/bin/audio_rip.py
+    /usr/local/bin/batch.py
     /usr/lib/systemd/system/autocopy.service
     /etc/udev/rules.d/autodvd.rules
     /usr/local/bin/config_parser.py
+    /usr/local/bin/copier.py
+    /usr/local/bin/disc.py
+    /usr/local/bin/disc_fs.py
+    /usr/local/bin/distributed.py
+    /usr/local/bin/drive.py
     /usr/local/bin/dvd_title.py
+    /usr/local/bin/encode_queue.py
+    /usr/local/bin/hb_client.py
+    /usr/local/bin/ingest_index.py
+    /usr/local/bin/metadata_cache.py
+    /usr/local/bin/metrics.py
+    /usr/local/bin/mover.py
+    /usr/local/bin/rescue.py
+    /usr/local/bin/scheduler.py
+    /usr/local/bin/segment_encode.py
+    /usr/local/bin/supervisor.py
+    /usr/local/bin/title_scan.py
     /usr/local/sbin/send_siguser1.sh
     /usr/local/bin/trayopen
 "
@@ -0,0 +1,269 @@
+"""
+supervisor.py
+Run external tools under supervision.
+
+A hung HandBrakeCLI, abcde or mount blocks the lock of its drive, so
+tools are never run without a limit on how long they may take. run starts
+a tool from an argument list in a process group of its own, and stops it
+once it runs longer than a timeout, or shows no progress for a while.
+Progress is new output, or a watched output file growing. Stopping sends
+SIGTERM to the whole group and SIGKILL after a grace period, so helpers
+the tool started go as well.
+
+Tools can be capped in memory and CPU, see limit_prefix. Exit status,
+duration, CPU time and peak memory of every run are returned, and kept
+as metrics per tool.
+"""
+
+import collections
+import logging
+import os
+import re
+import select
+import shutil
+import signal
+import subprocess
+import time
+
+import metrics
+
+LOGGER = logging.getLogger('auto_copy')
+
+# lines of output kept to show when a command fails
+TAIL_LINES = 20
+
+# default seconds a short tool like mount may take, and a scan of a disc,
+# see tool_timeout and scan_timeout in the configuration
+TOOL_TIMEOUT = 120
+SCAN_TIMEOUT = 600
+
+# default seconds a rip or encode may go without progress, see stall_timeout
+STALL_TIMEOUT = 900
+
+# seconds between SIGTERM and SIGKILL when stopping a command
+TERM_GRACE = 10
+
+# longest wait for output before the timeouts are checked again
+POLL_INTERVAL = 1.0
+
+# why a command was stopped
+TIMEOUT = 'timeout'
+STALLED = 'stalled'
+
+
+class Result(object):
+    """
+    What became of a command
+    """
+
+    def __init__(self, name):
+        self.name = name
+        # None if the command could not be stopped
+        self.returncode = None
+        self.seconds = 0.0
+        self.cpu_seconds = 0.0
+        # peak resident memory in bytes
+        self.max_rss = 0
+        # TIMEOUT or STALLED if the command was stopped
+        self.stopped = None
+        # everything the command wrote, if captured
+        self.output = None
+        self.tail = collections.deque(maxlen=TAIL_LINES)
+
+    def __repr__(self):
+        return 'Result(' + self.name + ', ' + str(self.returncode) + ')'
+
+
+def limit_prefix(memory_mb=0, cpu_seconds=0, cpus=0, cgroup=False):
+    """
+    The argument list to put in front of a command to cap its resources,
+    see scheduler.priority_prefix. With cgroup, the command gets a cgroup
+    of its own through systemd-run, which needs root as the daemon has.
+    Otherwise rlimits are set with prlimit, where memory caps the address
+    space and cpus cannot be capped. Tools that are not installed are left
+    out with a warning.
+
+    memory_mb: most memory in MB, 0 for no limit
+    cpu_seconds: most CPU time, the command is killed beyond it. 0 for no limit
+    cpus: most cpus busy at once, e.g. 1.5. 0 for no limit
+    cgroup: cap memory and cpus in a cgroup
+    """
+    prefix = []
+    rlimits = []
+    if cgroup and (memory_mb or cpus):
+        if shutil.which('systemd-run'):
+            prefix.extend([shutil.which('systemd-run'), '--scope', '--quiet', '--collect'])
+            if memory_mb:
+                prefix.extend(['-p', 'MemoryMax=' + str(memory_mb) + 'M'])
+            if cpus:
+                prefix.extend(['-p', 'CPUQuota=' + str(int(cpus * 100)) + '%'])
+            memory_mb = cpus = 0
+        else:
+            LOGGER.warning('systemd-run not found, limiting with rlimits instead of a cgroup')
+    if cpus:
+        LOGGER.warning('cpus can only be capped in a cgroup, not capping them')
+    if memory_mb:
+        rlimits.append('--as=' + str(memory_mb * 1024 * 1024))
+    if cpu_seconds:
+        rlimits.append('--cpu=' + str(cpu_seconds))
+    if rlimits:
+        if shutil.which('prlimit'):
+            prefix.extend([shutil.which('prlimit')] + rlimits)
+        else:
+            LOGGER.warning('prlimit not found, not limiting %s', ' '.join(rlimits))
+    return prefix
+
+
+def stop(process, sig=signal.SIGTERM):
+    """
+    Send sig to a running process and, if it leads a process group as
+    processes started by run do, to the rest of the group
+    """
+    if process.returncode is not None:
+        return
+    try:
+        if os.getpgid(process.pid) == process.pid:
+            os.killpg(process.pid, sig)
+        else:
+            os.kill(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def file_size(path):
+    """
+    returns the size of path, None if it does not exist
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def run(command, timeout=0, stall_timeout=0, on_line=None, on_start=None, capture=False,
+        merge_stderr=True, watch=None, name=None, new_group=True, quiet=False, **kwargs):
+    """
+    Run command, passing every line of its output to on_line as it comes,
+    and stop it if it takes too long. Progress lines ending in a carriage
+    return count as lines too.
+
+    command: argument list
+    timeout: seconds the command may run, 0 for no limit
+    stall_timeout: seconds the command may go without progress, 0 for no limit
+    on_line: callable taking a line, e.g. a metrics.HandbrakeProgress. optional,
+        without it lines are logged at level debug
+    on_start: called with the subprocess.Popen object once it runs, e.g.
+        to be able to stop it, see stop. optional
+    capture: keep the whole output in the result
+    merge_stderr: read stderr with stdout, otherwise it is thrown away
+    watch: a file the command writes, growth counts as progress. optional
+    name: of the tool, for logs and metrics. Defaults to the first argument,
+        pass it if command starts with a prefix like limit_prefix
+    new_group: start a process group, so stopping reaches every process
+        the command started. Off for commands of a supervised process, so
+        stopping that one reaches them.
+    quiet: do not log a non-zero exit code, e.g. for checks
+    kwargs: passed on to subprocess.Popen
+
+    returns a Result. If the exit code is not 0, the last lines of output are logged.
+    """
+    if isinstance(command, str):
+        raise TypeError('command must be an argument list: ' + command)
+    name = name or os.path.basename(command[0])
+    result = Result(name)
+    output = [] if capture else None
+    log_lines = on_line is None and not capture and LOGGER.isEnabledFor(logging.DEBUG)
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT if merge_stderr else subprocess.DEVNULL,
+                               stdin=subprocess.DEVNULL, start_new_session=new_group, **kwargs)
+
+    def line_out(text):
+        result.tail.append(text)
+        if on_line is not None:
+            on_line(text)
+        elif log_lines:
+            LOGGER.debug('%s: %s', name, text)
+
+    pending = b''
+    last_progress = start
+    watched_size = None
+    # when SIGTERM and SIGKILL were sent
+    stopping = None
+    killed = None
+    reading = True
+    delay = 0.001
+    try:
+        if on_start is not None:
+            on_start(process)
+        while True:
+            now = time.time()
+            if watch is not None and file_size(watch) != watched_size:
+                watched_size = file_size(watch)
+                last_progress = now
+            if result.stopped is None:
+                if timeout and now - start > timeout:
+                    result.stopped = TIMEOUT
+                    LOGGER.warning('Stopping %s, still running after %ss', name, timeout)
+                elif stall_timeout and now - last_progress > stall_timeout:
+                    result.stopped = STALLED
+                    LOGGER.warning('Stopping %s, no progress for %ss', name, stall_timeout)
+                if result.stopped is not None:
+                    stop(process, signal.SIGTERM)
+                    stopping = now
+            elif killed is None and now - stopping > TERM_GRACE:
+                LOGGER.warning('%s did not stop, killing it', name)
+                stop(process, signal.SIGKILL)
+                killed = now
+                # what is left could be a helper that left the group
+                reading = False
+            elif killed is not None and now - killed > TERM_GRACE:
+                # e.g. stuck in the kernel on a dead drive
+                LOGGER.error('%s (pid %s) cannot be killed, leaving it', name, process.pid)
+                break
+            if reading:
+                if select.select([process.stdout], [], [], POLL_INTERVAL)[0]:
+                    chunk = os.read(process.stdout.fileno(), 65536)
+                    if not chunk:
+                        reading = False
+                        continue
+                    last_progress = time.time()
+                    if output is not None:
+                        output.append(chunk)
+                    lines = re.split(b'[\r\n]', pending + chunk)
+                    pending = lines.pop()
+                    for line in lines:
+                        if line:
+                            line_out(line.decode('utf-8', 'replace'))
+                continue
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                result.returncode = process.returncode = os.waitstatus_to_exitcode(status)
+                # kilobytes on Linux
+                result.max_rss = rusage.ru_maxrss * 1024
+                result.cpu_seconds = rusage.ru_utime + rusage.ru_stime
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+    except BaseException:
+        # e.g. KeyboardInterrupt, the command must not outlive us
+        stop(process, signal.SIGKILL)
+        raise
+    finally:
+        process.stdout.close()
+    if pending:
+        line_out(pending.decode('utf-8', 'replace'))
+    result.seconds = time.time() - start
+    if output is not None:
+        result.output = b''.join(output)
+    metrics.REGISTRY.observe('process_seconds', result.seconds, tool=name)
+    metrics.REGISTRY.set('process_max_rss_bytes', result.max_rss, tool=name)
+    if result.stopped is not None:
+        metrics.REGISTRY.inc('process_stopped_total', tool=name, reason=result.stopped)
+    LOGGER.debug('%s exited with %s after %.1fs, %.1fs CPU, peak RSS %sMB', name,
+                 result.returncode, result.seconds, result.cpu_seconds,
+                 result.max_rss // (1024 * 1024))
+    if result.returncode != 0 and (not quiet or result.stopped is not None):
+        LOGGER.warning('%s exited with %s, last output:\n%s', name, result.returncode,
+                       '\n'.join(result.tail))
+    return result
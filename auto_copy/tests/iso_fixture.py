@@ -0,0 +1,83 @@
+# iso_fixture.py
+# build small ISO9660 images for tests, no external tools needed
+
+import struct
+
+SECTOR_SIZE = 2048
+
+
+def both_endian(fmt, value):
+    """ISO9660 stores most numbers little and big endian"""
+    return struct.pack('<' + fmt, value) + struct.pack('>' + fmt, value)
+
+
+def directory_record(name, sector, size, is_dir):
+    """A single ISO9660 directory record"""
+    length = 33 + len(name) + (len(name) + 1) % 2
+    record = bytearray(length)
+    record[0] = length
+    record[2:10] = both_endian('I', sector)
+    record[10:18] = both_endian('I', size)
+    record[25] = 2 if is_dir else 0
+    record[28:32] = both_endian('H', 1)
+    record[32] = len(name)
+    record[33:33 + len(name)] = name
+    return bytes(record)
+
+
+def make_iso(path, volume_id, files):
+    """
+    Write an ISO9660 image
+
+    path: where to write the image
+    volume_id: the volume name
+    files: dict mapping paths (at most one directory deep, e.g.
+        'VIDEO_TS/VIDEO_TS.IFO') to their content as bytes
+    """
+    dirs = {'': {}}
+    for file_path, content in files.items():
+        dir_name, _, file_name = file_path.rpartition('/')
+        dirs.setdefault(dir_name, {})[file_name] = content
+    # one sector per directory, starting after the volume descriptors
+    dir_sectors = {}
+    sector = 18
+    for dir_name in sorted(dirs):
+        dir_sectors[dir_name] = sector
+        sector += 1
+    file_sectors = {}
+    for dir_name in sorted(dirs):
+        for file_name, content in sorted(dirs[dir_name].items()):
+            file_sectors[(dir_name, file_name)] = sector
+            sector += max(1, (len(content) + SECTOR_SIZE - 1) // SECTOR_SIZE)
+    total_sectors = sector
+    image = bytearray(total_sectors * SECTOR_SIZE)
+    # directories
+    for dir_name in sorted(dirs):
+        records = directory_record(b'\0', dir_sectors[dir_name], SECTOR_SIZE, True) \
+            + directory_record(b'\1', dir_sectors[''], SECTOR_SIZE, True)
+        if dir_name == '':
+            for sub_dir in sorted(dirs):
+                if sub_dir:
+                    records += directory_record(sub_dir.encode('ascii'), dir_sectors[sub_dir],
+                                                SECTOR_SIZE, True)
+        for file_name, content in sorted(dirs[dir_name].items()):
+            records += directory_record((file_name + ';1').encode('ascii'),
+                                        file_sectors[(dir_name, file_name)], len(content), False)
+        offset = dir_sectors[dir_name] * SECTOR_SIZE
+        image[offset:offset + len(records)] = records
+        for file_name, content in dirs[dir_name].items():
+            offset = file_sectors[(dir_name, file_name)] * SECTOR_SIZE
+            image[offset:offset + len(content)] = content
+    # primary volume descriptor and terminator
+    pvd = bytearray(SECTOR_SIZE)
+    pvd[0:7] = b'\x01CD001\x01'
+    pvd[40:72] = volume_id.encode('ascii').ljust(32)
+    pvd[80:88] = both_endian('I', total_sectors)
+    pvd[120:124] = both_endian('H', 1)
+    pvd[128:132] = both_endian('H', SECTOR_SIZE)
+    pvd[156:190] = directory_record(b'\0', dir_sectors[''], SECTOR_SIZE, True)
+    pvd[881] = 1
+    image[16 * SECTOR_SIZE:17 * SECTOR_SIZE] = pvd
+    image[17 * SECTOR_SIZE:17 * SECTOR_SIZE + 7] = b'\xffCD001\x01'
+    with open(path, 'wb') as image_fh:
+        image_fh.write(image)
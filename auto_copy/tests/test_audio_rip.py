@@ -0,0 +1,94 @@
+# test_audio_rip.py
+# tests for audio_rip.py
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from .. import audio_rip
+
+CDPARANOIA_TOC = """cdparanoia III release 10.2 (September 11, 2008)
+
+Table of contents (audio tracks only):
+track        length               begin        copy pre ch
+===========================================================
+  1.    16503 [03:40.03]        0 [00:00.00]    no   no  2
+  2.    20745 [04:36.45]    16503 [03:40.03]    no   no  2
+ 10.     9000 [02:00.00]    37248 [08:16.48]    no   no  2
+TOTAL   46248 [10:16.48]    (audio only)
+"""
+
+# writes the track number into the wav, fails for track 2
+FAKE_CDPARANOIA = """
+import sys
+if '-Q' in sys.argv:
+    sys.stderr.write('''%s''')
+    sys.exit(0)
+track = sys.argv[sys.argv.index('-w') + 1]
+if track == '2':
+    sys.exit(1)
+open(sys.argv[-1], 'w').write(track)
+""" % CDPARANOIA_TOC
+
+# copies the wav, wherever the output goes
+FAKE_ENCODER = """
+import sys
+args = sys.argv[1:]
+outfile = args[args.index('-o') + 1] if '-o' in args else args[-1]
+wav = [arg for arg in args if arg.endswith('.wav')][0]
+open(outfile, 'w').write(open(wav).read())
+"""
+
+class Config(object):
+    mp3_bitrate = '320'
+    opus_bitrate = '160'
+    tool_timeout = 120
+    job_timeout = 0
+    stall_timeout = 900
+
+class testAudioRip(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.device = os.path.join(self.tmp_dir, 'cd.img')
+        open(self.device, 'w').close()
+        self.config = Config()
+        self.config.cdparanoia = self.tool('cdparanoia', FAKE_CDPARANOIA)
+        self.config.lame = self.tool('lame', FAKE_ENCODER)
+        self.config.flac = self.tool('flac', FAKE_ENCODER)
+        self.config.opusenc = self.tool('opusenc', FAKE_ENCODER)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def tool(self, name, code):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as tool_fh:
+            tool_fh.write('#!' + sys.executable + '\n' + code)
+        os.chmod(path, 0o755)
+        return path
+
+    def test_parse_toc(self):
+        """Tracks and their lengths are read from cdparanoia"""
+        tracks = audio_rip.parse_cdparanoia_toc(CDPARANOIA_TOC)
+        self.assertEqual([(track.number, track.sectors) for track in tracks],
+                         [(1, 16503), (2, 20745), (10, 9000)])
+
+    def test_rip_disc(self):
+        """Every track read is encoded to every format, the drive is released before"""
+        out_dir = os.path.join(self.tmp_dir, 'out')
+        ejected = []
+        def on_read_done():
+            ejected.append(sorted(os.listdir(os.path.join(out_dir, '.wav'))))
+        tracks = audio_rip.rip_disc(self.config, self.device, out_dir, ['mp3', 'flac', 'opus'],
+                                    workers=2, on_read_done=on_read_done)
+        self.assertEqual(ejected, [['track_01.wav', 'track_10.wav']])
+        self.assertEqual([track.outputs for track in tracks],
+                         [['mp3', 'flac', 'opus'], [], ['mp3', 'flac', 'opus']])
+        self.assertEqual(tracks[1].failed, ['mp3', 'flac', 'opus'])
+        self.assertEqual(sorted(os.listdir(out_dir)),
+                         ['track_01.flac', 'track_01.mp3', 'track_01.opus',
+                          'track_10.flac', 'track_10.mp3', 'track_10.opus'])
+        with open(os.path.join(out_dir, 'track_10.opus')) as track_fh:
+            self.assertEqual(track_fh.read(), '10')
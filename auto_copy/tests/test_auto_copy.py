@@ -1,7 +1,12 @@
 # test_auto_copy.py
 # tests for auto_copy.py
 
+import os
+import shutil
+import sys
+import tempfile
 import unittest
+from unittest import mock
 from .. import auto_copy
 
 class testAutocopy(unittest.TestCase):
@@ -13,4 +18,255 @@ class testAutocopy(unittest.TestCase):
         self.assertEqual(config.max_tracks, 10)
         self.assertTrue(isinstance(config.max_tracks, int))
 
+    def test_distributed_needs_token(self):
+        """A coordinator port without a token is refused"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        config_file = os.path.join(tmp_dir, 'auto_copy.yml')
+        with open('auto_copy.yml.example') as example_fh, open(config_file, 'w') as config_fh:
+            config_fh.write(example_fh.read().replace('distributed_port : 0',
+                                                      'distributed_port : 8765'))
+        with self.assertRaises(auto_copy.config_parser.IllegalConfigValue):
+            auto_copy.read_config(config_file)
 
+    def test_drive_configs_single(self):
+        """Without cdrom_devices, cdrom_device is used"""
+        config = auto_copy.read_config('auto_copy.yml.example')
+        drives = auto_copy.drive_configs(config)
+        self.assertEqual(len(drives), 1)
+        self.assertEqual(drives[0].cdrom_device, '/dev/sr0')
+        self.assertEqual(drives[0].cdrom_mnt, '/mnt/cdrom')
+
+    def test_drive_configs_multiple(self):
+        """Each drive gets its own device and mount point"""
+        config = auto_copy.read_config('auto_copy.yml.example')
+        config.cdrom_devices = ['/dev/sr0', {'device': '/dev/sr1', 'mnt': '/mnt/dvd'}]
+        drives = auto_copy.drive_configs(config)
+        self.assertEqual([d.cdrom_device for d in drives], ['/dev/sr0', '/dev/sr1'])
+        self.assertEqual([d.cdrom_mnt for d in drives], ['/mnt/cdrom_sr0', '/mnt/dvd'])
+        # the original config is left alone
+        self.assertEqual(config.cdrom_device, '/dev/sr0')
+
+    def test_iter_large_files(self):
+        """Small and excluded files are skipped while walking"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for rel_path, size in [('a.mkv', 300), ('small.txt', 10), ('sub/b.mkv', 300),
+                                   ('sub/c.iso', 300), ('skip/d.mkv', 300)]:
+                path = os.path.join(tmp_dir, rel_path)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as file_fh:
+                    file_fh.write(b'x' * size)
+            found = auto_copy.iter_large_files(tmp_dir, 100, exclude=['skip'])
+            self.assertEqual(sorted(os.path.relpath(path, tmp_dir) for path, size in found),
+                             ['a.mkv', 'sub/b.mkv', 'sub/c.iso'])
+            found = auto_copy.iter_large_files(tmp_dir, 100, include=['*.mkv'], exclude=['skip'])
+            self.assertEqual(sorted(os.path.relpath(path, tmp_dir) for path, size in found),
+                             ['a.mkv', 'sub/b.mkv'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_setup_logging(self):
+        """Records are written through the queue at the configured level, and rotated"""
+        tmp_dir = tempfile.mkdtemp()
+        config = auto_copy.read_config('auto_copy.yml.example')
+        config.log_file = os.path.join(tmp_dir, 'auto_copy.log')
+        config.log_max_mb = 0.001
+        config.log_backup_count = 1
+        handlers = list(auto_copy.LOGGER.handlers)
+        level = auto_copy.LOGGER.level
+        listener = auto_copy.setup_logging(config)
+        try:
+            listener.handlers[0].setStream(open(os.devnull, 'w'))
+            auto_copy.LOGGER.debug('hidden %s', 'debug')
+            for num in range(30):
+                auto_copy.LOGGER.info('visible %s', num)
+        finally:
+            auto_copy.atexit.unregister(listener.stop)
+            listener.stop()
+            listener.handlers[0].stream.close()
+            auto_copy.LOGGER.handlers = handlers
+            auto_copy.LOGGER.setLevel(level)
+        with open(config.log_file) as log_fh:
+            log = log_fh.read()
+        self.assertIn('visible 29', log)
+        self.assertNotIn('hidden', log)
+        self.assertEqual(sorted(os.listdir(tmp_dir)), ['auto_copy.log', 'auto_copy.log.1'])
+        shutil.rmtree(tmp_dir)
+
+    def test_resolve_tools(self):
+        """Tools are looked up once, bare names on PATH, missing ones reported"""
+        config = auto_copy.read_config('auto_copy.yml.example')
+        config.handbrakecli = 'sh'
+        config.cdparanoia = '/nonexistent/cdparanoia'
+        config.audio_ripper = 'native'
+        config.audio_formats = ['flac']
+        config.flac = auto_copy.sys.executable
+        config.segment_encoding = False
+        self.assertEqual(auto_copy.resolve_tools(config), ['cdparanoia'])
+        self.assertEqual(config.handbrakecli, shutil.which('sh'))
+        self.assertTrue(os.path.isabs(config.flac))
+        self.assertEqual(config.cdparanoia, '/nonexistent/cdparanoia')
+
+    def test_stage_disc_resumes(self):
+        """A disc taken out before it was imaged completely is resumed when inserted again"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        config = auto_copy.read_config('auto_copy.yml.example')
+        config.cdrom_device = os.path.join(tmp_dir, 'sr0')
+        config.staging_dir = os.path.join(tmp_dir, 'staging')
+        config.rescue_block_size = 1024
+        data = os.urandom(4 * 1024 * 1024)
+        with open(config.cdrom_device, 'wb') as device_fh:
+            device_fh.write(data)
+        my_disc = mock.Mock(fingerprint='0123456789abcdef' * 4)
+        clock = [1000.0]
+        reads = []
+        rescue = auto_copy.rescue
+        real_pread = rescue.Rescuer.pread
+
+        def pread(rescuer, size, start):
+            clock[0] += 60
+            reads.append(start)
+            return real_pread(rescuer, size, start)
+        with mock.patch.object(rescue.Rescuer, 'pread', pread), \
+                mock.patch.object(rescue.time, 'time', lambda: clock[0]):
+            config.job_timeout = 100
+            with self.assertRaises(auto_copy.IncompleteImageException):
+                auto_copy.stage_disc(config, my_disc)
+            self.assertEqual(len(reads), 2)
+            config.job_timeout = 0
+            image = auto_copy.stage_disc(config, my_disc)
+        self.assertEqual(image, os.path.join(config.staging_dir, 'disc_0123456789abcdef.iso'))
+        self.assertEqual(len(reads), 4)
+        with open(image, 'rb') as image_fh:
+            self.assertEqual(image_fh.read(), data)
+        self.assertEqual(os.listdir(config.staging_dir), ['disc_0123456789abcdef.iso'])
+        # still staged, e.g. while its encodes run: not read again, see
+        # test_staged_image_queued_once for its jobs
+        self.assertEqual(auto_copy.stage_disc(config, my_disc), image)
+        self.assertEqual(len(reads), 4)
+
+    def test_staged_image_queued_once(self):
+        """A disc inserted again while its image is encoded gets no second set of jobs"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        config = auto_copy.read_config('auto_copy.yml.example')
+        config.encode_queue_file = os.path.join(tmp_dir, 'queue.db')
+        image = os.path.join(tmp_dir, 'disc_0123456789abcdef.iso')
+        jobs = [{'source': image, 'title': num, 'outfile': 'movie_%s.mkv' % num,
+                 'command': ['true']} for num in (1, 2)]
+        encoder = auto_copy.open_encode_queue(config, workers=None)
+        finished = []
+        with mock.patch.object(auto_copy, 'encode_jobs', lambda *args, **kwargs: jobs):
+            for _ in range(2):
+                auto_copy.encode_staged_image(config, image, encoder,
+                                              on_finished=finished.append)
+        self.assertEqual(encoder.execute('SELECT COUNT(*) FROM jobs').fetchone()[0], 2)
+        self.assertEqual(len(encoder.unfinished(image)), 2)
+        for job_id in encoder.unfinished(image):
+            encoder.finish(encoder.get(job_id), 0)
+        self.assertEqual(finished, [True, True])
+
+    def test_manual_encode_leaves_daemon_jobs(self):
+        """The workers of a manual run only take the jobs of its own image"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        config = auto_copy.read_config('auto_copy.yml.example')
+        config.encode_queue_file = os.path.join(tmp_dir, 'queue.db')
+        config.encode_workers = 2
+        image = os.path.join(tmp_dir, 'disc_0123456789abcdef.iso')
+        with open(image, 'w') as image_fh:
+            image_fh.write('image')
+        job = {'source': image, 'title': 1, 'outfile': os.path.join(tmp_dir, 'movie.mkv'),
+               'command': [sys.executable, '-c', 'pass']}
+        daemon = auto_copy.open_encode_queue(config, workers=None)
+        other = daemon.insert(dict(job, source=os.path.join(tmp_dir, 'other.iso')),
+                              auto_copy.encode_queue.QUEUED)
+        finished = []
+        with mock.patch.object(auto_copy, 'encode_jobs', lambda *args, **kwargs: [job]):
+            auto_copy.encode_staged_image(config, image, on_finished=finished.append)
+        self.assertEqual(finished, [True])
+        self.assertEqual(daemon.get(other)['state'], auto_copy.encode_queue.QUEUED)
+
+    def test_failed_verification_leaves_no_copy(self):
+        """A copy that does not match its checksum is removed"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        config = auto_copy.read_config('auto_copy.yml.example')
+        config.cdrom_mnt = os.path.join(tmp_dir, 'cdrom')
+        config.data_dir = os.path.join(tmp_dir, 'data')
+        config.min_file_size = 0
+        config.verify_copies = True
+        os.makedirs(config.cdrom_mnt)
+        os.makedirs(config.data_dir)
+        with open(os.path.join(config.cdrom_mnt, 'movie.vob'), 'wb') as movie_fh:
+            movie_fh.write(os.urandom(1024))
+        copier = auto_copy.copier
+        real_copy_file = copier.copy_file
+
+        def copy_file(source, dest_dir):
+            result = real_copy_file(source, dest_dir)
+            with open(result.dest, 'r+b') as dest_fh:
+                dest_fh.write(b'bad')
+            return result
+        with mock.patch.object(auto_copy, 'mount'), mock.patch.object(auto_copy, 'umount'), \
+                mock.patch.object(copier, 'copy_file', copy_file):
+            self.assertFalse(auto_copy.copy_large_files(config))
+        self.assertEqual(os.listdir(config.data_dir), [])
+
+    def test_staged_dvd_is_scanned_first(self):
+        """The drive is authenticated by a scan before the image is read, the scan is reused"""
+        config = auto_copy.read_config('auto_copy.yml.example')
+        config.video_mode = 'staged'
+        my_disc = mock.Mock(media_type='VIDEO_DVD', device=config.cdrom_device)
+        runtime = mock.Mock(index=None, encoder=None, mover=None)
+        calls = []
+        with mock.patch.object(auto_copy.title_scan, 'scan',
+                               lambda source, **kwargs: calls.append('scan') or ['title']), \
+                mock.patch.object(auto_copy, 'stage_disc',
+                                  lambda config, my_disc: calls.append('stage') or 'disc.iso'), \
+                mock.patch.object(auto_copy, 'eject'), \
+                mock.patch.object(auto_copy, 'encode_staged_image') as encode_staged_image:
+            self.assertTrue(auto_copy.process_disc(config, my_disc, runtime))
+        self.assertEqual(calls, ['scan', 'stage'])
+        self.assertEqual(encode_staged_image.call_args[1]['titles'], ['title'])
+
+    def test_spooled_encodes_pass_limits(self):
+        """With a HandBrake worker, priority and limits go to it instead of hb_client"""
+        config = auto_copy.read_config('auto_copy.yml.example')
+        config.handbrake_spool = '/var/spool/handbrake'
+        config.job_memory_mb = 2048
+        self.assertEqual(auto_copy.open_scheduler(config).prefix, [])
+        limits = auto_copy.spool_limits(config)
+        self.assertEqual((limits['nice'], limits['idle_io'], limits['memory_mb']),
+                         (config.encode_nice, config.encode_idle_io, 2048))
+        env = auto_copy.handbrake_env(config)
+        self.assertEqual(env['HANDBRAKE_SPOOL'], '/var/spool/handbrake')
+        self.assertEqual(auto_copy.json.loads(env['HANDBRAKE_LIMITS']), limits)
+
+    def test_spool_config_keeps_environment(self):
+        """The spool directory reaches hb_client only, not everything else we run"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        config_file = os.path.join(tmp_dir, 'auto_copy.yml')
+        with open('auto_copy.yml.example') as example_fh, open(config_file, 'w') as config_fh:
+            config_fh.write(example_fh.read().replace("handbrake_spool : ''",
+                                                      "handbrake_spool : '/var/spool/handbrake'"))
+        with mock.patch.dict(os.environ, clear=False):
+            os.environ.pop('HANDBRAKE_SPOOL', None)
+            config = auto_copy.read_config(config_file)
+            self.assertNotIn('HANDBRAKE_SPOOL', os.environ)
+        self.assertEqual(config.handbrakecli, config.hb_client)
+        self.assertIsNone(auto_copy.handbrake_env(auto_copy.read_config('auto_copy.yml.example')))
+
+    def test_tray_closed_without_trayopen(self):
+        """A missing trayopen is an error the caller can handle, not an exit"""
+        config = auto_copy.read_config('auto_copy.yml.example')
+        config.trayopen = '/nonexistent/trayopen'
+        my_lock = mock.Mock()
+        with mock.patch.object(auto_copy.time, 'sleep'):
+            with self.assertRaises(auto_copy.TrayopenNotFoundException):
+                auto_copy.tray_closed(config, my_lock)
+        my_lock.release_lock.assert_called_once_with(None, None)
@@ -0,0 +1,113 @@
+# test_auto_copy_daemon.py
+# tests for auto_copy_daemon.py and send_siguser1.sh
+
+import asyncio
+import concurrent.futures
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from .. import auto_copy
+from .. import auto_copy_daemon
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SEND_SIGUSER1 = os.path.join(os.path.dirname(HERE), 'send_siguser1.sh')
+
+class testDaemon(unittest.TestCase):
+
+    def setUp(self):
+        # 'import auto_copy' in auto_copy_daemon.py finds this package instead of the module
+        patcher = mock.patch.object(auto_copy_daemon, 'auto_copy', auto_copy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.event_dir = os.path.join(self.tmp_dir, 'events')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_pending_devices(self):
+        """Events udev left are collected once"""
+        self.assertEqual(auto_copy_daemon.pending_devices(self.event_dir), [])
+        os.mkdir(self.event_dir)
+        for device in ('sr0', 'sr1'):
+            open(os.path.join(self.event_dir, device), 'w').close()
+        self.assertEqual(sorted(auto_copy_daemon.pending_devices(self.event_dir)),
+                         ['sr0', 'sr1'])
+        self.assertEqual(auto_copy_daemon.pending_devices(self.event_dir), [])
+
+    def test_notify(self):
+        """Only the drives that changed are woken, each at most once"""
+        async def check():
+            queues = {'sr0': asyncio.Queue(), 'sr1': asyncio.Queue()}
+            os.mkdir(self.event_dir)
+            open(os.path.join(self.event_dir, 'sr1'), 'w').close()
+            auto_copy_daemon.on_signal(queues, self.event_dir)
+            self.assertEqual((queues['sr0'].qsize(), queues['sr1'].qsize()), (0, 1))
+            auto_copy_daemon.notify(queues, ['/dev/sr1', 'sr2'])
+            self.assertEqual(queues['sr1'].qsize(), 1)
+            # a signal without events, e.g. from an old udev rule, wakes all drives
+            auto_copy_daemon.on_signal(queues, self.event_dir)
+            self.assertEqual((queues['sr0'].qsize(), queues['sr1'].qsize()), (1, 1))
+        asyncio.run(check())
+
+    def test_drives_work_in_parallel(self):
+        """A busy drive does not hold up the others, errors do not stop a worker"""
+        started = []
+        both_started = threading.Barrier(2, timeout=5)
+
+        def fake_auto_copy(config, runtime):
+            started.append(config.cdrom_device)
+            both_started.wait()
+            if config.cdrom_device == '/dev/sr1':
+                raise IOError('read error')
+
+        async def check():
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+            queues = {}
+            workers = []
+            for device in ('/dev/sr0', '/dev/sr1'):
+                config = mock.Mock(cdrom_device=device)
+                queues[os.path.basename(device)] = asyncio.Queue()
+                workers.append(asyncio.ensure_future(auto_copy_daemon.drive_worker(
+                    config, queues[os.path.basename(device)], None, executor)))
+            auto_copy_daemon.notify(queues, ['sr0', 'sr1'])
+            while len(started) < 2 or any(not events.empty() for events in queues.values()):
+                await asyncio.sleep(0.01)
+            # the worker of sr1 survived its error
+            both_started.reset()
+            auto_copy_daemon.notify(queues, ['sr1', 'sr0'])
+            while len(started) < 4:
+                await asyncio.sleep(0.01)
+            for worker in workers:
+                worker.cancel()
+            executor.shutdown()
+        with mock.patch.object(auto_copy, 'auto_copy', fake_auto_copy):
+            asyncio.run(asyncio.wait_for(check(), 10))
+        self.assertEqual(sorted(started), ['/dev/sr0', '/dev/sr0', '/dev/sr1', '/dev/sr1'])
+
+    def test_send_siguser1_event_dir(self):
+        """The udev script drops its event where the configuration says"""
+        config_file = os.path.join(self.tmp_dir, 'auto_copy.yml')
+        with open(config_file, 'w') as config_fh:
+            config_fh.write("data_dir : '/mnt/video/new'\nevent_dir : '" + self.event_dir
+                            + "'\n")
+        # no daemon to signal, this very test would match otherwise
+        bin_dir = os.path.join(self.tmp_dir, 'bin')
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, 'ps'), 'w') as ps_fh:
+            ps_fh.write('#!/bin/sh\n')
+        os.chmod(os.path.join(bin_dir, 'ps'), 0o755)
+        env = dict(os.environ, AUTO_COPY_CONFIG=config_file,
+                   PATH=bin_dir + os.pathsep + os.environ['PATH'])
+        env.pop('AUTO_COPY_EVENT_DIR', None)
+        subprocess.run(['bash', SEND_SIGUSER1, 'sr1'], env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        self.assertEqual(os.listdir(self.event_dir), ['sr1'])
+        other_dir = os.path.join(self.tmp_dir, 'other')
+        subprocess.run(['bash', SEND_SIGUSER1, 'sr0'], env=dict(env, AUTO_COPY_EVENT_DIR=other_dir),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.assertEqual(os.listdir(other_dir), ['sr0'])
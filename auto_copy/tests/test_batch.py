@@ -0,0 +1,103 @@
+# test_batch.py
+# tests for batch.py
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from .. import auto_copy
+from .. import batch
+from .iso_fixture import make_iso
+
+class testBatch(unittest.TestCase):
+
+    def setUp(self):
+        # 'import auto_copy' in batch.py finds this package instead of the module
+        patcher = mock.patch.object(batch, 'auto_copy', auto_copy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.config = auto_copy.read_config('auto_copy.yml.example')
+        self.config.cdrom_mnt = os.path.join(self.tmp_dir, 'mnt')
+        self.config.ingest_index_file = ''
+        self.config.metadata_cache_file = ''
+        self.state_file = os.path.join(self.tmp_dir, 'state', 'batch.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def image(self, rel_path, volume_id, files):
+        path = os.path.join(self.tmp_dir, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        make_iso(path, volume_id, files)
+        return path
+
+    def test_find_images(self):
+        """Directories are searched for images, patterns expanded"""
+        first = self.image('archive/a.iso', 'A', {'README.TXT': b'a'})
+        second = self.image('archive/sub/b.BIN', 'B', {'README.TXT': b'b'})
+        third = self.image('other/c.img', 'C', {'README.TXT': b'c'})
+        with open(os.path.join(self.tmp_dir, 'archive', 'notes.txt'), 'w') as notes_fh:
+            notes_fh.write('not an image')
+        self.assertEqual(batch.find_images([os.path.join(self.tmp_dir, 'archive'),
+                                            os.path.join(self.tmp_dir, 'o*', '*.img'), first]),
+                         sorted([first, second, third]))
+
+    def test_resume(self):
+        """Images are processed in parallel, a second run only retries the failed ones"""
+        images = [self.image('data.iso', 'DATA', {'FILE.BIN': b'data'}),
+                  self.image('movie.iso', 'MOVIE', {'VIDEO_TS/VIDEO_TS.IFO': b'ifo'}),
+                  self.image('broken.iso', 'BROKEN', {'FILE.BIN': b'data'})]
+        garbage = os.path.join(self.tmp_dir, 'garbage.iso')
+        with open(garbage, 'wb') as garbage_fh:
+            garbage_fh.write(b'\0' * 100000)
+        images.append(garbage)
+        calls = []
+
+        def process_disc(config, my_disc, runtime, in_drive=True):
+            self.assertFalse(in_drive)
+            calls.append((my_disc.device, my_disc.media_type, config.cdrom_mnt))
+            if my_disc.label == 'BROKEN':
+                raise IOError('read error')
+            return True
+        with mock.patch.object(auto_copy, 'process_disc', process_disc):
+            results = batch.run_batch(self.config, images, batch.BatchState(self.state_file),
+                                      auto_copy.Runtime(self.config), jobs=2)
+            self.assertEqual(dict((os.path.basename(image), result['result'])
+                                  for image, result in results.items()),
+                             {'data.iso': batch.DONE, 'movie.iso': batch.DONE,
+                              'broken.iso': batch.FAILED, 'garbage.iso': batch.SKIPPED})
+            self.assertEqual(sorted((os.path.basename(device), media_type)
+                                    for device, media_type, mnt in calls),
+                             [('broken.iso', 'DATA'), ('data.iso', 'DATA'),
+                              ('movie.iso', 'VIDEO_DVD')])
+            self.assertTrue(set(mnt for device, media_type, mnt in calls)
+                            <= set([self.config.cdrom_mnt + '_batch0',
+                                    self.config.cdrom_mnt + '_batch1']))
+            self.assertIn('1 failed', batch.report(results, 1))
+            del calls[:]
+            results = batch.run_batch(self.config, images, batch.BatchState(self.state_file),
+                                      auto_copy.Runtime(self.config), jobs=2)
+        self.assertEqual([os.path.basename(device) for device, media_type, mnt in calls],
+                         ['broken.iso'])
+        self.assertEqual(list(results), [images[2]])
+
+    def test_failed_encode_is_not_recorded(self):
+        """A disc whose encodes failed is not recorded as ingested, so a retry reads it again"""
+        self.config.ingest_index_file = os.path.join(self.tmp_dir, 'index.sqlite')
+        self.config.encode_queue_file = os.path.join(self.tmp_dir, 'queue.sqlite')
+        self.config.data_dir = os.path.join(self.tmp_dir, 'data')
+        self.config.handbrakecli = 'false'
+        self.config.metadata_backend = 'none'
+        self.config.max_tracks = 1
+        images = [self.image('movie.iso', 'MOVIE', {'VIDEO_TS/VIDEO_TS.IFO': b'ifo'})]
+        for attempt in range(2):
+            runtime = auto_copy.Runtime(self.config, auto_copy.open_encode_queue(
+                self.config, workers=None))
+            results = batch.run_batch(self.config, images, batch.BatchState(self.state_file),
+                                      runtime)
+            self.assertEqual(results[images[0]]['result'], batch.FAILED)
+            self.assertEqual(results[images[0]]['note'], '1 encodes failed')
+            self.assertEqual(runtime.index.execute('SELECT COUNT(*) FROM discs').fetchone()[0], 0)
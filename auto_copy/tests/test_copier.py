@@ -0,0 +1,104 @@
+# test_copier.py
+# tests for copier.py
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from .. import copier
+
+class testCopier(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp_dir, 'movie.mkv')
+        self.dest_dir = os.path.join(self.tmp_dir, 'dest')
+        os.mkdir(self.dest_dir)
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        with open(self.source, 'wb') as source:
+            source.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_dest(self):
+        with open(os.path.join(self.dest_dir, 'movie.mkv'), 'rb') as dest:
+            return dest.read()
+
+    def test_copy_with_checksum(self):
+        """Data and checksum are right, no partial file is left"""
+        result = copier.copy_file(self.source, self.dest_dir, buffer_size=1024 * 1024)
+        self.assertEqual(self.read_dest(), self.data)
+        self.assertEqual(result.checksum, hashlib.sha256(self.data).hexdigest())
+        self.assertTrue(copier.verify(result))
+        self.assertListEqual(os.listdir(self.dest_dir), ['movie.mkv'])
+
+    def test_copy_without_checksum(self):
+        """The fast path copies the data as well"""
+        result = copier.copy_file(self.source, self.dest_dir, checksum=False)
+        self.assertEqual(self.read_dest(), self.data)
+        self.assertIsNone(result.checksum)
+
+    def test_resume(self):
+        """An interrupted copy continues where it stopped"""
+        partial = self.interrupted_copy(self.source, 1000000)
+        result = copier.copy_file(self.source, self.dest_dir)
+        self.assertEqual(result.resumed_at, 1000000)
+        self.assertEqual(self.read_dest(), self.data)
+        self.assertEqual(result.checksum, hashlib.sha256(self.data).hexdigest())
+        self.assertListEqual(os.listdir(self.dest_dir), ['movie.mkv'])
+
+    def interrupted_copy(self, source, length):
+        """Leave the first length bytes of a copy of source, as an interruption would"""
+        partial = copier.part_path(os.path.join(self.dest_dir, 'movie.mkv'), source)
+        with open(copier.source_info_path(partial), 'w') as info_fh:
+            copier.json.dump(copier.source_info(source, os.path.getsize(source)), info_fh)
+        with open(source, 'rb') as source_fh, open(partial, 'wb') as partial_fh:
+            partial_fh.write(source_fh.read(length))
+        return partial
+
+    def test_stale_partial_is_discarded(self):
+        """A partial copy of another file, or of an older version, is not resumed"""
+        other_dir = os.path.join(self.tmp_dir, 'other')
+        os.mkdir(other_dir)
+        other = os.path.join(other_dir, 'movie.mkv')
+        with open(other, 'wb') as other_fh:
+            other_fh.write(os.urandom(2000000))
+        self.interrupted_copy(other, 1000000)
+        self.interrupted_copy(self.source, 1000000)
+        with open(self.source, 'r+b') as source_fh:
+            source_fh.write(b'changed')
+        os.utime(self.source, (0, 0))
+        result = copier.copy_file(self.source, self.dest_dir)
+        self.assertEqual(result.resumed_at, 0)
+        with open(self.source, 'rb') as source_fh:
+            self.assertEqual(self.read_dest(), source_fh.read())
+        # the partial copy of the other source is left for it
+        result = copier.copy_file(other, self.dest_dir)
+        self.assertEqual(result.resumed_at, 1000000)
+        self.assertListEqual(os.listdir(self.dest_dir), ['movie.mkv'])
+
+    def test_discard(self):
+        """A bad copy is removed along with the partial copy of its source"""
+        result = copier.copy_file(self.source, self.dest_dir)
+        self.interrupted_copy(self.source, 1000000)
+        copier.discard(result)
+        self.assertListEqual(os.listdir(self.dest_dir), [])
+
+    def test_manifest(self):
+        """The manifest lists the copies like sha256sum does"""
+        result = copier.copy_file(self.source, self.dest_dir)
+        manifest = os.path.join(self.dest_dir, 'disc.sha256')
+        copier.write_manifest([result], manifest)
+        with open(manifest) as manifest_fh:
+            self.assertEqual(manifest_fh.read(), result.checksum + '  movie.mkv\n')
+
+    def test_manifest_moved(self):
+        """A manifest written for another directory lists the paths relative to that one"""
+        result = copier.copy_file(self.source, self.dest_dir)
+        result.dest = os.path.join(self.tmp_dir, 'data', 'movie_1.mkv')
+        manifest = os.path.join(self.dest_dir, 'disc.sha256')
+        copier.write_manifest([result], manifest, os.path.join(self.tmp_dir, 'data'))
+        with open(manifest) as manifest_fh:
+            self.assertEqual(manifest_fh.read(), result.checksum + '  movie_1.mkv\n')
@@ -0,0 +1,50 @@
+# test_disc.py
+# tests for disc.py and disc_fs.py
+
+import os
+import shutil
+import tempfile
+import unittest
+from .. import disc
+from .. import disc_fs
+from .iso_fixture import make_iso
+
+class testDisc(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmp_dir, 'disc.iso')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_iso9660(self):
+        """Volume name, directories and files are read without mounting"""
+        ifo = b'DVDVIDEO-VMG' + b'\0' * 3000
+        make_iso(self.image, 'MY_MOVIE', {'VIDEO_TS/VIDEO_TS.IFO': ifo, 'README.TXT': b'hi'})
+        volume = disc_fs.Volume(self.image)
+        self.assertEqual(volume.file_system, 'iso9660')
+        self.assertEqual(volume.volume_id, 'MY_MOVIE')
+        self.assertEqual(sorted(entry.name for entry in volume.listdir()),
+                         ['README.TXT', 'VIDEO_TS'])
+        self.assertEqual(volume.read_file(volume.find('video_ts/video_ts.ifo')), ifo)
+        self.assertIsNone(volume.find('AUDIO_TS'))
+
+    def test_no_file_system(self):
+        """Garbage is rejected"""
+        with open(self.image, 'wb') as image:
+            image.write(b'\0' * 40000)
+        with self.assertRaises(disc_fs.NoFileSystemException):
+            disc_fs.Volume(self.image)
+
+    def test_detect(self):
+        """Video DVDs and data discs are told apart"""
+        make_iso(self.image, 'MY_MOVIE', {'VIDEO_TS/VIDEO_TS.IFO': b'DVDVIDEO-VMG'})
+        my_disc = disc.detect(self.image)
+        self.assertEqual(my_disc.media_type, disc.VIDEO_DVD)
+        self.assertEqual(my_disc.label, 'MY_MOVIE')
+        self.assertEqual(disc.detect(self.image).fingerprint, my_disc.fingerprint)
+        make_iso(self.image, 'BACKUP', {'PHOTOS/IMG_0001.JPG': b'jpeg'})
+        data_disc = disc.detect(self.image)
+        self.assertEqual(data_disc.media_type, disc.DATA)
+        self.assertNotEqual(data_disc.fingerprint, my_disc.fingerprint)
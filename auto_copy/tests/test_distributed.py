@@ -0,0 +1,115 @@
+# test_distributed.py
+# tests for distributed.py
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+from .. import distributed
+from .. import encode_queue
+
+WORKER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'distributed.py')
+
+# a HandBrakeCLI "encoding" by reversing its input
+FAKE_HANDBRAKE = """
+import sys
+data = open(sys.argv[sys.argv.index('-i') + 1], 'rb').read()
+sys.stdout.write('Encoding: task 1 of 1, 100.00 % (30.00 fps, avg 25.00 fps, ETA 00h00m00s)\\r')
+open(sys.argv[sys.argv.index('-o') + 1], 'wb').write(data[::-1])
+"""
+
+class testDistributed(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.handbrakecli = os.path.join(self.tmp_dir, 'HandBrakeCLI')
+        with open(self.handbrakecli, 'w') as tool_fh:
+            tool_fh.write('#!' + sys.executable + '\n' + FAKE_HANDBRAKE)
+        os.chmod(self.handbrakecli, 0o755)
+        self.queue = encode_queue.EncodeQueue(os.path.join(self.tmp_dir, 'queue.sqlite'),
+                                              workers=None)
+        self.coordinator = distributed.Coordinator(self.queue, token='secret', lease=1)
+        server = self.coordinator.serve(0, '127.0.0.1')
+        self.url = 'http://127.0.0.1:' + str(server.server_address[1])
+
+    def tearDown(self):
+        self.coordinator.server.shutdown()
+        shutil.rmtree(self.tmp_dir)
+
+    def image(self, name, size):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as image_fh:
+            image_fh.write(os.urandom(size))
+        return path
+
+    def submit(self, image, title):
+        outfile = os.path.join(self.tmp_dir, 'title_' + str(title) + '.mp4')
+        command = ['/bin/HandBrakeCLI', '-i', image, '-o', outfile, '-t', str(title),
+                   '--x264-preset', 'slow']
+        self.queue.submit([{'source': image, 'title': title, 'outfile': outfile,
+                            'command': command}], cleanup=image)
+        return outfile
+
+    def check_done(self, image, outfiles, content):
+        for outfile in outfiles:
+            with open(outfile, 'rb') as outfile_fh:
+                self.assertEqual(outfile_fh.read(), content[::-1])
+        self.assertFalse(os.path.exists(image))
+        states = [job['state'] for job in self.queue.execute('SELECT state FROM jobs')]
+        self.assertEqual(states, [encode_queue.DONE] * len(outfiles))
+
+    def test_worker_processes(self):
+        """Several worker processes share the jobs of a queue"""
+        image = self.image('disc.iso', 100000)
+        with open(image, 'rb') as image_fh:
+            content = image_fh.read()
+        outfiles = [self.submit(image, title) for title in (1, 2, 3)]
+        workers = [subprocess.Popen(
+            [sys.executable, WORKER, '--coordinator', self.url, '--token', 'secret',
+             '--work-dir', os.path.join(self.tmp_dir, 'worker' + str(num)),
+             '--handbrakecli', self.handbrakecli, '--name', 'worker' + str(num), '--once'],
+            stderr=subprocess.DEVNULL) for num in range(2)]
+        self.assertEqual([worker.wait(60) for worker in workers], [0, 0])
+        self.check_done(image, outfiles, content)
+        self.assertEqual(self.queue.preset_speeds(), {'slow': 25.0})
+
+    def test_dead_worker(self):
+        """A job of a worker that stopped reporting is done by another one"""
+        image = self.image('disc.iso', 5000)
+        with open(image, 'rb') as image_fh:
+            content = image_fh.read()
+        outfiles = [self.submit(image, 1)]
+        dead = distributed.Worker(self.url, os.path.join(self.tmp_dir, 'dead'), name='dead',
+                                  token='secret')
+        job = dead.claim()
+        self.assertEqual(job['source_size'], 5000)
+        time.sleep(1.1)
+        worker = distributed.Worker(self.url, os.path.join(self.tmp_dir, 'alive'),
+                                    handbrakecli=self.handbrakecli, name='alive', token='secret')
+        # small chunks, so download and upload take several requests
+        with mock.patch.object(distributed, 'CHUNK_SIZE', 1000):
+            worker.run(once=True)
+        self.check_done(image, outfiles, content)
+        self.assertEqual(self.queue.get(job['id'])['attempts'], 2)
+        with self.assertRaises(distributed.LeaseLost):
+            dead.call('POST', '/jobs/' + str(job['id']) + '/heartbeat', {'worker': 'dead'})
+
+    def test_token(self):
+        """Workers without the token get nothing"""
+        request = urllib.request.Request(self.url + '/claim', data=b'{}', method='POST')
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        self.assertEqual(error.exception.code, 403)
+
+    def test_no_token_only_local(self):
+        """Without a token, the coordinator does not listen on other interfaces"""
+        open_coordinator = distributed.Coordinator(self.queue)
+        with self.assertRaises(ValueError):
+            open_coordinator.serve(0, '0.0.0.0')
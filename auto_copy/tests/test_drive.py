@@ -0,0 +1,23 @@
+# test_drive.py
+# tests for drive.py
+
+import tempfile
+import unittest
+from .. import drive
+
+class testDrive(unittest.TestCase):
+
+    def test_image_is_ready(self):
+        """An image file needs no waiting"""
+        with tempfile.NamedTemporaryFile() as image:
+            self.assertEqual(drive.wait_until_ready(image.name, timeout=1), drive.CDS_DISC_OK)
+
+    def test_parse_uevent(self):
+        """Media change events of optical drives are recognized"""
+        data = b'change@/devices/pci0000:00/ata2/host1/target1:0:0/1:0:0:0/block/sr0\0' \
+            + b'ACTION=change\0SUBSYSTEM=block\0DEVNAME=sr0\0DISK_MEDIA_CHANGE=1\0'
+        event = drive.parse_uevent(data)
+        self.assertEqual(event['DEVNAME'], 'sr0')
+        self.assertTrue(drive.is_media_change(event))
+        event = drive.parse_uevent(b'add@/devices/foo\0ACTION=add\0SUBSYSTEM=usb\0')
+        self.assertFalse(drive.is_media_change(event))
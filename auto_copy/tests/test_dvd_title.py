@@ -0,0 +1,44 @@
+# test_dvd_title.py
+# tests for dvd_title.py
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from .. import dvd_title
+from .iso_fixture import make_iso
+
+class testDvdTitle(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.image = os.path.join(self.tmp_dir, 'disc.iso')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_normalize_title(self):
+        """Volume names are made readable, generic ones are dropped"""
+        self.assertEqual(dvd_title.normalize_title('THE_BIG__MOVIE '), 'The Big Movie')
+        self.assertIsNone(dvd_title.normalize_title('DVD_VIDEO'))
+        self.assertIsNone(dvd_title.normalize_title(''))
+
+    def test_native_title_and_disc_id(self):
+        """Title and disc id are read from the image without HandBrake"""
+        vmg = b'DVDVIDEO-VMG' + b'\0' * 100
+        vts = b'DVDVIDEO-VTS' + b'\1' * 100
+        make_iso(self.image, 'MY_MOVIE', {'VIDEO_TS/VIDEO_TS.IFO': vmg,
+                                          'VIDEO_TS/VTS_01_0.IFO': vts})
+        self.assertEqual(dvd_title.read_title(self.image, handbrakecli='/does/not/exist'),
+                         'My Movie')
+        volume = dvd_title.open_volume(self.image)
+        self.assertEqual(dvd_title.disc_id(volume), hashlib.md5(vmg + vts).hexdigest())
+
+    def test_provider_id_fallback(self):
+        """With a generic volume name the provider id is used"""
+        vmg = bytearray(200)
+        vmg[0:12] = b'DVDVIDEO-VMG'
+        vmg[0x40:0x4b] = b'OTHER_TITLE'
+        make_iso(self.image, 'DVD_VIDEO', {'VIDEO_TS/VIDEO_TS.IFO': bytes(vmg)})
+        self.assertEqual(dvd_title.read_native_title(self.image), 'Other Title')
@@ -0,0 +1,146 @@
+# test_encode_queue.py
+# tests for encode_queue.py
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from .. import encode_queue
+
+class testEncodeQueue(unittest.TestCase):
+
+    def setUp(self):
+        """Create a directory for the job database and a fake staged image"""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, 'queue.sqlite')
+        self.image = os.path.join(self.tmp_dir, 'disc.iso')
+        with open(self.image, 'w') as image:
+            image.write('image')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def job(self, title, returncode=0):
+        """A job running a python one-liner exiting with returncode"""
+        outfile = os.path.join(self.tmp_dir, str(title) + '.mp4')
+        return {
+            'source': self.image,
+            'title': title,
+            'outfile': outfile,
+            'command': [sys.executable, '-c', 'import sys; sys.exit(' + str(returncode) + ')'],
+        }
+
+    def test_jobs_are_run_by_workers(self):
+        """Submitted jobs are run, their state recorded and the image removed"""
+        encoder = encode_queue.EncodeQueue(self.db_file, workers=2)
+        ids = encoder.submit([self.job(1), self.job(2, returncode=1)], cleanup=self.image)
+        # not the job of someone else, no worker will take it
+        other = encoder.insert(self.job(3), encode_queue.RUNNING)
+        encoder.join(ids)
+        self.assertEqual(encoder.get(ids[0])['state'], encode_queue.DONE)
+        self.assertEqual(encoder.get(ids[1])['state'], encode_queue.FAILED)
+        self.assertEqual(encoder.get(other)['state'], encode_queue.RUNNING)
+        self.assertFalse(os.path.exists(self.image))
+
+    def test_when_finished(self):
+        """The callback learns once all jobs of a disc finished, and whether they succeeded"""
+        encoder = encode_queue.EncodeQueue(self.db_file, workers=None)
+        outcomes = []
+        ids = [encoder.insert(self.job(1), encode_queue.QUEUED),
+               encoder.insert(self.job(2, returncode=1), encode_queue.QUEUED)]
+        encoder.when_finished(ids, outcomes.append)
+        encoder.run_job(encoder.claim())
+        self.assertEqual(outcomes, [])
+        encoder.run_job(encoder.claim())
+        self.assertEqual(outcomes, [False])
+        encoder.when_finished(ids[:1], outcomes.append)
+        self.assertEqual(outcomes, [False, True])
+
+    def test_run_now(self):
+        """Jobs can be run in the calling thread"""
+        encoder = encode_queue.EncodeQueue(self.db_file, workers=None)
+        ids = encoder.run_now([self.job(1)])
+        self.assertEqual(encoder.get(ids[0])['state'], encode_queue.DONE)
+
+    def test_job_environment(self):
+        """Jobs run with the environment the queue was given"""
+        script = 'import os, sys; sys.exit(os.environ["HANDBRAKE_SPOOL"] != "spool")'
+        check = dict(self.job(1), command=[sys.executable, '-c', script])
+        encoder = encode_queue.EncodeQueue(self.db_file, workers=None,
+                                           env=dict(os.environ, HANDBRAKE_SPOOL='spool'))
+        ids = encoder.run_now([check])
+        self.assertEqual(encoder.get(ids[0])['state'], encode_queue.DONE)
+
+    def test_done_jobs_are_not_repeated(self):
+        """A title encoded before a crash is skipped when the disc is read again"""
+        encoder = encode_queue.EncodeQueue(self.db_file, workers=None)
+        done = encoder.run_now([self.job(1)])
+        failed = encoder.run_now([self.job(2, returncode=1)])
+        ids = encoder.run_now([self.job(1), self.job(2)])
+        self.assertEqual(ids[0], done[0])
+        self.assertNotEqual(ids[1], failed[0])
+        self.assertEqual(encoder.submit([self.job(1)]), done)
+        self.assertEqual(encoder.pending(), 0)
+        self.assertEqual(encoder.execute('SELECT COUNT(*) FROM jobs').fetchone()[0], 3)
+
+    def test_recover_after_crash(self):
+        """Interrupted jobs on images are queued again, finished ones are kept"""
+        encoder = encode_queue.EncodeQueue(self.db_file, workers=None)
+        done = encoder.run_now([self.job(1)])[0]
+        image_job = encoder.insert(self.job(2), encode_queue.RUNNING)
+        drive_job = dict(self.job(3), source='/dev/does_not_exist')
+        drive_job = encoder.insert(drive_job, encode_queue.RUNNING)
+        encoder = encode_queue.EncodeQueue(self.db_file, workers=None, recover=True)
+        self.assertEqual(encoder.get(done)['state'], encode_queue.DONE)
+        self.assertEqual(encoder.get(image_job)['state'], encode_queue.QUEUED)
+        self.assertEqual(encoder.get(drive_job)['state'], encode_queue.FAILED)
+
+    def test_stalled_job_is_queued_again(self):
+        """A job stopped for lack of progress is run again"""
+        attempts = os.path.join(self.tmp_dir, 'attempts')
+        job = dict(self.job(1), command=[sys.executable, '-c', (
+            'import sys, time\n'
+            'open(sys.argv[1], "a").write("x")\n'
+            'if len(open(sys.argv[1]).read()) < 2:\n'
+            '    time.sleep(60)\n'), attempts])
+        encoder = encode_queue.EncodeQueue(self.db_file, workers=1, stall_timeout=0.5)
+        job_id = encoder.submit([job])[0]
+        encoder.join([job_id])
+        self.assertEqual(encoder.get(job_id)['state'], encode_queue.DONE)
+        self.assertEqual(encoder.get(job_id)['attempts'], 2)
+        self.assertGreater(encoder.get(job_id)['max_rss'], 0)
+
+    def test_claim_across_processes(self):
+        """A job taken through another connection to the database is not taken again"""
+        first = encode_queue.EncodeQueue(self.db_file, workers=None)
+        second = encode_queue.EncodeQueue(self.db_file, workers=None)
+        ids = [first.insert(self.job(1), encode_queue.QUEUED),
+               first.insert(self.job(2), encode_queue.QUEUED)]
+
+        def accept(job):
+            if job['id'] == ids[0]:
+                # e.g. a manual run takes the job between looking and taking
+                self.assertEqual(second.claim()['id'], ids[0])
+            return True
+        self.assertEqual(first.claim(accept)['id'], ids[1])
+        self.assertIsNone(second.claim())
+
+    def test_crashed_job_removes_image(self):
+        """A job that could not even be started is failed, and its image removed"""
+        class BrokenScheduler(object):
+            def prepare(self, encoder, job, command):
+                raise ValueError('broken')
+        encoder = encode_queue.EncodeQueue(self.db_file, workers=1, scheduler=BrokenScheduler())
+        ids = encoder.submit([self.job(1)], cleanup=self.image)
+        encoder.join(ids)
+        self.assertEqual(encoder.get(ids[0])['state'], encode_queue.FAILED)
+        self.assertFalse(os.path.exists(self.image))
+
+    def test_default_workers(self):
+        """Encodes run several threads, so there are fewer of them than cores"""
+        with mock.patch.object(encode_queue.os, 'cpu_count', return_value=16):
+            self.assertEqual(encode_queue.default_workers(), 4)
+        with mock.patch.object(encode_queue.os, 'cpu_count', return_value=2):
+            self.assertEqual(encode_queue.default_workers(), 1)
@@ -0,0 +1,92 @@
+# test_hb_client.py
+# tests for hb_client.py and docker/hb_worker.py
+
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from .. import hb_client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLIENT = os.path.join(os.path.dirname(HERE), 'hb_client.py')
+
+spec = importlib.util.spec_from_file_location(
+    'hb_worker', os.path.join(os.path.dirname(HERE), 'docker', 'hb_worker.py'))
+hb_worker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(hb_worker)
+
+# a HandBrakeCLI printing its arguments and exiting with the last one
+FAKE_HANDBRAKE = """
+import sys
+sys.stdout.write('Encoding: task 1 of 1, 50.00 %\\r' + ' '.join(sys.argv[1:]) + '\\n')
+sys.stderr.write('log line\\n')
+sys.exit(int(sys.argv[-1]))
+"""
+
+class testHandbrakeSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spool = os.path.join(self.tmp_dir, 'spool')
+        self.handbrakecli = os.path.join(self.tmp_dir, 'HandBrakeCLI')
+        with open(self.handbrakecli, 'w') as tool_fh:
+            tool_fh.write('#!' + sys.executable + '\n' + FAKE_HANDBRAKE)
+        os.chmod(self.handbrakecli, 0o755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def client(self, *args):
+        return subprocess.run([sys.executable, CLIENT] + list(args), stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, env=dict(os.environ, HANDBRAKE_SPOOL=self.spool))
+
+    def test_jobs_run_in_worker(self):
+        """Output and exit code of jobs come back through the spool directory"""
+        worker = hb_worker.Worker(self.spool, self.handbrakecli)
+        threads = [threading.Thread(target=worker.run) for num in range(2)]
+        for thread in threads:
+            thread.start()
+        open(os.path.join(self.spool, 'worker.alive'), 'w').close()
+        try:
+            results = [self.client('-i', 'disc.iso', '0'), self.client('--scan', '3')]
+        finally:
+            worker.stopped.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results[0].returncode, 0)
+        self.assertEqual(results[0].stdout, b'Encoding: task 1 of 1, 50.00 %\r-i disc.iso 0\n')
+        self.assertEqual(results[0].stderr, b'log line\n')
+        self.assertEqual(results[1].returncode, 3)
+        # nothing is left behind
+        self.assertEqual(sorted(os.listdir(self.spool)), ['done', 'new', 'running', 'worker.alive'])
+        self.assertEqual(os.listdir(os.path.join(self.spool, 'done')), [])
+
+    @unittest.skipUnless(shutil.which('nice') and shutil.which('prlimit'), 'needs nice and prlimit')
+    def test_limits_reach_handbrake(self):
+        """Priority and limits set on the host apply to HandBrakeCLI in the worker"""
+        with open(self.handbrakecli, 'w') as tool_fh:
+            tool_fh.write('#!' + sys.executable + '\nimport os, resource\n'
+                          'print(os.nice(0), resource.getrlimit(resource.RLIMIT_CPU)[0])\n')
+        worker = hb_worker.Worker(self.spool, self.handbrakecli)
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        open(os.path.join(self.spool, 'worker.alive'), 'w').close()
+        nice = os.nice(0)
+        try:
+            result = subprocess.run([sys.executable, CLIENT, '--scan'], stdout=subprocess.PIPE,
+                                    env=dict(os.environ, HANDBRAKE_SPOOL=self.spool,
+                                             HANDBRAKE_LIMITS='{"nice": 5, "cpu_seconds": 60}'))
+        finally:
+            worker.stopped.set()
+            thread.join()
+        self.assertEqual(result.stdout.split(), [str(min(nice + 5, 19)).encode(), b'60'])
+
+    def test_no_worker(self):
+        """Without a worker, the client fails right away"""
+        result = self.client('--scan')
+        self.assertEqual(result.returncode, hb_client.NO_WORKER)
+        self.assertIn(b'No HandBrake worker', result.stderr)
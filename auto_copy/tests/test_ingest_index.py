@@ -0,0 +1,59 @@
+# test_ingest_index.py
+# tests for ingest_index.py
+
+import os
+import shutil
+import tempfile
+import unittest
+from .. import ingest_index
+
+class testIngestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'data')
+        os.mkdir(self.data_dir)
+        self.index = ingest_index.IngestIndex(os.path.join(self.tmp_dir, 'index.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, path, data):
+        with open(path, 'wb') as file_fh:
+            file_fh.write(data)
+        return path
+
+    def test_discs(self):
+        """Discs are remembered by fingerprint"""
+        self.assertFalse(self.index.has_disc('abc'))
+        self.index.add_disc('abc', 'MY_MOVIE', 'DATA')
+        self.assertTrue(self.index.has_disc('abc'))
+
+    def test_find_copy(self):
+        """Only files with the very same content are found"""
+        data = os.urandom(300 * 1024)
+        copy = self.write(os.path.join(self.data_dir, 'movie.mkv'), data)
+        self.assertEqual(self.index.rebuild(self.data_dir), 1)
+        same = self.write(os.path.join(self.tmp_dir, 'same.mkv'), data)
+        existing, partial, full = self.index.find_copy(same)
+        self.assertEqual(existing, copy)
+        self.assertEqual(full, ingest_index.full_hash(copy))
+        # same size, beginning, middle and end, but a different byte in between
+        changed = bytearray(data)
+        changed[100 * 1024] ^= 1
+        other = self.write(os.path.join(self.tmp_dir, 'other.mkv'), bytes(changed))
+        self.assertEqual(ingest_index.partial_hash(other), partial)
+        self.assertIsNone(self.index.find_copy(other)[0])
+        self.assertIsNone(self.index.find_copy(self.write(other, data[:-1]))[0])
+
+    def test_removed_copy(self):
+        """Files missing from data_dir are not found, and forgotten by rebuild only"""
+        copy = self.write(os.path.join(self.data_dir, 'movie.mkv'), b'x' * 1000)
+        self.index.add_file(copy)
+        os.unlink(copy)
+        source = self.write(os.path.join(self.tmp_dir, 'movie.mkv'), b'x' * 1000)
+        self.assertIsNone(self.index.find_copy(source)[0])
+        # it may still be on its way there, e.g. with the mover
+        self.assertIsNotNone(self.index.execute('SELECT path FROM files').fetchone())
+        self.assertEqual(self.index.rebuild(self.data_dir), 0)
+        self.assertIsNone(self.index.execute('SELECT path FROM files').fetchone())
@@ -0,0 +1,62 @@
+# test_metadata_cache.py
+# tests for metadata_cache.py
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from .. import metadata_cache
+
+class CountingBackend(metadata_cache.LocalBackend):
+    """Local backend counting the lookups"""
+
+    def __init__(self, movies, delay=0):
+        metadata_cache.LocalBackend.__init__(self, movies)
+        self.lookups = 0
+        self.delay = delay
+
+    def year(self, title):
+        self.lookups += 1
+        time.sleep(self.delay)
+        return metadata_cache.LocalBackend.year(self, title)
+
+class testMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, 'metadata.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hits_and_misses_are_cached(self):
+        """Found years and misses are only looked up once, also after a restart"""
+        backend = CountingBackend({'My Movie': 1999})
+        lookup = metadata_cache.MetadataLookup(backend, metadata_cache.MetadataCache(self.db_file))
+        self.assertEqual(lookup.year('my  movie', disc_id='abc'), 1999)
+        self.assertIsNone(lookup.year('Unknown Movie'))
+        lookup = metadata_cache.MetadataLookup(backend, metadata_cache.MetadataCache(self.db_file))
+        self.assertEqual(lookup.year('Renamed Label', disc_id='abc'), 1999)
+        self.assertIsNone(lookup.year('Unknown Movie'))
+        self.assertEqual(backend.lookups, 2)
+
+    def test_expiry_and_eviction(self):
+        """Expired entries are dropped, the cache does not grow beyond max_entries"""
+        cache = metadata_cache.MetadataCache(self.db_file, negative_ttl=-1, max_entries=2)
+        cache.put('a', None)
+        self.assertEqual(cache.get('a'), (False, None))
+        for key in ['b', 'c', 'd']:
+            cache.put(key, 2000)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('d'), (True, 2000))
+
+    def test_timeout(self):
+        """A slow backend does not hold up the lookup, and is not cached"""
+        backend = CountingBackend({'My Movie': 1999}, delay=0.5)
+        cache = metadata_cache.MetadataCache(self.db_file)
+        lookup = metadata_cache.MetadataLookup(backend, cache, timeout=0.05)
+        start = time.time()
+        self.assertIsNone(lookup.year('My Movie'))
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(cache.get(metadata_cache.normalize_key('My Movie')), (False, None))
@@ -0,0 +1,61 @@
+# test_metrics.py
+# tests for metrics.py
+
+import json
+import sys
+import unittest
+import urllib.request
+from .. import metrics
+from .. import supervisor
+
+HANDBRAKE_OUTPUT = (
+    "import sys\n"
+    "sys.stdout.write('Encoding: task 1 of 1, 1.50 %\\r')\n"
+    "sys.stdout.write('Encoding: task 1 of 1, 52.25 % (120.50 fps, avg 110.00 fps, ETA 00h01m05s)\\r')\n"
+    "sys.stdout.write('\\nEncode done!\\n')\n"
+)
+
+class testMetrics(unittest.TestCase):
+
+    def test_parse_handbrake(self):
+        """Progress lines are parsed, with and without rates"""
+        self.assertEqual(metrics.parse_handbrake('Encoding: task 1 of 1, 0.42 %'),
+                         {'percent': 0.42})
+        self.assertEqual(metrics.parse_handbrake(
+            'Encoding: task 2 of 2, 99.01 % (61.23 fps, avg 58.70 fps, ETA 01h02m03s)'),
+            {'percent': 99.01, 'fps': 61.23, 'avg_fps': 58.7, 'eta': 3723})
+        self.assertIsNone(metrics.parse_handbrake('x264 [info]: profile High'))
+
+    def test_run_with_progress(self):
+        """Carriage return separated progress reaches the registry as it comes"""
+        registry = metrics.Registry()
+        seen = []
+        progress = metrics.HandbrakeProgress(registry, job='movie.mp4')
+        def on_line(line):
+            progress(line)
+            seen.append(registry.snapshot().get('encode_percent'))
+        result = supervisor.run([sys.executable, '-c', HANDBRAKE_OUTPUT], on_line=on_line)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(seen[:2], [[{'job': 'movie.mp4', 'value': 1.5}],
+                                    [{'job': 'movie.mp4', 'value': 52.25}]])
+        self.assertEqual(progress.avg_fps, 110.0)
+        progress.finish()
+        self.assertEqual(registry.snapshot()['encode_percent'], [])
+
+    def test_export(self):
+        """Metrics are served as JSON and in the Prometheus format"""
+        metrics.REGISTRY.inc('copy_bytes_total', 1000, device='sr9')
+        metrics.REGISTRY.observe('stage_seconds', 42, stage='copy', device='sr9')
+        server = metrics.serve(0)
+        try:
+            url = 'http://127.0.0.1:' + str(server.server_address[1])
+            text = urllib.request.urlopen(url + '/metrics').read().decode('utf-8')
+            snapshot = json.loads(urllib.request.urlopen(url + '/metrics.json').read())
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('auto_copy_copy_bytes_total{device="sr9"} 1000', text)
+        self.assertIn('auto_copy_stage_seconds_bucket{device="sr9",stage="copy",le="60"} 1', text)
+        self.assertIn('auto_copy_stage_seconds_bucket{device="sr9",stage="copy",le="30"} 0', text)
+        self.assertIn({'device': 'sr9', 'stage': 'copy', 'count': 1, 'sum': 42.0},
+                      snapshot['stage_seconds'])
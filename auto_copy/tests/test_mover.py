@@ -0,0 +1,122 @@
+# test_mover.py
+# tests for mover.py
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+from .. import mover
+
+class testMover(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.staging = os.path.join(self.tmp_dir, 'staging')
+        self.dest = os.path.join(self.tmp_dir, 'dest')
+        os.makedirs(self.staging)
+        os.makedirs(self.dest)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def output(self, relpath, content):
+        path = os.path.join(self.staging, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as output_fh:
+            output_fh.write(content)
+        return path
+
+    def journal(self):
+        with open(os.path.join(self.staging, mover.JOURNAL)) as journal_fh:
+            return json.load(journal_fh)
+
+    def test_move(self):
+        """Handed over files end up in dest, staging is cleaned up"""
+        files = {'movie.mp4': os.urandom(300000), 'audio_cd/track_01.flac': b'flac'}
+        the_mover = mover.Mover(self.staging, self.dest)
+        for relpath, content in sorted(files.items()):
+            the_mover.submit(self.output(relpath, content))
+        # not handed over, stays
+        self.output('encoding.mp4', b'half')
+        the_mover.join()
+        for relpath, content in files.items():
+            with open(os.path.join(self.dest, relpath), 'rb') as dest_fh:
+                self.assertEqual(dest_fh.read(), content)
+        self.assertEqual(sorted(os.listdir(self.staging)), [mover.JOURNAL, 'encoding.mp4'])
+        self.assertEqual(sorted(os.listdir(self.dest)), ['audio_cd', 'movie.mp4'])
+        self.assertEqual(self.journal(), {})
+        self.assertEqual(the_mover.final_path(os.path.join(self.staging, 'movie.mp4')),
+                         os.path.join(self.dest, 'movie.mp4'))
+
+    def test_resume(self):
+        """Files in the journal of an earlier run are moved, continuing a partial copy"""
+        content = os.urandom(3 * 1024 * 1024 + 5)
+        self.output('movie.mp4', content)
+        with open(os.path.join(self.staging, mover.JOURNAL), 'w') as journal_fh:
+            json.dump(['movie.mp4'], journal_fh)
+        with open(os.path.join(self.dest, '.movie.mp4.part'), 'wb') as part_fh:
+            part_fh.write(content[:2 * 1024 * 1024 + 7])
+        with mock.patch.object(mover, 'BUFFER_SIZE', 1024 * 1024):
+            the_mover = mover.Mover(self.staging, self.dest)
+            the_mover.join()
+        with open(os.path.join(self.dest, 'movie.mp4'), 'rb') as dest_fh:
+            self.assertEqual(dest_fh.read(), content)
+        self.assertEqual(os.listdir(self.dest), ['movie.mp4'])
+
+    def test_name_taken(self):
+        """A file whose name is taken gets another one, known as soon as it is handed over"""
+        with open(os.path.join(self.dest, 'movie.mp4'), 'wb') as dest_fh:
+            dest_fh.write(b'older movie')
+        the_mover = mover.Mover(self.staging, self.dest, workers=0)
+        first = the_mover.submit(self.output('movie.mp4', b'movie'))
+        self.assertEqual(first, os.path.join(self.dest, 'movie_1.mp4'))
+        self.assertEqual(the_mover.final_path(os.path.join(self.staging, 'movie.mp4')), first)
+        self.assertEqual(self.journal(), {'movie.mp4': 'movie_1.mp4'})
+        # after a restart, the file still goes where it was said to go
+        the_mover = mover.Mover(self.staging, self.dest)
+        the_mover.join()
+        with open(first, 'rb') as dest_fh:
+            self.assertEqual(dest_fh.read(), b'movie')
+
+    def test_retry(self):
+        """A failed move is tried again later"""
+        calls = []
+        transfer = mover.transfer
+
+        def flaky(source, dest, throttle=None):
+            calls.append(dest)
+            if len(calls) == 1:
+                raise OSError('Stale file handle')
+            return transfer(source, dest, throttle)
+        with mock.patch.object(mover, 'transfer', flaky):
+            the_mover = mover.Mover(self.staging, self.dest, retry_delay=0.1)
+            the_mover.submit(self.output('movie.mp4', b'movie'))
+            the_mover.join()
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'movie.mp4')))
+
+    def test_wait_for_space(self):
+        """Waiting ends when the mover freed enough space, or has nothing left to move"""
+        the_mover = mover.Mover(self.staging, self.dest, workers=0, min_free=1000)
+        with mock.patch.object(mover, 'free_bytes', lambda path: 0):
+            self.assertEqual(int(the_mover.wait_for_space()), 0)
+            the_mover.submit(self.output('movie.mp4', b'movie'))
+            start = time.time()
+            worker = mover.threading.Thread(target=the_mover.run)
+            worker.daemon = True
+            worker.start()
+            the_mover.wait_for_space()
+            self.assertTrue(os.path.exists(os.path.join(self.dest, 'movie.mp4')))
+            self.assertLess(time.time() - start, 10)
+
+    def test_throttle(self):
+        """Bytes beyond a second's worth are delayed"""
+        throttle = mover.Throttle(1000)
+        start = time.time()
+        throttle.consume(1000)
+        throttle.consume(500)
+        self.assertGreaterEqual(time.time() - start, 0.45)
@@ -0,0 +1,95 @@
+# test_rescue.py
+# tests for rescue.py
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from .. import rescue
+
+SECTOR = rescue.SECTOR_SIZE
+
+class testRescue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.device = os.path.join(self.tmp_dir, 'device')
+        self.image = os.path.join(self.tmp_dir, 'disc.iso')
+        self.map_file = os.path.join(self.tmp_dir, 'disc.map')
+        self.data = os.urandom(64 * SECTOR)
+        with open(self.device, 'wb') as device:
+            device.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_image(self):
+        with open(self.image, 'rb') as image:
+            return image.read()
+
+    def test_map(self):
+        """Areas are split and merged, and survive saving"""
+        rescue_map = rescue.RescueMap(100)
+        rescue_map.set(10, 20, rescue.FINISHED)
+        rescue_map.set(30, 10, rescue.FINISHED)
+        rescue_map.set(15, 5, rescue.BAD)
+        self.assertEqual(rescue_map.areas, [[0, 10, '?'], [10, 5, '+'], [15, 5, '-'],
+                                            [20, 20, '+'], [40, 60, '?']])
+        rescue_map.save(self.map_file)
+        loaded = rescue.RescueMap.load(self.map_file)
+        self.assertEqual(loaded.size, 100)
+        self.assertEqual(loaded.areas, rescue_map.areas)
+
+    def test_bad_sectors(self):
+        """Good data around bad sectors is read, the bad sectors are zeroed"""
+        bad = set([20, 21, 40])
+        real_pread = rescue.Rescuer.pread
+        def pread(rescuer, size, start):
+            if bad & set(range(start // SECTOR, (start + size) // SECTOR)):
+                raise OSError(errno.EIO, 'Input/output error')
+            return real_pread(rescuer, size, start)
+        with mock.patch.object(rescue.Rescuer, 'pread', pread):
+            rescue_map = rescue.rescue(self.device, self.image, self.map_file,
+                                       block_size=16 * SECTOR, retry_time=60)
+        self.assertEqual(rescue_map.find(rescue.BAD),
+                         [(20 * SECTOR, 2 * SECTOR), (40 * SECTOR, SECTOR)])
+        expected = bytearray(self.data)
+        for sector in bad:
+            expected[sector * SECTOR:(sector + 1) * SECTOR] = b'\0' * SECTOR
+        self.assertEqual(self.read_image(), bytes(expected))
+
+    def test_resume(self):
+        """Areas finished before are not read again"""
+        rescue_map = rescue.RescueMap(len(self.data))
+        rescue_map.set(0, 32 * SECTOR, rescue.FINISHED)
+        rescue_map.save(self.map_file)
+        with open(self.image, 'wb') as image:
+            image.write(self.data[:32 * SECTOR])
+        reads = []
+        real_pread = rescue.Rescuer.pread
+        def pread(rescuer, size, start):
+            reads.append(start)
+            return real_pread(rescuer, size, start)
+        with mock.patch.object(rescue.Rescuer, 'pread', pread):
+            rescue_map = rescue.rescue(self.device, self.image, self.map_file,
+                                       block_size=16 * SECTOR)
+        self.assertEqual(reads, [32 * SECTOR, 48 * SECTOR])
+        self.assertTrue(rescue_map.complete)
+        self.assertEqual(self.read_image(), self.data)
+
+    def test_time_limit(self):
+        """The first pass stops at the time limit, what was not read stays to be resumed"""
+        clock = [1000.0]
+        real_pread = rescue.Rescuer.pread
+        def pread(rescuer, size, start):
+            # every read takes a minute on this disc
+            clock[0] += 60
+            return real_pread(rescuer, size, start)
+        with mock.patch.object(rescue.Rescuer, 'pread', pread), \
+                mock.patch.object(rescue.time, 'time', lambda: clock[0]):
+            rescue_map = rescue.rescue(self.device, self.image, self.map_file,
+                                       block_size=16 * SECTOR, time_limit=100)
+        self.assertEqual(rescue_map.find(rescue.FINISHED), [(0, 32 * SECTOR)])
+        self.assertEqual(rescue_map.find(rescue.NON_TRIED), [(32 * SECTOR, 32 * SECTOR)])
@@ -0,0 +1,85 @@
+# test_scheduler.py
+# tests for scheduler.py
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from .. import encode_queue
+from .. import scheduler
+
+# prints a HandBrake progress line, whatever preset it is given
+PROGRESS = 'print("Encoding: task 1 of 1, 100.00 % (50.00 fps, avg 42.00 fps, ETA 00h00m00s)")'
+
+class testScheduler(unittest.TestCase):
+
+    def test_preset_speeds(self):
+        """Measured presets are taken as they are, the others estimated from them"""
+        speeds = scheduler.preset_speeds({'slow': 30.0, 'unknown': 99.0})
+        self.assertEqual(speeds['slow'], 30.0)
+        self.assertAlmostEqual(speeds['medium'], 50.0)
+        self.assertAlmostEqual(speeds['veryfast'], 200.0)
+        self.assertEqual(scheduler.preset_speeds({})['medium'], scheduler.DEFAULT_FPS)
+
+    def test_choose_preset(self):
+        """The slowest preset making the target wins, the fastest if none does"""
+        speeds = scheduler.preset_speeds({'medium': 100.0})
+        # 2 hours of video at 60 fps (slow) take 50 minutes
+        self.assertEqual(scheduler.choose_preset(7200, 3600, speeds)[0], 'slow')
+        # 10 hours at 150 fps (fast) take 1.7 hours, at 60 fps 4.2
+        self.assertEqual(scheduler.choose_preset(36000, 7200, speeds)[0], 'fast')
+        self.assertEqual(scheduler.choose_preset(36000, 7200, speeds, share=0.5)[0], 'faster')
+        self.assertEqual(scheduler.choose_preset(36000, 7200, speeds, parallel=2)[0], 'medium')
+        self.assertEqual(scheduler.choose_preset(10 ** 6, 60, speeds)[0], 'veryfast')
+        self.assertEqual(scheduler.choose_preset(60, 3600, speeds, slowest='veryslow')[0],
+                         'veryslow')
+
+    def test_replace_preset(self):
+        command = ['HandBrakeCLI', '-i', 'disc.iso', '--x264-preset', 'slow', '--optimize']
+        self.assertEqual(scheduler.current_preset(command), 'slow')
+        self.assertEqual(scheduler.replace_preset(command, 'fast')[4], 'fast')
+        self.assertEqual(command[4], 'slow')
+        self.assertIsNone(scheduler.current_preset(['HandBrakeCLI', '--x264-preset']))
+
+    def test_priority_prefix(self):
+        """Only installed tools are used"""
+        with mock.patch.object(scheduler.shutil, 'which', lambda name: '/usr/bin/' + name):
+            self.assertEqual(scheduler.priority_prefix(5, True, [2, 3]),
+                             ['/usr/bin/nice', '-n', '5', '/usr/bin/ionice', '-c', '3', '-t',
+                              '/usr/bin/taskset', '-c', '2,3'])
+        with mock.patch.object(scheduler.shutil, 'which', lambda name: None):
+            self.assertEqual(scheduler.priority_prefix(5, True, [2, 3]), [])
+
+
+class testScheduledQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.tmp_dir, 'queue.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_preset_and_fps_are_recorded(self):
+        """The chosen preset and the fps reached end up in the job database"""
+        planner = scheduler.Scheduler(slowest='veryslow', fastest='veryfast', target_hours=1,
+                                      reserved_cpus=0)
+        encoder = encode_queue.EncodeQueue(self.db_file, workers=None, scheduler=planner)
+        job = {
+            'source': '/dev/sr0',
+            'title': 1,
+            'outfile': os.path.join(self.tmp_dir, 'movie.mp4'),
+            'command': [sys.executable, '-c', PROGRESS, '--x264-preset', 'veryslow'],
+            'duration': 7200,
+        }
+        with mock.patch.object(scheduler.os, 'getloadavg', lambda: (0.0, 0.0, 0.0)):
+            job_id = encoder.run_now([job])[0]
+        row = encoder.get(job_id)
+        self.assertEqual(row['state'], encode_queue.DONE)
+        # two hours of video within an hour need 50 fps: medium at 60 fps
+        self.assertEqual(row['preset'], 'medium')
+        self.assertEqual(row['fps'], 42.0)
+        self.assertEqual(encoder.preset_speeds(), {'medium': 42.0})
+        self.assertEqual(encoder.backlog(), (0, 0))
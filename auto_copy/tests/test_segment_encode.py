@@ -0,0 +1,75 @@
+# test_segment_encode.py
+# tests for segment_encode.py
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from .. import segment_encode
+
+# stand-ins writing the duration of a "video" as its content
+FAKE_HANDBRAKE = """
+import sys
+chapters = [int(c) for c in sys.argv[sys.argv.index('--chapters') + 1].split('-')]
+lengths = [300, 420, 600, 280, 500, 400]
+seconds = sum(lengths[chapters[0] - 1:chapters[1]])
+sys.stdout.write('Encoding: task 1 of 1, 50.00 % (100.00 fps, avg 90.00 fps, ETA 00h00m10s)\\r')
+open(sys.argv[sys.argv.index('-o') + 1], 'w').write(str(seconds))
+"""
+FAKE_FFPROBE = """
+import sys
+print(open(sys.argv[-1]).read())
+"""
+FAKE_FFMPEG = """
+import sys
+files = [line.split("'")[1] for line in open(sys.argv[sys.argv.index('-i') + 1])]
+open(sys.argv[-1], 'w').write(str(sum(float(open(f).read()) for f in files)))
+"""
+
+class testSegmentEncode(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def tool(self, name, code):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as tool_fh:
+            tool_fh.write('#!' + sys.executable + '\n' + code)
+        os.chmod(path, 0o755)
+        return path
+
+    def test_plan_segments(self):
+        """Segments are contiguous, of about equal length, and not too short"""
+        chapters = [300, 420, 600, 280, 500, 400]
+        self.assertEqual(segment_encode.plan_segments(chapters, 3), [(1, 2), (3, 4), (5, 6)])
+        self.assertEqual(segment_encode.plan_segments(chapters, 32), [(n, n) for n in range(1, 7)])
+        self.assertEqual(segment_encode.plan_segments([100, 100, 100], 4), [(1, 3)])
+        self.assertEqual(segment_encode.plan_segments([], 4), [])
+
+    def test_segment_command(self):
+        """Only the output, chapters and markers change"""
+        command = ['HandBrakeCLI', '-i', 'disc.iso', '-o', 'movie.mp4', '-t', '2', '-m', '-f', 'mp4']
+        self.assertEqual(segment_encode.segment_command(command, 3, 4, 'seg.mp4', 8),
+                         ['HandBrakeCLI', '-i', 'disc.iso', '-o', 'seg.mp4', '-t', '2', '-f', 'mp4',
+                          '--chapters', '3-4', '--encopts', 'threads=8'])
+
+    def test_chapter_metadata(self):
+        """Chapters follow the measured segment lengths"""
+        metadata = segment_encode.chapter_metadata([10, 20, 30], [(1, 2), (3, 3)], [30.5, 29.5])
+        starts = [line for line in metadata.splitlines() if line.startswith(('START', 'END'))]
+        self.assertEqual(starts, ['START=0', 'END=10000', 'START=10000', 'END=30500',
+                                  'START=30500', 'END=60000'])
+
+    def test_encode_title(self):
+        """Segments are encoded, joined, checked and cleaned up"""
+        outfile = os.path.join(self.tmp_dir, 'movie.mp4')
+        command = [self.tool('HandBrakeCLI', FAKE_HANDBRAKE), '-o', outfile, '-m']
+        chapters = [300, 420, 600, 280, 500, 400]
+        segment_encode.encode_title(command, chapters, 3, self.tool('ffmpeg', FAKE_FFMPEG),
+                                    self.tool('ffprobe', FAKE_FFPROBE))
+        self.assertEqual(float(open(outfile).read()), sum(chapters))
+        self.assertNotIn('.movie.mp4.segments', os.listdir(self.tmp_dir))
@@ -0,0 +1,116 @@
+# test_supervisor.py
+# tests for supervisor.py
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+from .. import supervisor
+
+# starts a helper, then ignores SIGTERM
+STUBBORN = """
+import signal, subprocess, sys, time
+helper = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+open(sys.argv[1], 'w').write(str(helper.pid))
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+print('started', flush=True)
+time.sleep(60)
+"""
+
+# writes to a file for a while, then hangs
+STALLING = """
+import sys, time
+for num in range(6):
+    open(sys.argv[1], 'a').write('x')
+    time.sleep(0.25)
+time.sleep(60)
+"""
+
+
+def alive(pid):
+    """A process exists and is not a zombie"""
+    try:
+        with open('/proc/' + str(pid) + '/stat') as stat_fh:
+            return stat_fh.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class testSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_result(self):
+        """Exit code, output and resource usage are returned and kept as metrics"""
+        result = supervisor.run([sys.executable, '-c', (
+            'import sys\n'
+            'sys.stdout.write("out\\n")\n'
+            'sys.stderr.write("err\\n")\n'
+            'sys.exit(3)\n')], capture=True, merge_stderr=False, name='tool', quiet=True)
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.output, b'out\n')
+        self.assertEqual(list(result.tail), ['out'])
+        self.assertIsNone(result.stopped)
+        self.assertGreater(result.max_rss, 0)
+        self.assertIn({'tool': 'tool', 'value': result.max_rss},
+                      supervisor.metrics.REGISTRY.snapshot()['process_max_rss_bytes'])
+        with self.assertRaises(TypeError):
+            supervisor.run('mount /dev/sr0 /mnt/cdrom')
+
+    def test_timeout(self):
+        """A command running too long is stopped with its helpers, killed if it has to be"""
+        pid_file = os.path.join(self.tmp_dir, 'helper.pid')
+        start = time.time()
+        with mock.patch.object(supervisor, 'TERM_GRACE', 0.5):
+            result = supervisor.run([sys.executable, '-c', STUBBORN, pid_file], timeout=1)
+        self.assertEqual(result.stopped, supervisor.TIMEOUT)
+        self.assertEqual(result.returncode, -9)
+        self.assertEqual(list(result.tail), ['started'])
+        self.assertLess(time.time() - start, 10)
+        with open(pid_file) as pid_fh:
+            helper = int(pid_fh.read())
+        for num in range(50):
+            if not alive(helper):
+                break
+            time.sleep(0.1)
+        self.assertFalse(alive(helper))
+
+    def test_stall(self):
+        """A growing watched file counts as progress, a command without any is stopped"""
+        watched = os.path.join(self.tmp_dir, 'out.wav')
+        result = supervisor.run([sys.executable, '-c', STALLING, watched], stall_timeout=0.8,
+                                watch=watched)
+        self.assertEqual(result.stopped, supervisor.STALLED)
+        self.assertEqual(result.returncode, -15)
+        self.assertEqual(os.path.getsize(watched), 6)
+        self.assertGreater(result.seconds, 2)
+
+    def test_limit_prefix(self):
+        """Limits use a cgroup if asked for and possible, rlimits otherwise"""
+        with mock.patch.object(supervisor.shutil, 'which', lambda name: '/usr/bin/' + name):
+            self.assertEqual(supervisor.limit_prefix(), [])
+            self.assertEqual(supervisor.limit_prefix(memory_mb=2, cpu_seconds=60),
+                             ['/usr/bin/prlimit', '--as=2097152', '--cpu=60'])
+            self.assertEqual(supervisor.limit_prefix(memory_mb=2, cpu_seconds=60, cpus=1.5,
+                                                     cgroup=True),
+                             ['/usr/bin/systemd-run', '--scope', '--quiet', '--collect',
+                              '-p', 'MemoryMax=2M', '-p', 'CPUQuota=150%',
+                              '/usr/bin/prlimit', '--cpu=60'])
+        with mock.patch.object(supervisor.shutil, 'which', lambda name: None):
+            self.assertEqual(supervisor.limit_prefix(memory_mb=2, cgroup=True), [])
+
+    @unittest.skipUnless(shutil.which('prlimit'), 'prlimit is not installed')
+    def test_rlimit(self):
+        """A command using more CPU time than allowed is killed by the kernel"""
+        result = supervisor.run(supervisor.limit_prefix(cpu_seconds=1)
+                                + [sys.executable, '-c', 'while True: pass'],
+                                timeout=30, quiet=True)
+        self.assertLess(result.returncode, 0)
+        self.assertIsNone(result.stopped)
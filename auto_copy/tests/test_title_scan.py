@@ -0,0 +1,55 @@
+# test_title_scan.py
+# tests for title_scan.py
+
+import json
+import unittest
+from .. import title_scan
+
+def hb_title(index, hours, minutes, chapters=1):
+    """A title as found in the HandBrake json scan output"""
+    return {
+        'Index': index,
+        'Name': 'MY_MOVIE',
+        'Duration': {'Hours': hours, 'Minutes': minutes, 'Seconds': 0},
+        'ChapterList': [{'Duration': {'Hours': 0, 'Minutes': 5, 'Seconds': 0}}] * chapters,
+        'AudioList': [{'LanguageCode': 'eng', 'CodecName': 'ac3'}],
+        'SubtitleList': [],
+    }
+
+SCAN_OUTPUT = 'Version: {"Name": "HandBrake"}\nProgress: {"State": "SCANNING"}\n' \
+    + 'JSON Title Set: ' + json.dumps({'TitleList': [
+        hb_title(1, 0, 0), hb_title(2, 1, 45, chapters=20), hb_title(3, 0, 22, chapters=4),
+    ]}, indent=4) + '\n'
+
+class testTitleScan(unittest.TestCase):
+
+    def test_parse_title_set(self):
+        """Titles are parsed from the scan output"""
+        titles = title_scan.parse_title_set(SCAN_OUTPUT)
+        self.assertEqual([title.index for title in titles], [1, 2, 3])
+        self.assertEqual(titles[1].duration, 6300)
+        self.assertEqual(len(titles[1].chapters), 20)
+        self.assertEqual(titles[1].audio[0]['language'], 'eng')
+        self.assertEqual(titles[1].name, 'MY_MOVIE')
+
+    def test_parse_garbage(self):
+        """Output without a title set yields no titles"""
+        self.assertListEqual(title_scan.parse_title_set('No title found.'), [])
+
+    def test_feature_titles(self):
+        """Short titles are skipped, the longest titles are kept"""
+        titles = title_scan.parse_title_set(SCAN_OUTPUT)
+        features = title_scan.feature_titles(titles, 120)
+        self.assertEqual([title.index for title in features], [2, 3])
+        features = title_scan.feature_titles(titles, 120, max_titles=1)
+        self.assertEqual([title.index for title in features], [2])
+
+    def test_unique_titles(self):
+        """Identical titles are grouped, the first one is kept"""
+        titles = title_scan.parse_title_set(SCAN_OUTPUT)
+        duplicate = title_scan.Title(7, titles[1].duration + 1, chapters=titles[1].chapters,
+                                     audio=titles[1].audio, name='MY_MOVIE')
+        different = title_scan.Title(8, titles[1].duration, chapters=titles[1].chapters[:5],
+                                     audio=titles[1].audio)
+        unique = title_scan.unique_titles(titles + [duplicate, different])
+        self.assertEqual([title.index for title in unique], [1, 2, 3, 8])
@@ -0,0 +1,182 @@
+"""
+title_scan.py
+Scan all titles of a DVD (or image) in a single HandBrakeCLI pass and
+parse the result, so only real feature titles need to be ripped.
+"""
+
+import json
+import logging
+
+import supervisor
+
+LOGGER = logging.getLogger('auto_copy')
+
+# HandBrakeCLI prints this right before the scan result
+JSON_MARKER = 'JSON Title Set:'
+
+
+class Title(object):
+    """
+    A single title found on a disc
+    """
+
+    def __init__(self, index, duration, chapters=None, audio=None, subtitles=None,
+                 name=None, vts=None, angles=1):
+        """
+        index: title number as used by HandBrakeCLI -t
+        duration: length in seconds
+        chapters: list of chapter lengths in seconds
+        audio: list of audio tracks, each a dict with language and codec
+        subtitles: list of subtitle tracks, each a dict with language and source
+        name: the volume name HandBrake found
+        vts: the video title set the title lives in, if known
+        angles: number of angles
+        """
+        self.index = index
+        self.duration = duration
+        self.chapters = chapters or []
+        self.audio = audio or []
+        self.subtitles = subtitles or []
+        self.name = name
+        self.vts = vts
+        self.angles = angles
+
+    def __repr__(self):
+        return 'Title(' + str(self.index) + ', ' + str(self.duration) + 's, ' \
+            + str(len(self.chapters)) + ' chapters)'
+
+
+def duration_seconds(duration):
+    """
+    Convert a HandBrake duration dict into seconds
+    """
+    if not duration:
+        return 0
+    return duration.get('Hours', 0) * 3600 + duration.get('Minutes', 0) * 60 \
+        + duration.get('Seconds', 0)
+
+
+def parse_title_set(output):
+    """
+    Parse the output of HandBrakeCLI --scan --json
+
+    output: everything HandBrakeCLI printed to stdout
+
+    returns a list of Title objects, empty if nothing could be parsed
+    """
+    marker = output.find(JSON_MARKER)
+    if marker < 0:
+        return []
+    start = output.find('{', marker)
+    try:
+        title_set = json.JSONDecoder().raw_decode(output[start:])[0]
+    except ValueError:
+        LOGGER.warning('Could not parse HandBrake scan result')
+        return []
+    titles = []
+    for title in title_set.get('TitleList', []):
+        titles.append(Title(
+            title['Index'],
+            duration_seconds(title.get('Duration')),
+            chapters=[duration_seconds(chapter.get('Duration'))
+                      for chapter in title.get('ChapterList', [])],
+            audio=[{'language': audio.get('LanguageCode'), 'codec': audio.get('CodecName'),
+                    'channels': audio.get('ChannelLayoutName')}
+                   for audio in title.get('AudioList', [])],
+            subtitles=[{'language': subtitle.get('LanguageCode'),
+                        'source': subtitle.get('SourceName')}
+                       for subtitle in title.get('SubtitleList', [])],
+            name=title.get('Name'),
+            vts=title.get('VTS'),
+            angles=title.get('AngleCount', 1),
+        ))
+    return titles
+
+
+def scan(source, handbrakecli='/bin/HandBrakeCLI', timeout=supervisor.SCAN_TIMEOUT, env=None):
+    """
+    Scan all titles of source
+
+    source: a device or an image
+    handbrakecli: path to HandBrakeCLI
+    timeout: seconds the scan may take
+    env: environment of HandBrakeCLI, e.g. for hb_client.py. Defaults to ours
+
+    returns a list of Title objects
+    """
+    command = [handbrakecli, '--scan', '--json', '-t', '0', '-i', source]
+    LOGGER.debug('Scanning titles: %s', ' '.join(command))
+    try:
+        result = supervisor.run(command, timeout=timeout, capture=True, merge_stderr=False,
+                                quiet=True, env=env)
+    except OSError as error:
+        LOGGER.warning('Scanning %s failed: %s', source, error)
+        return []
+    if result.returncode != 0:
+        LOGGER.warning('Scanning %s failed with %s', source, result.returncode)
+        return []
+    titles = parse_title_set(result.output.decode('utf-8', 'replace'))
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug('Found titles: %s', ', '.join([repr(title) for title in titles]))
+    return titles
+
+
+def feature_titles(titles, min_duration, max_titles=None):
+    """
+    Select the titles worth ripping
+
+    titles: list of Title objects
+    min_duration: titles shorter than this (seconds) are skipped
+    max_titles: rip at most this many titles, the longest ones win. optional
+
+    returns a list of Title objects, in disc order
+    """
+    features = [title for title in titles if title.duration >= min_duration]
+    if max_titles is not None and len(features) > max_titles:
+        longest = sorted(features, key=lambda title: title.duration, reverse=True)[:max_titles]
+        features = [title for title in features if title in longest]
+    return features
+
+
+def fingerprint(title, tolerance=2):
+    """
+    Describe a title by its layout, so that copies of the same content
+    (repeated playlists, obfuscation titles, angles) end up with the same
+    fingerprint. The title number itself is not part of it.
+
+    title: a Title object
+    tolerance: durations are rounded to this many seconds
+
+    returns a hashable tuple
+    """
+    def rounded(seconds):
+        return int(round(float(seconds) / tolerance))
+    return (
+        rounded(title.duration),
+        tuple([rounded(chapter) for chapter in title.chapters]),
+        title.vts,
+        tuple([(audio['language'], audio['codec'], audio['channels']) for audio in title.audio]),
+        tuple([subtitle['language'] for subtitle in title.subtitles]),
+    )
+
+
+def unique_titles(titles, tolerance=2):
+    """
+    Group titles with the same fingerprint and keep one of each group,
+    the one with the lowest title number.
+
+    titles: list of Title objects
+    tolerance: see fingerprint
+
+    returns a list of Title objects, in disc order
+    """
+    groups = {}
+    for title in titles:
+        groups.setdefault(fingerprint(title, tolerance), []).append(title)
+    unique = []
+    for group in groups.values():
+        if len(group) > 1:
+            LOGGER.info('Titles %s look identical, keeping title %s',
+                        ', '.join([str(title.index) for title in group]), group[0].index)
+        unique.append(group[0])
+    return sorted(unique, key=lambda title: title.index)